@@ -2,7 +2,11 @@
 
 import os
 import sys
-from sqlalchemy.util import KeyedTuple
+import argparse
+
+from om_record  import gen_record_type
+from om_input   import open_input
+from om_profile import profile_stage, profile_output, profile_run, add_profile_args
 
 #grep -P '#|\tgap' SL2.50ch_from_sc.agp.gff3 > SL2.50ch_from_sc.agp.gff3.gap.gff3
 #grep -P '#|\tcontig' SL2.50ch_from_sc.agp.gff3 > SL2.50ch_from_sc.agp.gff3.contig.gff3
@@ -14,6 +18,14 @@ col_names_shared =                    [ 'object_id'   , 'object_beg'   , 'object
 col_names_gap_Y  = col_names_shared + [ 'gap_length'  , 'gap_type'     , 'linkage'      , 'linkage_evidence'                   ]
 col_names_gap_N  = col_names_shared + [ 'gap_length'  , 'gap_type'     , 'linkage'                                             ]
 col_names_contig = col_names_shared + [ 'component_id', 'component_beg', 'component_end', 'orientation'                        ]
+col_names_extra  =                    [ 'orientation' , 'component_type_desc', 'type'   , 'source_name'     , 'score'          , 'phase' ]
+
+def gen_agp_record_type(name, col_names):
+    return gen_record_type(name, col_names + [ x for x in col_names_extra if x not in col_names ])
+
+AgpGapY   = gen_agp_record_type('AgpGapY'  , col_names_gap_Y )
+AgpGapN   = gen_agp_record_type('AgpGapN'  , col_names_gap_N )
+AgpContig = gen_agp_record_type('AgpContig', col_names_contig)
 
 component_types = {
     'A': 'Active Finishing',
@@ -43,16 +55,25 @@ gff_cols    = [ 'object_id', 'source_name', 'type', 'object_beg', 'object_end',
 source_name = 'agp'
 id_prefix   = 'agp_'
 
+def parse_args(args):
+    parser = argparse.ArgumentParser(description="AGP file as GFF3")
+    parser.add_argument( 'inagp' , help="AGP file, optionally gzip, bgzip or bzip2 compressed" )
+    add_profile_args(parser)
+
+    return parser.parse_args(args=args)
+
 def main(args):
-    in_agp = args[0]
+    in_agp = args.inagp
     ou_gff = in_agp + ".gff3"
     
     print "SAVING TO", ou_gff
-    with open(in_agp, 'r') as fhd_in:
+    profile_output(ou_gff)
+    with open_input(in_agp) as fhd_in, profile_stage("convert", unit="lines") as stage:
         with open(ou_gff, 'w') as fhd_ou:
             fhd_ou.write("##gff-version 3\n")
             fhd_ou.write("#infile: %s\n" % in_agp)
             
+            num_lines = 0
             for line_in in fhd_in:
                 line_in = line_in.strip()
                 
@@ -63,15 +84,16 @@ def main(args):
                     continue
                 
                 cols_in = line_in.split("\t")
+                num_lines += 1
                 
                 if cols_in[4] in flags_gap:
                     if   cols_in[7] == 'no':
                         assert len(cols_in) == len(col_names_gap_N), "%d vs %d: %s" % ( len(cols_in), len(col_names_gap_N), " ".join(cols_in) )
-                        cols_in = KeyedTuple(cols_in, labels=col_names_gap_N   )._asdict()
+                        cols_in = AgpGapN(  cols_in)
                     
                     elif cols_in[7] == 'yes':
                         assert len(cols_in) == len(col_names_gap_Y), "%d vs %d: %s" % ( len(cols_in), len(col_names_gap_Y), " ".join(cols_in) )
-                        cols_in = KeyedTuple(cols_in, labels=col_names_gap_Y   )._asdict()
+                        cols_in = AgpGapY(  cols_in)
 
                     else:
                         print "unknown gap linkage evidence:", cols_in[7]
@@ -81,7 +103,7 @@ def main(args):
                 
                 else:
                     assert len(cols_in) == len(col_names_contig), "%d vs %d: %s" % ( len(cols_in), len(col_names_contig), " ".join(cols_in) )
-                    cols_in = KeyedTuple(cols_in, labels=col_names_contig)._asdict()
+                    cols_in = AgpContig(cols_in)
                 
                 cols_in['component_type_desc'] = component_types[cols_in['component_type']]
                 cols_in['type'               ] = type_mapper[    cols_in['component_type']]
@@ -98,9 +120,14 @@ def main(args):
                 fhd_ou.write(";".join( ["=".join([x, cols_in[x]]) for x in sorted(cols_in) if x not in gff_cols] ) )
                 fhd_ou.write("\n")
 
+            stage.rows = num_lines
+
 
 if __name__ == '__main__':
-    main(sys.argv[1:])
+    args = parse_args(sys.argv[1:])
+
+    with profile_run("agp_to_gff", args):
+        main(args)
         
 #1               2        3               4       5       6               7       8        9
 #SL2.50ch00      1        2191949         1       W       SL2.40sc05082   1       2191949  0
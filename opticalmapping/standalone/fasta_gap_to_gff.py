@@ -2,82 +2,219 @@
 
 import os
 import sys
-import re
+import mmap
+import argparse
 
-re_ns = re.compile('(n+)')
+import numpy as np
+
+from om_input   import open_input, detect_compression
+from om_fasta   import FastaIndex, FastaIndexError
+from om_profile import profile_stage, profile_output, profile_run, add_profile_args
 
 source_name = "fasta"
 source_type = "gap"
 id_prefix   = "fastagap_"
 score, orientation, phase = [ '.', '.', '.' ]
 
-def parse_seq(ofh, seq_name, seq_seq, min_size=1):
-    if len(seq_seq) == 0:
+scan_buffer_size = 1 << 20
+
+class GapScanner(object):
+    """
+    Finds the runs of N/n of one sequence fed a piece at a time, carrying a
+    run still open at the end of a piece over to the next one. Only the gap
+    lines are kept, so memory does not grow with the sequence length.
+    """
+    def __init__(self, seq_name, min_size=1):
+        self.seq_name  = seq_name
+        self.min_size  = min_size
+        self.seq_len   = 0
+        self.run_start = None
+        self.hit_num   = 1
+        self.lines     = []
+
+    def add_gap(self, start, end):
+        #start and end are 0 based, end excluded
+        if end - start < self.min_size:
+            return
+
+        start_pos  = start + 1
+        end_pos    = end
+        diff_pos   = end_pos - start_pos
+
+        row_id     = id_prefix + self.seq_name + '_' + str(self.hit_num)
+        attributes = "ID=%s;Name=%s;length=%d" % ( row_id, row_id, diff_pos )
+
+        cols       = [ self.seq_name, source_name, source_type, start_pos, end_pos, score, orientation, phase, attributes ]
+
+        self.lines.append("\t".join( [ str(x) for x in cols ] ) + "\n")
+
+        self.hit_num += 1
+
+    def feed(self, seq):
+        size = len(seq)
+        if size == 0:
+            return
+
+        offset        = self.seq_len
+        self.seq_len += size
+
+        with profile_stage("scan", rows=size, unit="bp"):
+            self.scan(seq, offset, size)
+
+    def scan(self, seq, offset, size):
+        if self.run_start is None and 'N' not in seq and 'n' not in seq:
+            return
+
+        #N and n are the only bytes that become "n" with the 0x20 bit set
+        is_n  = ( np.frombuffer(seq, dtype=np.uint8) | 0x20 ) == ord('n')
+        edges = np.flatnonzero(np.diff(np.concatenate(( [False], is_n, [False] )).view(np.int8)))
+
+        if self.run_start is not None and not is_n[0]:
+            self.add_gap(self.run_start, offset)
+            self.run_start = None
+
+        for start, end in zip(edges[0::2].tolist(), edges[1::2].tolist()):
+            if start == 0 and self.run_start is not None:
+                start = self.run_start - offset
+
+            if end == size:
+                self.run_start = offset + start
+            else:
+                self.add_gap(offset + start, offset + end)
+                self.run_start = None
+
+    def finish(self):
+        if self.run_start is not None:
+            self.add_gap(self.run_start, self.seq_len)
+            self.run_start = None
+
+def write_seq(ofh, scanner):
+    if scanner.seq_len == 0:
         return
 
-    ofh.write("##sequence-region %s 0 %d\n" % (seq_name, len(seq_seq)))
-
-    print "saving chromosome", seq_name, "len", len(seq_seq)
-    hit_num = 1
-    for m in re_ns.finditer(seq_seq.lower()):
-        start_pos = m.start() + 1
-        end_pos   = m.end()
-        match_seq = m.group()
-        diff_pos  = end_pos - start_pos
-        match_len = len(match_seq)
-        #print seq_name, start_pos, end_pos, diff_pos, match_len, match_seq
-        
-        if match_len < min_size:
+    print "saving chromosome", scanner.seq_name, "len", scanner.seq_len
+
+    with profile_stage("write", rows=len(scanner.lines), unit="gaps"):
+        ofh.write("##sequence-region %s 0 %d\n" % (scanner.seq_name, scanner.seq_len))
+        ofh.write("".join(scanner.lines))
+
+def scan_lines(ofh, lines, min_size=1):
+    """
+    Writes the gaps of the FASTA lines in lines, holding at most
+    scan_buffer_size bytes of sequence at a time
+    """
+    scanner  = None
+    parts    = []
+    size     = 0
+    for line in lines:
+        line = line.strip()
+
+        if len(line) == 0:
             continue
-        
-        row_id     = id_prefix + seq_name + '_' + str(hit_num)
-        attributes = "ID=%s;Name=%s;length=%d" % ( row_id, row_id, diff_pos )
-        
-        cols       = [ seq_name, source_name, source_type, start_pos, end_pos, score, orientation, phase, attributes ]
-        #print cols
-        
-        ofh.write("\t".join( [ str(x) for x in cols ] ) + "\n")
-        
-        hit_num += 1
+
+        if line[0] == ">":
+            if scanner is not None:
+                scanner.feed("".join(parts))
+                scanner.finish()
+                write_seq(ofh, scanner)
+
+            scanner = GapScanner(line[1:], min_size=min_size)
+            parts   = []
+            size    = 0
+
+        elif scanner is not None:
+            parts.append(line)
+            size += len(line)
+            if size >= scan_buffer_size:
+                scanner.feed("".join(parts))
+                parts = []
+                size  = 0
+
+    if scanner is not None:
+        scanner.feed("".join(parts))
+        scanner.finish()
+        write_seq(ofh, scanner)
+
+def scan_indexed(job):
+    """
+    GapScanner of one sequence of an indexed FASTA, run in a worker process
+    """
+    infasta, seq_num, min_size = job
+    with FastaIndex.load(infasta, write=False) as index:
+        scanner = GapScanner(index.title(seq_num), min_size=min_size)
+        for chunk in index.chunks(seq_num, chunk_bases=scan_buffer_size):
+            scanner.feed(chunk)
+        scanner.finish()
+    return scanner
+
+def scan_parallel(ofh, infasta, index, jobs, min_size=1):
+    """
+    Scans the sequences of an indexed FASTA in a pool of jobs processes and
+    writes them in the order of the file
+    """
+    import multiprocessing
+
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for scanner in pool.imap(scan_indexed, [ ( infasta, seq_num, min_size ) for seq_num in xrange(len(index)) ]):
+            write_seq(ofh, scanner)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description="Gaps (runs of N) of a FASTA file as GFF3")
+    parser.add_argument( 'infasta' ,                                            help="FASTA file, optionally gzip, bgzip or bzip2 compressed" )
+    parser.add_argument( 'min_size', nargs='?', default=1, type=int,            help="Minimum gap size [default: 1]" )
+    parser.add_argument( '-m'      , '--mmap' , action='store_true',            help="Read an uncompressed FASTA through mmap" )
+    parser.add_argument( '-j'      , '--jobs' , default=1, type=int,            help="Scan the sequences of an uncompressed FASTA in this many processes, through its .fai index (built if missing) [default: 1]" )
+    add_profile_args(parser)
+
+    return parser.parse_args(args=args)
 
 def main(args):
-    infasta  = args[0]
-    min_size = 1
-    if len(args) > 1:
-        min_size = int(args[1])
-    
-    
+    infasta  = args.infasta
+    min_size = args.min_size
+
+
     outgff   = infasta + '.gff3'
-    
-    with open(infasta, 'r') as ifh:
-        with open(outgff, 'w') as ofh:
-            ofh.write("##gff-version 3\n")
-            ofh.write("#infile  : %s\n" % infasta)
-            ofh.write("#min_size: %d\n" % min_size)
-
-            seq_name = None
-            seq_seq  = ""
-            for line in ifh:
-                line = line.strip()
-            
-                if len(line) == 0:
-                    continue
-                
-                if line[0] == ">":
-                    if seq_name is not None:
-                        parse_seq(ofh, seq_name, seq_seq, min_size=min_size)
-
-                    seq_seq  = ""
-                    seq_name = line[1:]
-                
-                else:
-                    seq_seq += line
-            
-            if seq_name is not None:
-                parse_seq(ofh, seq_name, seq_seq, min_size=min_size)
-                pass
-        
-    
+    profile_output(outgff)
+
+    with open(outgff, 'w') as ofh:
+        ofh.write("##gff-version 3\n")
+        ofh.write("#infile  : %s\n" % infasta)
+        ofh.write("#min_size: %d\n" % min_size)
+
+        index = None
+        if args.jobs > 1 and detect_compression(infasta) is None:
+            try:
+                index = FastaIndex.load(infasta)
+            except FastaIndexError as e:
+                print e, "- scanning in a single process"
+
+        if index is not None:
+            #the sequences are scanned in the workers, only the whole is seen here
+            with profile_stage("scan", unit="bp") as stage:
+                scan_parallel(ofh, infasta, index, args.jobs, min_size=min_size)
+                stage.rows = sum(index.lengths())
+
+        elif args.mmap and detect_compression(infasta) is None and os.path.getsize(infasta) > 0:
+            with open(infasta, 'rb') as ifh:
+                mm = mmap.mmap(ifh.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    scan_lines(ofh, iter(mm.readline, ""), min_size=min_size)
+                finally:
+                    mm.close()
+
+        else:
+            with open_input(infasta) as ifh:
+                scan_lines(ofh, ifh, min_size=min_size)
+
+
 
 if __name__ == '__main__':
-    main(sys.argv[1:])
\ No newline at end of file
+    args = parse_args(sys.argv[1:])
+
+    with profile_run("fasta_gap_to_gff", args):
+        main(args)
@@ -0,0 +1,251 @@
+import numpy as np
+
+from om_index import IntervalIndex
+from om_input import open_input
+
+"""
+AGP coordinate maps and liftover.
+
+AgpMap.load reads an AGP file into one array per column, one entry per AGP
+line, and two interval indexes over them: one by object (chromosome) over the
+object_beg/object_end of the components and gaps, and one by component
+(scaffold, contig) over the component_beg/component_end of the components.
+A position is placed with a binary search over the sorted starts of its
+sequence, so lifting a batch of features costs a few searchsorted calls per
+sequence in the batch:
+
+    agp                                   = AgpMap.load("SL2.50ch_from_sc.agp")
+    seqs, begs, ends, strands, status     = agp.lift(["SL2.40sc04133"], [1000], [2000], to_object=True)
+    agp.target_names(to_object=True)[seqs[0]], begs[0], ends[0], strands[0], status_names[status[0]]
+
+    ('SL2.50ch01', 32985598, 32986598, -1, 'ok')
+
+Positions are 1 based and inclusive, as in AGP, GFF and XMAP files.
+Components of unknown orientation (?, 0, na) are taken as +.
+"""
+
+gap_types    = ('N', 'U')
+
+LIFT_OK      = 0
+LIFT_GAP     = 1
+LIFT_SPLIT   = 2
+LIFT_OUTSIDE = 3
+LIFT_UNKNOWN = 4
+
+status_names = [
+    'ok',
+    'gap',      #inside a gap of the object
+    'split',    #starts and ends in different components, or across a gap
+    'outside',  #beyond the part of the sequence covered by the AGP
+    'unknown',  #sequence not in the AGP
+]
+
+
+
+class AgpMap(object):
+    """
+    Components and gaps of an AGP file. Gaps have component id -1 and
+    strand 0, components strand 1 or -1.
+    """
+    def __init__(self, object_names, component_names, obj_ids, obj_begs, obj_ends, comp_ids, comp_begs, comp_ends, strands):
+        self.object_names    = object_names
+        self.component_names = component_names
+        self.object_codes    = dict([ (n, p) for p, n in enumerate(object_names   ) ])
+        self.component_codes = dict([ (n, p) for p, n in enumerate(component_names) ])
+
+        self.obj_ids         = obj_ids
+        self.obj_begs        = obj_begs
+        self.obj_ends        = obj_ends
+        self.comp_ids        = comp_ids
+        self.comp_begs       = comp_begs
+        self.comp_ends       = comp_ends
+        self.strands         = strands
+
+        self.parts           = np.flatnonzero(comp_ids >= 0)
+        self.by_object       = IntervalIndex.build(obj_ids, obj_begs, obj_ends)
+        self.by_component    = IntervalIndex.build(comp_ids[self.parts], comp_begs[self.parts], comp_ends[self.parts])
+
+    @classmethod
+    def load(cls, path):
+        object_names    = []
+        object_codes    = {}
+        component_names = []
+        component_codes = {}
+        cols            = [ [] for x in xrange(7) ]
+        obj_ids, obj_begs, obj_ends, comp_ids, comp_begs, comp_ends, strands = cols
+
+        with open_input(path) as fhd:
+            for line in fhd:
+                line = line.strip()
+
+                if len(line) == 0:
+                    continue
+
+                if line[0] == "#":
+                    continue
+
+                vals = line.split("\t")
+                if len(vals) < 8:
+                    raise ValueError("not an AGP line: %s" % line)
+
+                object_id = vals[0]
+                if object_id not in object_codes:
+                    object_codes[object_id] = len(object_names)
+                    object_names.append(object_id)
+
+                obj_ids .append(object_codes[object_id])
+                obj_begs.append(int(vals[1]))
+                obj_ends.append(int(vals[2]))
+
+                if vals[4] in gap_types:
+                    comp_ids .append(-1)
+                    comp_begs.append(0)
+                    comp_ends.append(0)
+                    strands  .append(0)
+                    continue
+
+                component_id = vals[5]
+                if component_id not in component_codes:
+                    component_codes[component_id] = len(component_names)
+                    component_names.append(component_id)
+
+                comp_ids .append(component_codes[component_id])
+                comp_begs.append(int(vals[6]))
+                comp_ends.append(int(vals[7]))
+                strands  .append(-1 if len(vals) > 8 and vals[8] == '-' else 1)
+
+        return cls(object_names, component_names,
+            np.array(obj_ids  , dtype=np.int32), np.array(obj_begs , dtype=np.int64), np.array(obj_ends , dtype=np.int64),
+            np.array(comp_ids , dtype=np.int32), np.array(comp_begs, dtype=np.int64), np.array(comp_ends, dtype=np.int64),
+            np.array(strands  , dtype=np.int8 ))
+
+    def __len__(self):
+        return len(self.obj_ids)
+
+    def source_codes(self, to_object=True):
+        return self.component_codes if to_object else self.object_codes
+
+    def target_names(self, to_object=True):
+        return self.object_names if to_object else self.component_names
+
+    def target_lengths(self, to_object=True):
+        """
+        Length of every target sequence: the end of the last line of an
+        object, or the largest component_end used of a component
+        """
+        if to_object:
+            ids, ends = self.obj_ids, self.obj_ends
+            lengths   = np.zeros(len(self.object_names), dtype=np.int64)
+        else:
+            ids, ends = self.comp_ids[self.parts], self.comp_ends[self.parts]
+            lengths   = np.zeros(len(self.component_names), dtype=np.int64)
+        np.maximum.at(lengths, ids, ends)
+        return lengths
+
+    def locate(self, index, code, positions):
+        """
+        AGP line holding each of positions on sequence code of index, -1 for
+        positions outside of every line
+        """
+        pos = index.index._pos(code)
+        if pos is None:
+            return np.full(len(positions), -1, dtype=np.int64)
+
+        start  = index.index.offsets[pos  ]
+        stop   = index.index.offsets[pos+1]
+        found  = np.searchsorted(index.starts[start:stop], positions, side='right') - 1
+        inside = found >= 0
+        found[inside] += start
+        inside[inside] = index.ends[found[inside]] >= positions[inside]
+
+        lines  = np.full(len(positions), -1, dtype=np.int64)
+        lines[inside] = index.index.rows[found[inside]]
+        return lines
+
+    def lift(self, seqs, begs, ends, to_object=True):
+        """
+        Lifts the features [begs, ends] of seqs, given as sequence names or
+        as codes in source_codes(to_object), to the objects (to_object) or
+        to the components.
+
+        Returns (seqs, begs, ends, strands, status): seqs are positions in
+        target_names(to_object), -1 where the feature was not lifted, strands
+        are -1 where the feature lands on a - component, and status holds a
+        LIFT_* code per feature.
+        """
+        begs        = np.asarray(begs)
+        ends        = np.asarray(ends)
+        num         = len(begs)
+        lows        = np.minimum(begs, ends)
+        highs       = np.maximum(begs, ends)
+
+        seqs        = np.asarray(seqs)
+        if seqs.dtype.kind in 'SUO':
+            codes   = self.source_codes(to_object)
+            seqs    = np.array([ codes.get(x, -1) for x in seqs.tolist() ], dtype=np.int64)
+
+        line_begs   = np.full(num, -1, dtype=np.int64)
+        line_ends   = np.full(num, -1, dtype=np.int64)
+        known       = np.zeros(num, dtype=np.bool_)
+
+        if to_object:
+            index   = self.by_component
+            #the component index holds positions in self.parts
+            lines   = self.parts
+        else:
+            index   = self.by_object
+            lines   = None
+
+        #one pair of binary searches per sequence in seqs
+        order       = np.argsort(seqs, kind='mergesort')
+        bounds      = np.flatnonzero(np.diff(seqs[order])) + 1
+        for rows in np.split(order, bounds):
+            if len(rows) == 0:
+                continue
+
+            code = seqs[rows[0]].item()
+            if code < 0 or code not in index:
+                continue
+
+            found_begs = self.locate(index, code, lows [rows])
+            found_ends = self.locate(index, code, highs[rows])
+            if lines is not None:
+                found_begs = np.where(found_begs >= 0, lines[found_begs], -1)
+                found_ends = np.where(found_ends >= 0, lines[found_ends], -1)
+
+            known    [rows] = True
+            line_begs[rows] = found_begs
+            line_ends[rows] = found_ends
+
+        same                = known & ( line_begs == line_ends ) & ( line_begs >= 0 )
+        status              = np.full(num, LIFT_UNKNOWN, dtype=np.int8)
+        status[known]       = LIFT_SPLIT
+        status[known & ( ( line_begs < 0 ) | ( line_ends < 0 ) )] = LIFT_OUTSIDE
+        status[same ]       = LIFT_OK
+        status[same & ( self.comp_ids[np.maximum(line_begs, 0)] < 0 )] = LIFT_GAP
+
+        ok                  = status == LIFT_OK
+        ok_lines            = line_begs[ok]
+        strands             = np.ones(num, dtype=np.int8)
+        strands[ok]         = self.strands[ok_lines]
+
+        if to_object:
+            src_begs, src_ends, dst_begs, dst_ids = self.comp_begs, self.comp_ends, self.obj_begs , self.obj_ids
+        else:
+            src_begs, src_ends, dst_begs, dst_ids = self.obj_begs , self.obj_ends , self.comp_begs, self.comp_ids
+
+        out_seqs            = np.full(num, -1, dtype=np.int64)
+        out_begs            = np.zeros(num, dtype=np.result_type(lows , np.int64))
+        out_ends            = np.zeros(num, dtype=np.result_type(highs, np.int64))
+
+        out_seqs[ok]        = dst_ids[ok_lines]
+
+        #on a - component the offsets from the start become offsets from the end
+        fwd                 = strands[ok] > 0
+        lo                  = lows [ok]
+        hi                  = highs[ok]
+        base                = dst_begs[ok_lines]
+        out_begs[ok]        = np.where(fwd, base + ( lo - src_begs[ok_lines] ), base + ( src_ends[ok_lines] - hi ))
+        out_ends[ok]        = np.where(fwd, base + ( hi - src_begs[ok_lines] ), base + ( src_ends[ok_lines] - lo ))
+
+        return out_seqs, out_begs, out_ends, strands, status
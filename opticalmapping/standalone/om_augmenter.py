@@ -11,18 +11,298 @@ def parse_args(args):
     parser.add_argument( 'infile',                                    help="MAP file"                                               )
     parser.add_argument( '-g'    , '--count'  , action='store_false', help="DO NOT perform global count"                            )
     parser.add_argument( '-c'    , '--conf'   , action='store_false', help="DO NOT perform confidence stats"                        )
+    parser.add_argument( '-C'    , '--cache'  , action='store_true' , help="Keep a binary parse cache next to the input file and reuse it" )
+    parser.add_argument( '-j'    , '--jobs'   , default=1, type=int , help="Number of processes to augment with [default: 1]"       )
+    parser.add_argument( '-Z'    , '--compress', choices=['gzip', 'bgzip'], help="Write the output gzip or bgzip compressed"            )
+    parser.add_argument( '-p'    , '--previous', action='store'     , help="Previous .augmented.tsv of this MAP. Only the queries whose rows changed are augmented again, the rest is copied from it" )
+    add_profile_args(parser)
     
     args    = parser.parse_args(args=args)
 
     return args
 
+def augmented_header(headers, valid_fields):
+    text  = "\n".join(headers[:-2]) + "\n#\n"
+    text += "# FIELDS:\n"
+    text +=         "\n".join( [ "# %-39s: %s" % ( x, valid_fields['helps_t'][x] ) for x in valid_fields['names'  ] ] ) + "\n#\n"
+    
+    text += "#h " + "\t".join( [ "%-39s"       % ( x                             ) for x in valid_fields['names'  ] ] ) + "\n"
+    text += "#f " + "\t".join( [ "%-39s"       % (    valid_fields['types'  ][x] ) for x in valid_fields['names'  ] ] ) + "\n"
+    return text
+
+def augment(data, mask=None):
+    """
+    Returns (rows, report): the rows in mask in output order and a table
+    with their values and every _meta_ field
+    """
+    with profile_stage("stats", rows=len(data)):
+        rows, stats                                  = query_stats(data, mask)
+
+    report                                           = data.take(rows)
+
+    cigar_matches, cigar_insertions, cigar_deletions = process_cigars(report.column("HitEnum"))
+    alignment_pairs, alignment_offsets               = decode_alignments(report.column("Alignment"))
+    alignment_count_queries, alignment_count_refs, alignment_count_refs_colapses, alignment_count_queries_colapses = process_alignments(alignment_pairs, alignment_offsets)
+
+    for stat in stats:
+        report.set_column(stat, stats[stat])
+
+    report.set_column("_meta_alignment_count_queries"              , alignment_count_queries         )
+    report.set_column("_meta_alignment_count_queries_colapses"     , alignment_count_refs_colapses   )
+    report.set_column("_meta_alignment_count_refs"                 , alignment_count_refs            )
+    report.set_column("_meta_alignment_count_refs_colapses"        , alignment_count_queries_colapses)
+
+    report.set_column("_meta_cigar_deletions"                      , cigar_deletions )
+    report.set_column("_meta_cigar_insertions"                     , cigar_insertions)
+    report.set_column("_meta_cigar_matches"                        , cigar_matches   )
+
+    report.set_column("_meta_proportion_query_len_gapped"          , (report.column('_meta_len_qry_match_gapped') * 1.0)/ report.column("QryLen"))
+    report.set_column("_meta_proportion_query_len_no_gap"          , (report.column('_meta_len_qry_match_no_gap') * 1.0)/ report.column("QryLen"))
+
+    return rows, report
+
+
+
+#splitmix64 finalizer constants, plain ints so that importing the module
+#does not load numpy
+hash_shifts     = [ 30, 27, 31 ]
+hash_mults      = [ 0xbf58476d1ce4e5b9, 0x94d049bb133111eb ]
+hash_golden     = 0x9e3779b97f4a7c15
+
+def mix_hashes(vals):
+    shifts = [ np.uint64(x) for x in hash_shifts ]
+    mults  = [ np.uint64(x) for x in hash_mults  ]
+    vals   = vals ^ ( vals >> shifts[0] )
+    vals   = vals * mults[0]
+    vals   = vals ^ ( vals >> shifts[1] )
+    vals   = vals * mults[1]
+    return vals ^ ( vals >> shifts[2] )
+
+def string_hashes(column):
+    """
+    uint64 hash of every string of a StringColumn, sliced from one copy of
+    its buffer instead of one numpy slice per row as tolist does
+    """
+    import itertools
+
+    text    = column.buffer.tostring()
+    offsets = column.offsets.tolist()
+    hashes  = np.fromiter((hash(text[start:end]) for start, end in itertools.izip(offsets[:-1], offsets[1:])), dtype=np.int64, count=len(column))
+    return hashes.view(np.uint64)
+
+def value_hashes(column, rows):
+    """
+    uint64 hash of the value of every row in rows
+    """
+    from om_table import StringColumn, CategoryColumn
+
+    if isinstance(column, StringColumn):
+        return string_hashes(column)[rows]
+
+    if isinstance(column, CategoryColumn):
+        labels = np.array([ hash(x) for x in column.categories ], dtype=np.int64).view(np.uint64)
+        return labels[column.codes[rows]]
+
+    vals = column[rows]
+    if vals.dtype.kind == 'f':
+        return np.ascontiguousarray(vals, dtype=np.float64).view(np.uint64)
+    return vals.astype(np.int64).view(np.uint64)
+
+def query_hashes(table, names):
+    """
+    Returns (queries, hashes, starts, rows): every QryContigID of table, a
+    hash of the names columns of its rows, and the row ids ordered by
+    QryContigID, RefContigID and position, the rows of query i starting at
+    starts[i]. XmapEntryID is only hashed as its order within the query, which
+    decides the confidence ties, so that renumbered entries still match.
+    """
+    qry_ids       = table.column("QryContigID")
+    rows          = np.lexsort((table.column("RefContigID"), qry_ids))
+    starts, qry_of_row = runs_of(qry_ids[rows])
+
+    hashes        = np.zeros(len(rows), dtype=np.uint64)
+    for name in names:
+        hashes    = mix_hashes( hashes ^ value_hashes(table.column(name), rows) )
+
+    entry_ids     = table.column("XmapEntryID")[rows]
+    by_entry      = np.lexsort((entry_ids, qry_of_row))
+    new_entry     = np.ones(len(rows), dtype=np.int64)
+    new_entry[1:] = ( entry_ids[by_entry][1:] != entry_ids[by_entry][:-1] ) | ( qry_of_row[by_entry][1:] != qry_of_row[by_entry][:-1] )
+    entry_rank    = np.cumsum(new_entry)
+    entry_rank    = entry_rank - entry_rank[ starts[qry_of_row[by_entry]] ]
+    ranks         = np.empty(len(rows), dtype=np.int64)
+    ranks[by_entry] = entry_rank
+    hashes        = mix_hashes( hashes ^ ranks.view(np.uint64) )
+
+    #order sensitive sum over the rows of every query
+    position      = np.arange(len(rows), dtype=np.int64) - starts[qry_of_row]
+    hashes        = mix_hashes( hashes ^ ( position.view(np.uint64) * np.uint64(hash_golden) ) )
+
+    if len(rows) > 0:
+        sums      = np.add.reduceat(hashes, starts)
+    else:
+        sums      = hashes
+
+    return qry_ids[rows][starts], sums, starts, rows
+
+def augment_changed(data, previous):
+    """
+    augment of data, reusing the rows of previous, a former augmented output,
+    for every query whose rows did not change since. Only the changed and new
+    queries are augmented again. Every statistic only depends on the rows of
+    its own query, as in augment_parallel.
+    """
+    from om_table import XmapTable
+
+    names         = [ x for x in data.names if x != "XmapEntryID" and not x.startswith("_meta_") ]
+
+    with profile_stage("diff", rows=len(data) + len(previous)):
+        new_qrys, new_hashes, new_starts, new_rows = query_hashes(data    , names)
+        old_qrys, old_hashes, old_starts, old_rows = query_hashes(previous, names)
+
+        new_counts    = np.diff(np.append(new_starts, len(new_rows)))
+        old_counts    = np.diff(np.append(old_starts, len(old_rows)))
+
+        if len(old_qrys) > 0:
+            old_pos   = np.minimum(np.searchsorted(old_qrys, new_qrys), len(old_qrys) - 1)
+            same      = ( old_qrys[old_pos] == new_qrys ) & ( old_hashes[old_pos] == new_hashes ) & ( old_counts[old_pos] == new_counts )
+        else:
+            old_pos   = np.zeros(len(new_qrys), dtype=np.int64)
+            same      = np.zeros(len(new_qrys), dtype=np.bool_)
+
+        #rows of the unchanged queries pair up in the order they were hashed in
+        qry_of_row    = np.repeat(np.arange(len(new_qrys)), new_counts)
+        kept          = same[qry_of_row]
+        position      = np.arange(len(new_rows), dtype=np.int64) - new_starts[qry_of_row]
+        kept_new      = new_rows[kept]
+        kept_old      = old_rows[ old_starts[old_pos[qry_of_row[kept]]] + position[kept] ]
+
+    print "reusing %d of %d queries, augmenting %d" % (same.sum(), len(new_qrys), len(new_qrys) - same.sum())
+
+    mask           = np.ones(len(data), dtype=np.bool_)
+    mask[kept_new] = False
+    rows, report   = augment(data, mask)
+
+    #the reused rows are taken straight from previous, in the serial order
+    rows           = np.append(rows, kept_new)
+    sources        = np.append(np.arange(len(report), dtype=np.int64), len(report) + kept_old)
+    order          = np.lexsort((rows, data.column("QryContigID")[rows], data.column("RefContigID")[rows]))
+    rows           = rows[order]
+    report         = XmapTable.concat([ report, previous ]).take(sources[order])
+    report.set_column("XmapEntryID", data.column("XmapEntryID")[rows])
+
+    return rows, report
+
+
+
+#set in the parent right before the workers are forked, so that they share
+#the parsed columns with it instead of receiving a pickled copy
+augment_jobs_data = None
+
+def augment_partition(part):
+    data, index, bounds, names, tmp_dir = augment_jobs_data
+    from om_table import StringColumn
+    from om_cache import write_arrays
+    from om_io    import get_format_plan
+
+    mask       = np.zeros(len(data), dtype=np.bool_)
+    mask[ index.rows[ index.offsets[bounds[part]]:index.offsets[bounds[part+1]] ] ] = True
+
+    rows, report = augment(data, mask)
+    lines      = StringColumn.from_list( get_format_plan(names).lines(report, np.arange(len(report), dtype=np.int64)) )
+
+    part_file  = os.path.join(tmp_dir, "part_%05d" % part)
+    write_arrays(part_file, {}, { 'rows': rows, 'buffer': lines.buffer, 'offsets': lines.offsets })
+    return part_file
+
+def augment_parallel(reporter, data, indexer, names, jobs, tmp_parent):
+    """
+    Augments groups of whole queries in a pool of jobs processes. Every
+    statistic only depends on the rows of its own query, so the partitions
+    are independent. The lines written by the workers are put back in the
+    serial output order before being written to reporter.
+    """
+    global augment_jobs_data
+    import shutil
+    import tempfile
+    import multiprocessing
+    from om_cache import read_arrays
+
+    index      = indexer["QryContigID"]
+    num_parts  = min(len(index), jobs * 4)
+    bounds     = np.searchsorted(index.offsets, np.linspace(0, len(data), num_parts + 1))
+    bounds     = np.unique(np.clip(bounds, 0, len(index)))
+    bounds[0]  = 0
+    bounds[-1] = len(index)
+    tmp_dir    = tempfile.mkdtemp(prefix=".om_augmenter_", dir=tmp_parent)
+
+    try:
+        augment_jobs_data = ( data, index, bounds.tolist(), names, tmp_dir )
+        pool       = multiprocessing.Pool(jobs)
+        try:
+            part_files = pool.map(augment_partition, range(len(bounds) - 1), chunksize=1)
+        finally:
+            pool.terminate()
+            augment_jobs_data = None
+
+        #partitions are consecutive ranges of QryContigID, so the serial order
+        #is every partition's block of RefContigID 1, then of RefContigID 2...
+        ref_ids    = data.column("RefContigID")
+        blocks     = []
+        buffers    = []
+        for part, part_file in enumerate(part_files):
+            info, arrays = read_arrays(part_file)
+            buffers.append( arrays['buffer'] )
+            part_refs    = ref_ids[ arrays['rows'] ]
+            starts, _    = runs_of(part_refs)
+            ends         = np.append(starts[1:], len(part_refs))
+            for ref, start, end in zip(part_refs[starts].tolist(), arrays['offsets'][starts].tolist(), arrays['offsets'][ends].tolist()):
+                blocks.append( [ ref, part, start, end ] )
+
+        for ref, part, start, end in sorted(blocks):
+            reporter.write( buffers[part][start:end].tostring() )
+
+    finally:
+        shutil.rmtree(tmp_dir)
+
+def print_confidence_stats(data, groups):
+    """
+    Confidences of every query in XmapEntryID order, read from the group
+    arrays rather than with one index lookup per XmapEntryID
+    """
+    by_entry       = groups["XmapEntryID_Confidence"]
+    by_qry_ref     = groups["QryContigID_RefContigID"]
+    by_qry_entry   = groups["QryContigID_XmapEntryID"]
+
+    #lowest confidence of each XmapEntryID and the chromosome of its first row
+    entry_pairs    = by_entry.outer.offsets[:-1]
+    entry_conf     = by_entry.inner.keys_arr[entry_pairs]
+    entry_chrom    = data.column("RefContigID")[ by_entry.inner.rows[ by_entry.inner.offsets[entry_pairs] ] ]
+
+    qry_entries    = np.searchsorted(by_entry.outer.keys_arr, by_qry_entry.inner.keys_arr)
+    qry_conf       = entry_conf [qry_entries].tolist()
+    qry_chrom      = entry_chrom[qry_entries].tolist()
+    qry_offsets    = by_qry_entry.outer.offsets.tolist()
+
+    for qry_pos, (QryContigID, num_chroms) in enumerate(zip(by_qry_ref.keys(), by_qry_ref.outer.counts().tolist())):
+        print "query %5d maps to %2d chromosomes" % (QryContigID, num_chroms)
+        Confidences    = qry_conf[ qry_offsets[qry_pos]:qry_offsets[qry_pos+1] ]
+        
+        print " confidences         ", Confidences
+        max_confidence = max(Confidences)
+        
+        print " max confidence      ", max_confidence
+        print " max confidence chrom", qry_chrom[ qry_offsets[qry_pos] + Confidences.index(max_confidence) ]
+
 def main(args):
+    from om_io import open_output, output_name
+
     valid_fields        = gen_valid_fields(valid_fields_g)
 
     infile              = args.infile
     DO_GLOBAL_COUNT     = args.count
     DO_CONFIDENCE_STATS = args.conf
-    oufile              = infile + ".augmented.tsv"
+    oufile              = output_name(infile + ".augmented.tsv", args.compress)
 
     if not os.path.exists(infile):
         print "input file %s does not exists" % infile
@@ -34,9 +314,14 @@ def main(args):
     
     
     
+    if args.previous is not None and not os.path.isfile(args.previous):
+        print "previous output %s does not exists" % args.previous
+        sys.exit(1)
+
     print "saving to %s" % oufile
+    profile_output(oufile)
 
-    data, headers, names, seman, types, indexer, groups, ref_maps_from, query_maps_from, filters_csv = parse_file(infile, valid_fields)
+    data, headers, names, seman, types, indexer, groups, ref_maps_from, query_maps_from, filters_csv = parse_file(infile, valid_fields, cache=args.cache)
 
     print "NAMES"  , names
     print "TYPES"  , types
@@ -57,66 +342,37 @@ def main(args):
     
     if DO_CONFIDENCE_STATS:
         print "PRINTING CONFIDENCE STATS"
-        for QryContigID in sorted(groups["QryContigID_RefContigID"]):
-            print "query %5d maps to %2d chromosomes" % (QryContigID, len(groups["QryContigID_RefContigID"][QryContigID]))
-            XmapEntryIDs   = groups["QryContigID_XmapEntryID"][QryContigID].keys()
-            Confidences    = [groups["XmapEntryID_Confidence"][x].keys()[0] for x in XmapEntryIDs]
-            
-            print " confidences         ", Confidences
-            max_confidence = max(Confidences)
-            
-            print " max confidence      ", max_confidence
-            print " max confidence chrom", data[list(groups["XmapEntryID_Confidence"][XmapEntryIDs[Confidences.index(max_confidence)]][max_confidence])[0]][seman["RefContigID"]]
+        print_confidence_stats(data, groups)
         print
     
 
+    previous            = None
+    if args.previous is not None:
+        print "LOADING PREVIOUS", args.previous
+        previous        = parse_file(args.previous, valid_fields, cache=args.cache)[0]
+
+        if previous.names != valid_fields['names']:
+            print "previous output %s is not an augmented file, augment from scratch" % args.previous
+            sys.exit(1)
+
     
     print "CREATING REPORT:", oufile 
-    data      = [ KeyedTuple(x, labels=names)._asdict() for x in data ]
-    
-    with open(oufile, "w") as reporter:
-        reporter.write("\n".join(headers[:-2]) + "\n#\n")
-        reporter.write("# FIELDS:\n")
-        reporter.write(        "\n".join( [ "# %-39s: %s" % ( x, valid_fields['helps_t'][x] ) for x in valid_fields['names'  ] ] ) + "\n#\n")
-        
-        reporter.write("#h " + "\t".join( [ "%-39s"       % ( x                             ) for x in valid_fields['names'  ] ] ) + "\n"  )
-        reporter.write("#f " + "\t".join( [ "%-39s"       % (    valid_fields['types'  ][x] ) for x in valid_fields['names'  ] ] ) + "\n"  )
+    with open_output(oufile, args.compress) as reporter:
+        reporter.write( augmented_header(headers, valid_fields) )
 
-        for RefContigID in sorted(groups["RefContigID_QryContigID"]):
-            QryContigIDs = groups["RefContigID_QryContigID"][RefContigID]
-            
-            for QryContigID in sorted(QryContigIDs):
-                data_poses           = list(groups["RefContigID_QryContigID"][RefContigID][QryContigID])
-                all_data_poses       = list(indexer["QryContigID"][QryContigID])
-                data_vals            = [ data[x] for x in data_poses ]
-    
-                stats                = stats_from_data_vals(RefContigID, QryContigID, groups, indexer, data, data_vals, all_data_poses)
-    
-                #print "RefContigID %4d QryContigID %6d" % ( RefContigID, QryContigID )
-                for data_val in data_vals:
-                    cigar                = data_val["HitEnum"]
-                    cigar_matches, cigar_insertions, cigar_deletions = process_cigar(cigar)
-                    
-                    Alignment            = data_val["Alignment"]
-                    alignment_count_queries, alignment_count_refs, alignment_count_refs_colapses, alignment_count_queries_colapses = process_alignment(Alignment)
-                    
-                    for stat in stats:
-                        data_val[stat] = stats[stat]
-    
-                    data_val["_meta_alignment_count_queries"              ] = alignment_count_queries
-                    data_val["_meta_alignment_count_queries_colapses"     ] = alignment_count_refs_colapses
-                    data_val["_meta_alignment_count_refs"                 ] = alignment_count_refs
-                    data_val["_meta_alignment_count_refs_colapses"        ] = alignment_count_queries_colapses
-                
-                    data_val["_meta_cigar_deletions"                      ] = cigar_deletions
-                    data_val["_meta_cigar_insertions"                     ] = cigar_insertions
-                    data_val["_meta_cigar_matches"                        ] = cigar_matches
-
-                    data_val["_meta_proportion_query_len_gapped"          ] = (data_val['_meta_len_qry_match_gapped'] * 1.0)/ data_val["QryLen"]
-                    data_val["_meta_proportion_query_len_no_gap"          ] = (data_val['_meta_len_qry_match_no_gap'] * 1.0)/ data_val["QryLen"] 
-    
-                    #print " ", " ".join( ["%s %s" % (x, str(data_val[x])) for x in sorted(data_val)] )
-                    reporter.write(            "\t".join( [ str(data_val[x])                                   for x in valid_fields['names'  ] ] ) + "\n"  )
+        if previous is not None:
+            with profile_stage("augment", rows=len(data)):
+                rows, report = augment_changed(data, previous)
+            write_rows(reporter, report, valid_fields['names'])
+
+        elif args.jobs > 1:
+            with profile_stage("augment", rows=len(data)):
+                augment_parallel(reporter, data, indexer, valid_fields['names'], args.jobs, os.path.dirname(os.path.abspath(oufile)))
+
+        else:
+            with profile_stage("augment", rows=len(data)):
+                rows, report = augment(data)
+            write_rows(reporter, report, valid_fields['names'])
 
 
 
@@ -127,7 +383,8 @@ if __name__ == '__main__':
 
     args         = parse_args(sys.argv[1:])
 
-    main(args)
+    with profile_run("om_augmenter", args):
+        main(args)
     
 """    
 # $ cd D:\Plextor\data\Acquisitie\BioNanoGenomics\MyLycopersicumWorkspace_31022015\Imports; C:\Program Files\BioNano Genomics\RefAligner\WindowsRefAligner.exe -f -ref D:\Plextor\data\Acquisitie\BioNanoGenomics\MyLycopersicumWorkspace_31022015\Imports\S_lycopersicum_chromosomes.2.50.BspQI-BbvCI.cmap -i D:\Plextor\data\Acquisitie\BioNanoGenomics\MyLycopersicumWorkspace_31022015\Imports\EXP_REFINEFINAL1.cmap -o S_lycopersicum_chromosomes.2.50.BspQI-BbvCI_to_EXP_REFINEFINAL1 -endoutlier 1e-2 -outlier 1e-4 -extend 1 -FN 0.08 -FP 0.8 -sf 0.2 -sd 0 -sr 0.02 -res 2.9 -resSD 0.7 -mres 2.0 -A 5 -biaswt 0 -M 1 -Mfast 0 -maxmem 2 -T 1e-6 -stdout -stderr
@@ -0,0 +1,309 @@
+#!/usr/bin/python
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+
+"""
+Throughput and memory benchmark of the standalone tools on synthetic data.
+
+The inputs are made by om_synth with a fixed seed, at the scale given by
+--rows (1k to 10M XMAP rows) and --genome-size (1 Mbp to 3 Gbp). Every tool
+is run --repeats times in a process of its own; the best wall time and the
+peak resident memory of the process count.
+
+--save writes the results to a baseline file, a later run with --baseline
+compares against it and exits with 1 when a tool got slower or bigger than
+the tolerance allows:
+
+    om_bench.py -r 1000000 -g 900000000 -d /data/bench --save
+    om_bench.py -r 1000000 -g 900000000 -d /data/bench --baseline om_bench.json
+
+With -d the inputs are kept and reused by the next run of the same scale and
+seed. Baselines only compare runs of the same scale, seed and interpreter.
+"""
+
+bench_filters    = [ "Confidence:ge:20", "_meta_num_qry_matches:le:3" ]
+
+parse_file_code  = "import sys; sys.path.insert(0, sys.argv[1]); from om_shared import *; parse_file(sys.argv[2], gen_valid_fields(valid_fields_g))"
+
+#name, arguments. {src}, {xmap}, {augmented}, {report}, {names}, {agp} and
+#{fasta} are replaced by the tools folder and the synthetic inputs. the
+#order matters, a tool reads the output of the one before
+bench_runs       = [
+    [ "parse_file"      , [ "-c", parse_file_code     , "{src}", "{xmap}"    ] ],
+    [ "om_augmenter"    , [ "om_augmenter.py"         , "{xmap}"             ] ],
+    [ "om_filter"       , [ "om_filter.py"            , "{augmented}"        ] + sum([ [ "-f", x ] for x in bench_filters ], []) ],
+    [ "om_to_gff"       , [ "om_to_gff.py"            , "{report}", "-n", "{names}" ] ],
+    [ "om_to_delta"     , [ "om_to_delta.py"          , "{report}"           ] ],
+    [ "agp_to_gff"      , [ "agp_to_gff.py"           , "{agp}"              ] ],
+    [ "fasta_gap_to_gff", [ "fasta_gap_to_gff.py"     , "{fasta}"            ] ],
+]
+
+#benchmarks whose outputs a benchmark reads
+bench_needs      = {
+    "om_filter"  : [ "om_augmenter" ],
+    "om_to_gff"  : [ "om_augmenter", "om_filter" ],
+    "om_to_delta": [ "om_augmenter", "om_filter" ],
+}
+
+bench_version    = 1
+
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description="Throughput and memory benchmark of the standalone tools on synthetic data")
+    parser.add_argument( '-r'    , '--rows'          , default=100000   , type=int  , help="XMAP rows [default: 100000]" )
+    parser.add_argument( '-g'    , '--genome-size'   , default=100000000, type=int  , help="Genome size in bp, for the AGP and FASTA [default: 100000000]" )
+    parser.add_argument( '-c'    , '--chromosomes'   , default=12       , type=int  , help="Number of chromosomes [default: 12]" )
+    parser.add_argument( '-S'    , '--seed'          , default=1        , type=int  , help="Random seed of the inputs [default: 1]" )
+    parser.add_argument( '-n'    , '--repeats'       , default=3        , type=int  , help="Runs per tool, the best one counts [default: 3]" )
+    parser.add_argument( '-b'    , '--bench'         , action='append'  , choices=[ x[0] for x in bench_runs ], help="Run only these benchmarks" )
+    parser.add_argument( '-d'    , '--data-dir'      , action='store'   ,             help="Keep the inputs in this folder and reuse them [default: a temporary folder]" )
+    parser.add_argument( '-B'    , '--baseline'      , action='store'   ,             help="Baseline file to compare with" )
+    parser.add_argument( '-s'    , '--save'          , nargs='?'        , const='om_bench.json', help="Save the results as baseline [default file: om_bench.json]" )
+    parser.add_argument( '-t'    , '--tolerance'     , default=0.10     , type=float, help="Allowed slow down over the baseline, as a fraction [default: 0.10]" )
+    parser.add_argument( '-m'    , '--mem-tolerance' , default=0.05     , type=float, help="Allowed memory growth over the baseline, as a fraction [default: 0.05]" )
+    parser.add_argument( '-p'    , '--python'        , default=sys.executable,    help="Interpreter to run the tools with" )
+
+    args    = parser.parse_args(args=args)
+
+    return args
+
+def bench_params(args):
+    return {
+        'rows'       : args.rows,
+        'genome_size': args.genome_size,
+        'chromosomes': args.chromosomes,
+        'seed'       : args.seed,
+    }
+
+def make_inputs(args, src_dir, data_dir, params):
+    """
+    Synthetic inputs of params in data_dir, made once and reused while
+    params do not change
+    """
+    prefix      = os.path.join(data_dir, "bench")
+    params_file = prefix + ".params.json"
+    paths_file  = prefix + ".paths.json"
+
+    if os.path.exists(params_file) and os.path.exists(paths_file):
+        with open(params_file, 'r') as fhd:
+            made = json.load(fhd)
+        if made == params:
+            print "REUSING INPUTS IN", data_dir
+            with open(paths_file, 'r') as fhd:
+                return json.load(fhd)
+
+    print "GENERATING INPUTS IN", data_dir
+    #in a process of its own: the peak memory of the generator would be
+    #inherited by the tools forked after it
+    start = time.time()
+    cmd   = [ args.python, os.path.join(src_dir, "om_synth.py"), prefix, "--paths", paths_file ]
+    for key in sorted(params):
+        cmd += [ "--" + key.replace("_", "-"), str(params[key]) ]
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call(cmd, stdout=devnull)
+    print "generated in %.1f s" % ( time.time() - start )
+
+    with open(params_file, 'w') as fhd:
+        json.dump(params, fhd, indent=1, sort_keys=True)
+
+    with open(paths_file, 'r') as fhd:
+        return json.load(fhd)
+
+def run_measured(cmd, cwd):
+    """
+    Wall time in seconds and peak resident memory in kb of cmd
+    """
+    with open(os.devnull, 'w') as devnull:
+        start  = time.time()
+        proc   = subprocess.Popen(cmd, stdout=devnull, stderr=devnull, cwd=cwd)
+        #the usage of this child only, RUSAGE_CHILDREN keeps the max of all
+        pid, status, usage = os.wait4(proc.pid, 0)
+        took   = time.time() - start
+        proc.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+
+    if proc.returncode != 0:
+        print "command failed (%d): %s" % (proc.returncode, " ".join(cmd))
+        sys.exit(1)
+
+    rss = usage.ru_maxrss
+    if sys.platform == 'darwin':
+        rss //= 1024
+    return took, rss
+
+def best_run(cmd, repeats, cwd):
+    best_took = None
+    best_rss  = None
+    for rep in xrange(repeats):
+        took, rss = run_measured(cmd, cwd)
+        if best_took is None or took < best_took:
+            best_took = took
+        if best_rss  is None or rss  < best_rss:
+            best_rss  = rss
+    return best_took, best_rss
+
+def input_names(paths):
+    from om_shared import gen_filter, gen_valid_fields, valid_fields_g, filter_name
+
+    augmented = paths['xmap'] + ".augmented.tsv"
+    report    = augmented
+    for filter_data in gen_filter(bench_filters, gen_valid_fields(valid_fields_g)):
+        report += filter_name(filter_data)
+    report   += ".report.tsv"
+
+    return {
+        'xmap'     : paths['xmap'],
+        'augmented': augmented,
+        'report'   : report,
+        'names'    : ",".join(paths['names']),
+        'agp'      : paths['agp'],
+        'fasta'    : paths['fasta'],
+    }
+
+def run_benchmarks(args, src_dir, paths, cwd):
+    names   = input_names(paths)
+    names['src'] = src_dir
+    size    = dict([ (n, os.path.getsize(paths[n])) for n in ('xmap', 'agp', 'fasta') ])
+    results = {}
+    wanted  = [ x[0] for x in bench_runs ] if args.bench is None else args.bench
+    needs   = set(sum([ bench_needs.get(x, []) for x in wanted ], []))
+
+    for name, cmd in bench_runs:
+        needed = name in wanted
+        if not needed and name not in needs:
+            continue
+
+        cmd    = [ x.format(**names) for x in cmd ]
+        if cmd[0] != "-c":
+            cmd[0] = os.path.join(src_dir, cmd[0])
+        cmd    = [ args.python ] + cmd
+
+        if not needed:
+            run_measured(cmd, cwd)
+            continue
+
+        took, rss      = best_run(cmd, args.repeats, cwd)
+        results[name]  = { 'seconds': round(took, 3), 'rss_kb': rss }
+
+        if   name in ( "agp_to_gff", ):
+            rate = "%10.1f kb/s" % ( size['agp'] / 1024.0 / took )
+        elif name in ( "fasta_gap_to_gff", ):
+            rate = "%10.1f Mbp/s" % ( args.genome_size / 1e6 / took )
+        else:
+            rate = "%10.0f rows/s" % ( args.rows / took )
+        print "%-18s %9.2f s %9.1f MB  %s" % ( name, took, rss / 1024.0, rate )
+
+    return results
+
+def host_info(args):
+    version = subprocess.check_output([ args.python, "-c", "import sys, numpy; print sys.version.split()[0], numpy.__version__" ]).split()
+    return {
+        'python'  : version[0],
+        'numpy'   : version[1],
+        'machine' : platform.machine(),
+        'node'    : platform.node(),
+    }
+
+def compare(baseline, run, args):
+    """
+    Names of the benchmarks over the tolerance of the baseline, None if the
+    baseline is not comparable
+    """
+    if baseline.get('version') != bench_version or baseline['params'] != run['params']:
+        print "baseline %s is of other inputs: %s" % ( args.baseline, json.dumps(baseline.get('params'), sort_keys=True) )
+        return None
+
+    if baseline['host']['python'] != run['host']['python']:
+        print "baseline %s was run with python %s, this is %s" % ( args.baseline, baseline['host']['python'], run['host']['python'] )
+        return None
+
+    print
+    print "%-18s %9s %9s %8s  %9s %9s %8s" % ( "COMPARED TO", "base s", "s", "", "base MB", "MB", "" )
+    regressions = []
+    for name, result in sorted(run['results'].items()):
+        base = baseline['results'].get(name)
+        if base is None:
+            print "%-18s not in baseline" % name
+            continue
+
+        time_change = result['seconds'] / base['seconds'] - 1.0 if base['seconds'] > 0 else 0.0
+        mem_change  = float(result['rss_kb']) / base['rss_kb'] - 1.0 if base['rss_kb'] > 0 else 0.0
+        status      = "ok"
+        if time_change > args.tolerance or mem_change > args.mem_tolerance:
+            status  = "REGRESSION"
+            regressions.append(name)
+
+        print "%-18s %9.2f %9.2f %+7.1f%%  %9.1f %9.1f %+7.1f%%  %s" % ( name, base['seconds'], result['seconds'], time_change * 100.0, base['rss_kb'] / 1024.0, result['rss_kb'] / 1024.0, mem_change * 100.0, status )
+
+    return regressions
+
+def main(args):
+    src_dir   = os.path.dirname(os.path.abspath(__file__))
+    params    = bench_params(args)
+
+    baseline  = None
+    if args.baseline is not None:
+        if not os.path.exists(args.baseline):
+            print "baseline file %s does not exists" % args.baseline
+            sys.exit(1)
+        with open(args.baseline, 'r') as fhd:
+            baseline = json.load(fhd)
+
+    sys.path.insert(0, src_dir)
+
+    if args.data_dir is not None:
+        data_dir = os.path.abspath(args.data_dir)
+        if not os.path.isdir(data_dir):
+            os.makedirs(data_dir)
+    else:
+        data_dir = tempfile.mkdtemp(prefix="om_bench_")
+
+    try:
+        paths   = make_inputs(args, src_dir, data_dir, params)
+        print "%-18s %11s %12s" % ( "BENCHMARK", "best", "peak rss" )
+        results = run_benchmarks(args, src_dir, paths, data_dir)
+
+    finally:
+        if args.data_dir is None:
+            shutil.rmtree(data_dir)
+
+    run = {
+        'version': bench_version,
+        'params' : params,
+        'host'   : host_info(args),
+        'repeats': args.repeats,
+        'results': results,
+    }
+
+    if args.save is not None:
+        if baseline is not None and os.path.abspath(args.save) == os.path.abspath(args.baseline):
+            baseline['results'].update(results)
+            results = baseline['results']
+        print "SAVING BASELINE TO", args.save
+        with open(args.save, 'w') as fhd:
+            json.dump(dict(run, results=results), fhd, indent=1, sort_keys=True)
+
+    if baseline is not None:
+        regressions = compare(baseline, run, args)
+
+        if regressions is None:
+            sys.exit(1)
+
+        if len(regressions) > 0:
+            print "regressions:", ", ".join(regressions)
+            sys.exit(1)
+
+
+
+if __name__ == '__main__':
+    args         = parse_args(sys.argv[1:])
+
+    main(args)
@@ -0,0 +1,217 @@
+import os
+import json
+import struct
+import hashlib
+
+import numpy as np
+
+from om_table import XmapTable, StringColumn, CategoryColumn
+from om_index import CsrIndex, CsrGroup, IntervalIndex
+
+"""
+Binary sidecar files made of a small JSON header followed by raw, 64 byte
+aligned numpy arrays. The arrays are read back as views over one read only
+memory map, so loading a cache costs a stat and an mmap regardless of the
+table size.
+
+    magic          8 bytes   "OMCACHE\\x01"
+    header length  8 bytes   little endian unsigned
+    header         JSON      {"info": {...}, "arrays": {name: [dtype, shape, offset]}}
+    arrays         raw bytes
+"""
+
+cache_magic     = "OMCACHE\x01"
+cache_version   = 2
+cache_align     = 64
+
+
+
+def _to_str(obj):
+    """
+    json gives back unicode, the rest of the code works with str
+    """
+    if isinstance(obj, unicode):
+        return obj.encode('utf-8')
+    if isinstance(obj, list):
+        return [ _to_str(x) for x in obj ]
+    if isinstance(obj, dict):
+        return dict([ (_to_str(k), _to_str(v)) for k, v in obj.items() ])
+    return obj
+
+def _aligned(pos):
+    return (pos + cache_align - 1) // cache_align * cache_align
+
+def write_arrays(path, info, arrays):
+    """
+    Writes info (json serialisable) and a {name: ndarray} dict to path.
+    The file is written under a temporary name and renamed into place so
+    that readers never see a half written cache.
+    """
+    names   = sorted(arrays)
+    layout  = {}
+    pos     = 0
+    for name in names:
+        arr          = np.ascontiguousarray(arrays[name])
+        arrays[name] = arr
+        pos          = _aligned(pos)
+        layout[name] = [ arr.dtype.str, list(arr.shape), pos ]
+        pos         += arr.nbytes
+
+    header  = json.dumps({ 'info': info, 'arrays': layout })
+    start   = _aligned(len(cache_magic) + 8 + len(header))
+
+    tmp     = "%s.tmp%d" % (path, os.getpid())
+    with open(tmp, 'wb') as fhd:
+        fhd.write(cache_magic)
+        fhd.write(struct.pack('<Q', len(header)))
+        fhd.write(header)
+        for name in names:
+            arr = arrays[name]
+            fhd.write("\0" * (start + layout[name][2] - fhd.tell()))
+            fhd.write(arr.data)
+    os.rename(tmp, path)
+
+def read_arrays(path):
+    """
+    Returns (info, {name: ndarray}) with the arrays mapped read only from path,
+    or (None, None) if path is not a cache file
+    """
+    if not os.path.exists(path):
+        return None, None
+
+    with open(path, 'rb') as fhd:
+        if fhd.read(len(cache_magic)) != cache_magic:
+            return None, None
+        header_len = struct.unpack('<Q', fhd.read(8))[0]
+        header     = _to_str(json.loads(fhd.read(header_len)))
+
+    start  = _aligned(len(cache_magic) + 8 + header_len)
+    mm     = np.memmap(path, dtype=np.uint8, mode='r')
+    arrays = {}
+    for name, (dtype, shape, pos) in header['arrays'].items():
+        dtype        = np.dtype(dtype)
+        count        = int(np.prod(shape)) if len(shape) > 0 else 1
+        arrays[name] = mm[start+pos:start+pos+count*dtype.itemsize].view(dtype).reshape(shape)
+
+    return header['info'], arrays
+
+
+
+def schema_hash(valid_fields, extra=None):
+    schema = [ [x[0], x[1]] for x in valid_fields['data'] ]
+    return hashlib.md5(json.dumps([cache_version, schema, extra])).hexdigest()
+
+def source_stamp(path):
+    st = os.stat(path)
+    return { 'size': st.st_size, 'mtime': repr(st.st_mtime) }
+
+def table_to_arrays(table, prefix, arrays):
+    """
+    Adds the columns of table to arrays and returns their description
+    """
+    desc = []
+    for name in table.names:
+        column = table.column(name)
+        key    = prefix + name
+        if   isinstance(column, StringColumn):
+            arrays[key + '/buffer' ] = column.buffer
+            arrays[key + '/offsets'] = column.offsets
+            desc.append([ name, 'string'  , None ])
+        elif isinstance(column, CategoryColumn):
+            arrays[key + '/codes'  ] = column.codes
+            desc.append([ name, 'category', column.categories ])
+        else:
+            arrays[key             ] = column
+            desc.append([ name, 'array'   , None ])
+    return desc
+
+def table_from_arrays(desc, prefix, arrays):
+    columns = []
+    for name, kind, categories in desc:
+        key = prefix + name
+        if   kind == 'string':
+            columns.append([ name, StringColumn(arrays[key + '/buffer'], arrays[key + '/offsets']) ])
+        elif kind == 'category':
+            columns.append([ name, CategoryColumn(arrays[key + '/codes'], categories) ])
+        else:
+            columns.append([ name, arrays[key] ])
+    return XmapTable([ x[0] for x in desc ], columns)
+
+def index_to_arrays(index, key, arrays):
+    arrays[key + '/keys'   ] = index.keys_arr
+    arrays[key + '/offsets'] = index.offsets
+    if index.rows is not None:
+        arrays[key + '/rows'] = index.rows
+    return index.labels
+
+def index_from_arrays(key, arrays, labels):
+    return CsrIndex(arrays[key + '/keys'], arrays[key + '/offsets'], arrays.get(key + '/rows'), labels=labels)
+
+def intervals_to_arrays(intervals, key, arrays):
+    arrays[key + '/starts'  ] = intervals.starts
+    arrays[key + '/ends'    ] = intervals.ends
+    arrays[key + '/max_ends'] = intervals.max_ends
+    return index_to_arrays(intervals.index, key, arrays)
+
+def intervals_from_arrays(key, arrays, labels):
+    return IntervalIndex(index_from_arrays(key, arrays, labels), arrays[key + '/starts'], arrays[key + '/ends'], arrays[key + '/max_ends'])
+
+
+
+def write_xmap_cache(path, source, valid_fields, cols_category, meta, data, indexer, groups):
+    arrays  = {}
+    info    = {
+        'source'   : source_stamp(source),
+        'schema'   : schema_hash(valid_fields, cols_category),
+        'meta'     : meta,
+        'columns'  : table_to_arrays(data, 'col/', arrays),
+        'indexer'  : {},
+        'groups'   : {},
+        'intervals': {}
+    }
+
+    for name, index in indexer.built.items():
+        info['indexer'][name] = index_to_arrays(index, 'idx/' + name, arrays)
+
+    for name, group in groups.built.items():
+        info['groups'][name] = [
+            index_to_arrays(group.outer, 'grp/' + name + '/outer', arrays),
+            index_to_arrays(group.inner, 'grp/' + name + '/inner', arrays)
+        ]
+
+    for name, intervals in indexer.built_intervals.items():
+        info['intervals'][name] = intervals_to_arrays(intervals, 'itv/' + name, arrays)
+
+    write_arrays(path, info, arrays)
+
+def read_xmap_cache(path, source, valid_fields, cols_category):
+    """
+    Returns (meta, data, indexes, groups, intervals) from the cache in path,
+    or None if it is missing or stale (source size/mtime or schema changed)
+    """
+    try:
+        info, arrays = read_arrays(path)
+    except (IOError, ValueError, KeyError):
+        return None
+
+    if info is None:
+        return None
+
+    if info['source'] != source_stamp(source) or info['schema'] != schema_hash(valid_fields, cols_category):
+        return None
+
+    data    = table_from_arrays(info['columns'], 'col/', arrays)
+
+    indexes = {}
+    for name, labels in info['indexer'].items():
+        indexes[name] = index_from_arrays('idx/' + name, arrays, labels)
+
+    groups  = {}
+    for name, (labels_outer, labels_inner) in info['groups'].items():
+        groups[name]  = CsrGroup(index_from_arrays('grp/' + name + '/outer', arrays, labels_outer), index_from_arrays('grp/' + name + '/inner', arrays, labels_inner))
+
+    intervals = {}
+    for name, labels in info['intervals'].items():
+        intervals[name] = intervals_from_arrays('itv/' + name, arrays, labels)
+
+    return info['meta'], data, indexes, groups, intervals
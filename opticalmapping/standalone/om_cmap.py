@@ -0,0 +1,349 @@
+import os
+import itertools
+
+import numpy as np
+
+from om_cache import read_arrays, write_arrays, source_stamp
+from om_input import read_chunks
+
+"""
+CMAP (consensus map) reader.
+
+A CMAP has one line per label of every map, plus one end of map line with
+LabelChannel 0:
+
+    #h CMapId  ContigLength  NumSites  SiteID  LabelChannel  Position    StdDev  Coverage  Occurrence
+    1          21805821.0    2183      1       1             10672.0     1.0     1         1
+    1          21805821.0    2183      2184    0             21805821.0  0.0     1         0
+
+The labels are kept in compressed sparse row layout: the positions of all
+maps back to back, the labels of the map at position p in map_ids being
+positions[offsets[p]:offsets[p+1]], in SiteID order. map_pos maps a CMapId
+straight to its position, so the coordinate of label i of map m is two array
+lookups away.
+
+load_cmap parses a CMAP once and keeps the arrays in a <cmap>.cache sidecar
+(see om_cache), later loads map it without reading the text again:
+
+    cmap = load_cmap("in_r.cmap")
+    cmap.position(1, 12)                       #label 12 of map 1
+    cmap.positions_of([1, 1, 7], [12, 13, 5])  #several at once
+"""
+
+cmap_cache_version = 1
+cmap_chunk_size    = 16 << 20
+
+#columns kept as arrays of their own, the rest goes to columns as float64
+cmap_key_cols      = ["CMapId", "ContigLength", "NumSites", "SiteID", "LabelChannel", "Position"]
+#a dense CMapId -> position table is used up to this many entries per map
+dense_lookup_ratio = 16
+
+
+
+class Cmap(object):
+    """
+    Label positions of the maps of a CMAP file
+    """
+    def __init__(self, headers, map_ids, lengths, offsets, positions, channels, columns):
+        self.headers   = headers
+        self.map_ids   = map_ids
+        self.lengths   = lengths
+        self.offsets   = offsets
+        self.positions = positions
+        self.channels  = channels
+        self.columns   = columns
+        self.lookup    = None
+
+        max_id         = int(map_ids[-1]) if len(map_ids) > 0 else -1
+        if 0 <= max_id < dense_lookup_ratio * len(map_ids) + 1024:
+            self.lookup = np.full(max_id + 1, -1, dtype=np.int64)
+            self.lookup[map_ids] = np.arange(len(map_ids))
+
+    def __len__(self):
+        return len(self.map_ids)
+
+    def __contains__(self, map_id):
+        return self.map_pos(map_id) >= 0
+
+    def map_pos(self, map_id):
+        """
+        Position of map_id in map_ids, -1 if missing
+        """
+        if self.lookup is not None:
+            if 0 <= map_id < len(self.lookup):
+                return int(self.lookup[map_id])
+            return -1
+
+        pos = np.searchsorted(self.map_ids, map_id)
+        if pos < len(self.map_ids) and self.map_ids[pos] == map_id:
+            return int(pos)
+        return -1
+
+    def maps_pos(self, map_ids):
+        """
+        map_pos of an array of map ids
+        """
+        map_ids = np.asarray(map_ids, dtype=np.int64)
+        if self.lookup is not None:
+            valid      = ( map_ids >= 0 ) & ( map_ids < len(self.lookup) )
+            pos        = np.full(len(map_ids), -1, dtype=np.int64)
+            pos[valid] = self.lookup[map_ids[valid]]
+            return pos
+
+        if len(self.map_ids) == 0:
+            return np.full(len(map_ids), -1, dtype=np.int64)
+
+        pos        = np.minimum(np.searchsorted(self.map_ids, map_ids), len(self.map_ids) - 1)
+        return np.where(self.map_ids[pos] == map_ids, pos, -1)
+
+    def _pos(self, map_id):
+        pos = self.map_pos(map_id)
+        if pos < 0:
+            raise KeyError(map_id)
+        return pos
+
+    def length(self, map_id):
+        return self.lengths[self._pos(map_id)].item()
+
+    def num_labels(self, map_id):
+        pos = self._pos(map_id)
+        return int(self.offsets[pos+1] - self.offsets[pos])
+
+    def labels(self, map_id):
+        """
+        Positions of the labels of map_id, label 1 first
+        """
+        pos = self._pos(map_id)
+        return self.positions[self.offsets[pos]:self.offsets[pos+1]]
+
+    def position(self, map_id, label):
+        """
+        Position of label (SiteID, 1 based) of map_id
+        """
+        pos = self._pos(map_id)
+        if not 1 <= label <= self.offsets[pos+1] - self.offsets[pos]:
+            raise IndexError("map %d has no label %d" % (map_id, label))
+        return self.positions[self.offsets[pos] + label - 1].item()
+
+    def positions_of(self, map_ids, labels):
+        """
+        Positions of labels[i] of map_ids[i], nan where the map or the label
+        does not exist
+        """
+        labels     = np.asarray(labels, dtype=np.int64)
+        pos        = self.maps_pos(map_ids)
+        found      = pos >= 0
+        starts     = np.where(found, self.offsets[np.maximum(pos, 0)    ], 0)
+        stops      = np.where(found, self.offsets[np.maximum(pos, 0) + 1], 0)
+        rows       = starts + labels - 1
+        valid      = found & ( labels >= 1 ) & ( rows < stops )
+
+        result        = np.full(len(labels), np.nan, dtype=np.float64)
+        result[valid] = self.positions[rows[valid]]
+        return result
+
+    def column(self, name, map_id=None):
+        """
+        Column name (eg. StdDev, Coverage) of every label, or of the labels
+        of map_id
+        """
+        column = self.columns[name]
+        if map_id is None:
+            return column
+        pos = self._pos(map_id)
+        return column[self.offsets[pos]:self.offsets[pos+1]]
+
+
+
+def parse_cmap_header(headers):
+    names = None
+    for line in headers:
+        if line.startswith("#h"):
+            names = [ x.strip() for x in line[2:].strip().split("\t") ]
+    if names is None:
+        raise ValueError("CMAP without a #h line")
+    for name in cmap_key_cols:
+        if name not in names:
+            raise ValueError("CMAP without a %s column" % name)
+    return names
+
+def iter_cmap_blocks(path, chunk_size=cmap_chunk_size):
+    """
+    Yields the "#" header lines of a CMAP as a list, then the values of its
+    data lines as float64 arrays of (lines, columns), a chunk at a time
+    """
+    headers = []
+    names   = None
+    rest    = ""
+    #the "\n" closes a last line without one
+    for chunk in itertools.chain(read_chunks(path, chunk_size=chunk_size), [ "\n" ]):
+        text = rest + chunk
+        cut  = text.rfind("\n") + 1
+        rest = text[cut:]
+        text = text[:cut]
+
+        if names is None:
+            #the header is at the top of the file, before the first label
+            while len(text) > 0 and ( text[0] == "#" or text[0] in "\r\n" ):
+                eol  = text.find("\n") + 1
+                line = text[:eol].strip()
+                if len(line) > 0:
+                    headers.append(line)
+                text = text[eol:]
+
+            if len(text) == 0:
+                continue
+
+            names = parse_cmap_header(headers)
+            yield headers
+
+        if len(text.strip()) > 0:
+            yield parse_cmap_block(text, len(names))
+
+    if names is None:
+        yield headers
+
+def parse_cmap_block(text, num_cols):
+    if "\n\n" in text or "\n\r\n" in text or text[0] in "\r\n":
+        text = "".join([ x for x in text.splitlines(True) if len(x.strip()) > 0 ])
+
+    num_lines = text.count("\n")
+    vals      = np.fromstring(text, dtype=np.float64, sep=" ")
+    if len(vals) != num_lines * num_cols:
+        raise ValueError("malformed CMAP lines: expected %d columns in %d lines, got %d values" % (num_cols, num_lines, len(vals)))
+    return vals.reshape(num_lines, num_cols)
+
+def read_cmap(path):
+    """
+    Parses a CMAP file, gzip, BGZF or bzip2 compressed or not, into a Cmap
+    """
+    blocks  = iter_cmap_blocks(path)
+    headers = next(blocks)
+    names   = parse_cmap_header(headers)
+    cols    = dict([ (n, p) for p, n in enumerate(names) ])
+    extra   = [ n for n in names if n not in cmap_key_cols ]
+
+    parts   = dict([ (n, []) for n in [ "CMapId", "SiteID", "Position", "LabelChannel", "ContigLength" ] + extra ])
+    for block in blocks:
+        #the end of map lines only carry the map length
+        labels = block[block[:, cols["LabelChannel"]] != 0]
+        for name in parts:
+            parts[name].append(labels[:, cols[name]])
+
+    def column(name, dtype):
+        if len(parts[name]) == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.concatenate(parts[name]).astype(dtype)
+
+    map_col   = column("CMapId"      , np.int64  )
+    site_col  = column("SiteID"      , np.int64  )
+    positions = column("Position"    , np.float64)
+    channels  = column("LabelChannel", np.int8   )
+    length    = column("ContigLength", np.float64)
+    columns   = dict([ (n, column(n, np.float64)) for n in extra ])
+
+    if len(map_col) > 1 and not ( ( np.diff(map_col) > 0 ) | ( ( np.diff(map_col) == 0 ) & ( np.diff(site_col) > 0 ) ) ).all():
+        order     = np.lexsort((site_col, map_col))
+        map_col   = map_col  [order]
+        site_col  = site_col [order]
+        positions = positions[order]
+        channels  = channels [order]
+        length    = length   [order]
+        columns   = dict([ (n, c[order]) for n, c in columns.items() ])
+
+    if len(map_col) > 0:
+        change     = np.empty(len(map_col), dtype=np.bool_)
+        change[0]  = True
+        np.not_equal(map_col[1:], map_col[:-1], out=change[1:])
+        starts     = np.flatnonzero(change)
+    else:
+        starts     = np.zeros(0, dtype=np.int64)
+
+    offsets   = np.append(starts, len(map_col)).astype(np.int64)
+    map_ids   = map_col[starts]
+    lengths   = length [starts]
+
+    #label i of a map has to be its ith row
+    expected  = np.arange(len(map_col), dtype=np.int64) - np.repeat(starts, np.diff(offsets)) + 1
+    if not np.array_equal(site_col, expected):
+        raise ValueError("SiteID of the labels of a map in %s are not 1, 2, 3 ..." % path)
+
+    return Cmap(headers, map_ids, lengths, offsets, positions, channels, columns)
+
+def write_cmap_cache(path, source, cmap):
+    arrays  = {
+        'map_ids'  : cmap.map_ids,
+        'lengths'  : cmap.lengths,
+        'offsets'  : cmap.offsets,
+        'positions': cmap.positions,
+        'channels' : cmap.channels,
+    }
+    for name, column in cmap.columns.items():
+        arrays['col/' + name] = column
+
+    info    = {
+        'version': cmap_cache_version,
+        'source' : source_stamp(source),
+        'headers': cmap.headers,
+        'columns': sorted(cmap.columns),
+    }
+    write_arrays(path, info, arrays)
+
+def read_cmap_cache(path, source):
+    """
+    Cmap from the cache in path, None if it is missing or stale
+    """
+    try:
+        info, arrays = read_arrays(path)
+    except (IOError, ValueError, KeyError):
+        return None
+
+    if info is None or info.get('version') != cmap_cache_version or info['source'] != source_stamp(source):
+        return None
+
+    columns = dict([ (n, arrays['col/' + n]) for n in info['columns'] ])
+    return Cmap(info['headers'], arrays['map_ids'], arrays['lengths'], arrays['offsets'], arrays['positions'], arrays['channels'], columns)
+
+def load_cmap(path, cache=True):
+    """
+    Cmap of path, from <path>.cache if it is up to date. With cache=True
+    the cache is written when missing or stale.
+    """
+    cache_file = path + ".cache"
+
+    cmap = read_cmap_cache(cache_file, path)
+    if cmap is not None:
+        return cmap
+
+    cmap = read_cmap(path)
+    if cache:
+        try:
+            write_cmap_cache(cache_file, path, cmap)
+        except (IOError, OSError) as e:
+            print "could not save cache %s: %s" % (cache_file, e)
+    return cmap
+
+def find_cmap(infile, maps_from):
+    """
+    Path of the CMAP a XMAP header names in ref_maps_from / query_maps_from,
+    as given or next to the XMAP file infile. None if not found.
+    """
+    if maps_from is None or len(maps_from) == 0:
+        return None
+
+    for path in ( maps_from, os.path.join(os.path.dirname(os.path.abspath(infile)), os.path.basename(maps_from)) ):
+        if os.path.isfile(path):
+            return path
+
+    return None
+
+def load_xmap_cmaps(infile, ref_maps_from, query_maps_from, cache=True):
+    """
+    (reference Cmap, query Cmap) named by the header of the XMAP infile, as
+    parse_file returns them. None for a CMAP that is not found.
+    """
+    cmaps = []
+    for maps_from in ( ref_maps_from, query_maps_from ):
+        path = find_cmap(infile, maps_from)
+        cmaps.append(None if path is None else load_cmap(path, cache=cache))
+    return tuple(cmaps)
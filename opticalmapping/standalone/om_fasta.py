@@ -0,0 +1,247 @@
+import os
+import mmap
+
+from om_input import open_input, detect_compression
+
+"""
+FASTA index compatible with samtools faidx.
+
+A .fai file has one tab separated line per sequence:
+
+    name    length    offset    line_bases    line_width
+
+offset is the byte offset of the first base, line_bases the bases of every
+full line and line_width the bytes of a full line, newline included. With it
+any slice of a sequence is a seek away, without reading the sequences before
+it. Only uncompressed FASTA files can be indexed; sequence_lengths also
+reads compressed ones, streaming.
+"""
+
+fai_ext = ".fai"
+
+
+
+class FastaIndexError(Exception):
+    pass
+
+class FaiEntry(object):
+    __slots__ = ('name', 'length', 'offset', 'line_bases', 'line_width')
+
+    def __init__(self, name, length, offset, line_bases, line_width):
+        self.name       = name
+        self.length     = length
+        self.offset     = offset
+        self.line_bases = line_bases
+        self.line_width = line_width
+
+    def byte_offset(self, pos):
+        """
+        Byte offset in the file of base pos (0 based)
+        """
+        if self.line_bases == 0:
+            return self.offset
+        return self.offset + ( pos // self.line_bases ) * self.line_width + pos % self.line_bases
+
+    def to_line(self):
+        return "%s\t%d\t%d\t%d\t%d\n" % ( self.name, self.length, self.offset, self.line_bases, self.line_width )
+
+class FastaIndex(object):
+    """
+    Entries of a .fai file, in the order of the sequences in the FASTA
+    """
+    def __init__(self, path, entries):
+        self.path    = path
+        self.entries = entries
+        self.names   = dict([ (x.name, p) for p, x in enumerate(entries) ])
+        self.mm      = None
+        self.fhd     = None
+
+    @classmethod
+    def build(cls, path):
+        """
+        Indexes an uncompressed FASTA, as samtools faidx does
+        """
+        if detect_compression(path) is not None:
+            raise FastaIndexError("cannot index compressed FASTA %s" % path)
+
+        entries   = []
+        entry     = None
+        offset    = 0
+        last_line = None
+
+        with open(path, 'rb') as fhd:
+            for line in fhd:
+                size    = len(line)
+                offset += size
+
+                if line[0] == ">":
+                    words     = line[1:].split()
+                    entry     = FaiEntry(words[0] if len(words) > 0 else "", 0, offset, -1, -1)
+                    last_line = None
+                    entries.append(entry)
+                    continue
+
+                if entry is None:
+                    continue
+
+                bases = len(line.rstrip("\r\n"))
+                if bases != len(line.rstrip()):
+                    raise FastaIndexError("blanks at the end of a line in sequence %s of %s" % (entry.name, path))
+
+                if bases == 0:
+                    #blank lines are only allowed at the end of a sequence
+                    if last_line is not None:
+                        last_line = -1
+                    continue
+
+                if last_line is not None and last_line != entry.line_bases:
+                    #only the last line of a sequence may be shorter
+                    raise FastaIndexError("different line length in sequence %s of %s" % (entry.name, path))
+
+                if entry.line_bases == -1:
+                    entry.line_bases = bases
+                    entry.line_width = size
+
+                elif bases > entry.line_bases or ( bases == entry.line_bases and size != entry.line_width ):
+                    raise FastaIndexError("different line length in sequence %s of %s" % (entry.name, path))
+
+                entry.length += bases
+                last_line     = bases
+
+        for entry in entries:
+            if entry.line_bases == -1:
+                entry.line_bases = entry.line_width = 0
+
+        return cls(path, entries)
+
+    @classmethod
+    def read(cls, path, fai=None):
+        entries = []
+        with open(fai or path + fai_ext, 'r') as fhd:
+            for line in fhd:
+                cols = line.rstrip("\r\n").split("\t")
+                if len(cols) < 5:
+                    continue
+                entries.append(FaiEntry(cols[0], int(cols[1]), int(cols[2]), int(cols[3]), int(cols[4])))
+        return cls(path, entries)
+
+    @classmethod
+    def load(cls, path, write=True):
+        """
+        Reads path.fai if it is newer than path, otherwise builds the index
+        and, if write is set, saves it for the next time
+        """
+        fai = path + fai_ext
+        if os.path.exists(fai) and os.path.getmtime(fai) >= os.path.getmtime(path):
+            return cls.read(path, fai)
+
+        index = cls.build(path)
+        if write:
+            try:
+                index.write(fai)
+            except (IOError, OSError) as e:
+                print "could not save index %s: %s" % (fai, e)
+        return index
+
+    def write(self, fai=None):
+        fai = fai or self.path + fai_ext
+        tmp = "%s.tmp%d" % (fai, os.getpid())
+        with open(tmp, 'w') as fhd:
+            for entry in self.entries:
+                fhd.write(entry.to_line())
+        os.rename(tmp, fai)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def entry(self, name):
+        """
+        FaiEntry of a sequence name or position
+        """
+        if isinstance(name, (int, long)):
+            return self.entries[name]
+        return self.entries[self.names[name]]
+
+    def lengths(self):
+        return [ x.length for x in self.entries ]
+
+    def open(self):
+        if self.mm is None:
+            self.fhd = open(self.path, 'rb')
+            if os.path.getsize(self.path) > 0:
+                self.mm = mmap.mmap(self.fhd.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.mm
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+        if self.fhd is not None:
+            self.fhd.close()
+            self.fhd = None
+
+    def title(self, name):
+        """
+        Header line of a sequence, without ">" and surrounding blanks
+        """
+        entry = self.entry(name)
+        mm    = self.open()
+        #the header is the line ending right before the first base
+        start = mm.rfind("\n", 0, entry.offset - 1) + 1
+        return mm[start:entry.offset].strip()[1:]
+
+    def fetch(self, name, start=0, end=None):
+        """
+        Bases [start, end) of a sequence, 0 based
+        """
+        entry = self.entry(name)
+        if end is None or end > entry.length:
+            end = entry.length
+        if start >= end:
+            return ""
+        mm    = self.open()
+        return mm[entry.byte_offset(start):entry.byte_offset(end - 1) + 1].translate(None, "\r\n")
+
+    def chunks(self, name, chunk_bases=1 << 20):
+        """
+        Yields the bases of a sequence chunk_bases at a time
+        """
+        length = self.entry(name).length
+        for start in xrange(0, length, chunk_bases):
+            yield self.fetch(name, start, start + chunk_bases)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+
+def sequence_lengths(path):
+    """
+    [(name, length)] of the sequences of a FASTA file, from its .fai (built
+    and saved if needed) or, for compressed files, counted while streaming
+    """
+    if detect_compression(path) is None:
+        return [ (x.name, x.length) for x in FastaIndex.load(path).entries ]
+
+    lengths = []
+    with open_input(path) as fhd:
+        for line in fhd:
+            line = line.strip()
+
+            if len(line) == 0:
+                continue
+
+            if line[0] == ">":
+                words = line[1:].split()
+                lengths.append([ words[0] if len(words) > 0 else "", 0 ])
+
+            elif len(lengths) > 0:
+                lengths[-1][1] += len(line)
+
+    return [ tuple(x) for x in lengths ]
@@ -10,13 +10,108 @@ def parse_args(args):
     parser = argparse.ArgumentParser(description="Bionano Genomics augmented MAP filter")
     parser.add_argument( 'infile',                                    help="AUGMENTED file"                                             )
     parser.add_argument( '-l'    , '--list'   , action='store_true' , help="List Fields and Operators"                                  )
-    parser.add_argument( '-f'    , '--filter' , action='append'     , help="Filters [Field:Function(%s):Value]" % ", ".join(sorted(valid_operators.keys())))
+    parser.add_argument( '-f'    , '--filter' , action='append'     , help="Filters [Field:Function(%s):Value]. Filters can be combined with AND, OR, NOT and parenthesis: \"Confidence:ge:10 AND ( _meta_num_qry_matches:eq:1 OR NOT Orientation:eq:- )\"" % ", ".join(sorted(valid_operators.keys())))
+    parser.add_argument( '-s'    , '--stream' , action='store_true' , help="Filter in two passes over the file, a batch of rows at a time, keeping only the columns the per query _meta_ statistics need in memory. _meta_ fields can not be filtered on")
+    parser.add_argument( '-C'    , '--cache'  , action='store_true' , help="Keep a binary parse cache next to the input file and reuse it" )
+    parser.add_argument( '-Z'    , '--compress', choices=['gzip', 'bgzip'], help="Write the report gzip or bgzip compressed" )
+    add_profile_args(parser)
     
     args    = parser.parse_args(args=args)
 
     return args
 
 
+def report_header(headers, filters, valid_fields):
+    text  = "\n".join(headers[:-2]) + "\n#\n"
+    
+    text += "# FILTERS:\n"
+    for filter_data in filters:
+        text += filter_header(filter_data)
+    text += "\n\n"
+    
+    text += "#h " + "\t".join( [ "%-39s"       % ( x                             ) for x in valid_fields['names'  ] ] ) + "\n"
+    text += "#f " + "\t".join( [ "%-39s"       % (    valid_fields['types'  ][x] ) for x in valid_fields['names'  ] ] ) + "\n"
+    return text
+
+def filter_report(data, filters):
+    """
+    Rows of data passing filters, with the per query statistics
+    recalculated over the rows left
+    """
+    #first pass on the values as read, the per query statistics are then
+    #recalculated over the rows left and the filters applied once more
+    with profile_stage("filter", rows=len(data)):
+        plan        = FilterPlan(filters)
+        mask        = plan.mask(data)
+
+    with profile_stage("stats", rows=len(data)):
+        rows, stats = query_stats(data, mask)
+
+    with profile_stage("filter", rows=len(rows)):
+        report      = data.take(rows)
+        for stat in stats:
+            report.set_column(stat, stats[stat])
+
+        return report.take(np.flatnonzero(plan.mask(report)))
+
+#the columns query_stats reads, kept from the rows passing in stream_filter
+stream_stat_cols = [ "XmapEntryID", "QryContigID", "RefContigID", "QryStartPos", "QryEndPos", "RefStartPos", "RefEndPos", "Orientation", "Confidence" ]
+
+def stream_filter(infile, oufile, filters, valid_fields, compress=None):
+    """
+    filter_report in two passes over infile, a batch at a time. The rows of
+    a query are spread over the file, ordered by RefContigID, so the first
+    pass keeps only the stream_stat_cols of the rows passing, to recalculate
+    the per query statistics over them, and the second one writes the rows
+    with those statistics. The rows are written in the order of infile.
+    """
+    from om_io    import open_output
+    from om_table import XmapTable
+
+    plan  = FilterPlan(filters)
+
+    xmap  = iter_xmap(infile, valid_fields)
+    meta  = next(xmap)
+
+    print "NAMES"  , meta['names']
+    print "TYPES"  , meta['types']
+
+    kept  = []
+    for data in profile_iter("parse", xmap):
+        with profile_stage("filter", rows=len(data)):
+            rows = np.flatnonzero(plan.mask(data))
+            kept.append( XmapTable(stream_stat_cols, [ (name, data.column(name)) for name in stream_stat_cols ]).take(rows) )
+
+    with profile_stage("stats", rows=sum([ len(x) for x in kept ])):
+        if len(kept) > 0:
+            kept    = XmapTable.concat(kept)
+        else:
+            kept    = XmapTable(stream_stat_cols, [ (name, np.zeros(0)) for name in stream_stat_cols ])
+        order, stats = query_stats(kept)
+        #position of every row kept in the stats
+        stat_pos    = np.empty(len(order), dtype=np.int64)
+        stat_pos[order] = np.arange(len(order), dtype=np.int64)
+
+    print "CREATING REPORT:", oufile
+    with open_output(oufile, compress) as reporter:
+        reporter.write( report_header(meta['headers'], filters, valid_fields) )
+
+        xmap  = iter_xmap(infile, valid_fields)
+        next(xmap)
+        done  = 0
+        for data in profile_iter("parse", xmap):
+            with profile_stage("filter", rows=len(data)):
+                report = data.take(np.flatnonzero(plan.mask(data)))
+                pos    = stat_pos[done:done+len(report)]
+                done  += len(report)
+                for stat in stats:
+                    if isinstance(stats[stat], list):
+                        report.set_column(stat, [ stats[stat][x] for x in pos.tolist() ])
+                    else:
+                        report.set_column(stat, stats[stat][pos])
+            write_rows(reporter, report, valid_fields['names'])
+    print
+
 def main(args):
     valid_fields = gen_valid_fields(valid_fields_g)
     infile       = args.infile
@@ -37,16 +132,30 @@ def main(args):
         sys.exit(1)
     
     
+    from om_io import open_output, output_name
+
     filters = gen_filter(args.filter, valid_fields)
+
+    if args.stream:
+        meta_fields = [ x for x in FilterPlan(filters).fields() if x.startswith("_meta_") ]
+        if len(meta_fields) > 0:
+            print "--stream can not filter on %s: the _meta_ statistics are only recalculated over the rows left after filtering. filter without --stream" % ", ".join(meta_fields)
+            sys.exit(1)
     
     oufile = infile
-    for field_name, field_operator_name, field_operator, field_value_str, field_value in filters:
-        oufile += ('_' + '_'.join( [ field_name, field_operator_name, field_value_str ] )).replace(',', '_')
+    for filter_data in filters:
+        oufile += filter_name(filter_data)
     
+    oufile = output_name(oufile + ".report.tsv", args.compress)
+
     print "saving to %s" % oufile
+    profile_output(oufile)
 
-    data, headers, names, seman, types, indexer, groups, ref_maps_from, query_maps_from, filters_csv = parse_file(infile, valid_fields)
-    data = [ KeyedTuple(x, labels=names)._asdict() for x in data ]
+    if args.stream:
+        stream_filter(infile, oufile, filters, valid_fields, compress=args.compress)
+        return
+
+    data, headers, names, seman, types, indexer, groups, ref_maps_from, query_maps_from, filters_csv = parse_file(infile, valid_fields, cache=args.cache)
 
     print "NAMES"  , names
     #print "HEADERS", "\n".join( headers )
@@ -57,51 +166,13 @@ def main(args):
     print "file has %5d maps and %3d chromosomes" % (len(indexer["QryContigID"]), len(indexer["RefContigID"]))
 
     
-    print "CREATING REPORT:", oufile + ".report.tsv"
-    with open(oufile + ".report.tsv", "w") as reporter:
-        reporter.write("\n".join(headers[:-2]) + "\n#\n")
-        
-        reporter.write("# FILTERS:\n")
-        for field_name, field_operator_name, field_operator, field_value_str, field_value in filters:
-            reporter.write( "# FILTER : %-39s: %3s : %s\n" % ( field_name, field_operator_name, field_value_str ) )
-        reporter.write( "\n\n" )
-        
-        reporter.write("#h " + "\t".join( [ "%-39s"       % ( x                             ) for x in valid_fields['names'  ] ] ) + "\n")
-        reporter.write("#f " + "\t".join( [ "%-39s"       % (    valid_fields['types'  ][x] ) for x in valid_fields['names'  ] ] ) + "\n")
-
-
-
-        for RefContigID in sorted(groups["RefContigID_QryContigID"]):
-            QryContigIDs = groups["RefContigID_QryContigID"][RefContigID]
-            
-            for QryContigID in sorted(QryContigIDs):
-                data_poses            = list(groups["RefContigID_QryContigID"][RefContigID][QryContigID])
-                data_vals             = []
-                valid_data_poses      = []
-                
-                all_data_poses = list(indexer["QryContigID"][QryContigID])
-                for data_pos in list(all_data_poses):
-                    data_val   = data[data_pos]
-                    filter_res = all([ field_operator( data_val[field_name], field_value ) for field_name, field_operator_name, field_operator, field_value_str, field_value in filters])
-                    if filter_res:
-                        if data_pos in data_poses:
-                            data_vals.append(data_val)
-                        valid_data_poses.append(data_pos)
-    
-                if len(data_vals) > 0:
-                    stats = stats_from_data_vals(RefContigID, QryContigID, groups, indexer, data, data_vals, valid_data_poses)
-        
-                    #print "RefContigID %4d QryContigID %6d" % ( RefContigID, QryContigID )
-                    for data_val in data_vals:
-                        for stat in stats:
-                            data_val[stat] = stats[stat]
+    print "CREATING REPORT:", oufile
+    with open_output(oufile, args.compress) as reporter:
+        reporter.write( report_header(headers, filters, valid_fields) )
+
 
-                        filter_res = all([ field_operator( data_val[field_name], field_value ) for field_name, field_operator_name, field_operator, field_value_str, field_value in filters])
-                        if not filter_res:
-                            continue
 
-                        #print " ", " ".join( ["%s %s" % (x, str(data_val[x])) for x in sorted(data_val)] )
-                        reporter.write(            "\t".join( [ str(data_val[x])                                   for x in valid_fields['names'  ] ] ) + "\n")
+        write_rows(reporter, filter_report(data, filters), valid_fields['names'])
     print
 
 
@@ -114,4 +185,5 @@ if __name__ == '__main__':
 
     args         = parse_args(sys.argv[1:])
 
-    main(args)
\ No newline at end of file
+    with profile_run("om_filter", args):
+        main(args)
\ No newline at end of file
@@ -0,0 +1,378 @@
+import numpy as np
+
+from om_profile import profile_stage
+
+"""
+Group indexes over XmapTable columns in compressed sparse row (CSR) layout.
+
+A one level index (column value -> row ids) is stored as
+
+    keys    [k0, k1, k2]          sorted unique values
+    offsets [0, 2, 3, 6]          rows of keys[i] are rows[offsets[i]:offsets[i+1]]
+    rows    [4, 9, 1, 0, 2, 7]    row ids, ascending within each key
+
+and a two level grouping (value of col A -> value of col B -> row ids) adds
+one more keys/offsets level on top of it. Lookups are binary searches over the
+key arrays, so nothing is stored per row but the row id itself.
+
+An interval index (value -> rows overlapping [beg, end]) is a one level index
+with the rows of every key sorted by start, plus the start, the end and the
+running maximum of the ends of those rows:
+
+    starts   [10, 20, 35, 50]
+    ends     [90, 30, 40, 60]
+    max_ends [90, 90, 90, 90]
+
+Rows starting after end are cut with a binary search over starts, rows before
+the first max_end >= beg with one over max_ends, and only the rows in between
+have their own end checked.
+"""
+
+def _rows_dtype(num_rows):
+    if num_rows < 2**31:
+        return np.int32
+    return np.int64
+
+def _key_values(column):
+    """
+    Sortable key array and, for category columns, the labels of the codes
+    """
+    if hasattr(column, 'codes'):
+        return column.codes, column.categories
+    assert not hasattr(column, 'offsets'), "cannot index a string column"
+    return column, None
+
+def _runs(vals):
+    """
+    Start position of every run of equal values in a sorted array
+    """
+    if len(vals) == 0:
+        return np.zeros(0, dtype=np.int64)
+    change     = np.empty(len(vals), dtype=np.bool_)
+    change[0]  = True
+    np.not_equal(vals[1:], vals[:-1], out=change[1:])
+    return np.flatnonzero(change)
+
+
+
+class CsrIndex(object):
+    """
+    Read only mapping of key -> array of row ids
+    """
+    __slots__ = ('keys_arr', 'offsets', 'rows', 'labels', 'codes')
+
+    def __init__(self, keys_arr, offsets, rows, labels=None):
+        self.keys_arr = keys_arr
+        self.offsets  = offsets
+        self.rows     = rows
+        self.labels   = labels
+        self.codes    = None if labels is None else dict([ (l, p) for p, l in enumerate(labels) ])
+
+    @classmethod
+    def build(cls, column):
+        vals, labels = _key_values(column)
+        order        = np.argsort(vals, kind='mergesort').astype(_rows_dtype(len(vals)))
+        svals        = vals[order]
+        starts       = _runs(svals)
+        offsets      = np.append(starts, len(svals)).astype(np.int64)
+        return cls(svals[starts], offsets, order, labels=labels)
+
+    def _as_key(self, key):
+        #a python int against an int32 array makes searchsorted cast the
+        #whole array to int64 on every lookup
+        dtype = self.keys_arr.dtype
+        if dtype.kind == 'i' and isinstance(key, (int, long)):
+            bound = 1 << (dtype.itemsize * 8 - 1)
+            if -bound <= key < bound:
+                return dtype.type(key)
+        return key
+
+    def _pos(self, key):
+        if self.codes is not None:
+            key = self.codes.get(key, -1)
+        pos = np.searchsorted(self.keys_arr, self._as_key(key))
+        if pos < len(self.keys_arr) and self.keys_arr[pos] == key:
+            return pos
+        return None
+
+    def __len__(self):
+        return len(self.keys_arr)
+
+    def __contains__(self, key):
+        return self._pos(key) is not None
+
+    def __getitem__(self, key):
+        pos = self._pos(key)
+        if pos is None:
+            raise KeyError(key)
+        return self.rows[self.offsets[pos]:self.offsets[pos+1]]
+
+    def get(self, key, default=None):
+        pos = self._pos(key)
+        if pos is None:
+            return default
+        return self.rows[self.offsets[pos]:self.offsets[pos+1]]
+
+    def keys(self):
+        keys = self.keys_arr.tolist()
+        if self.labels is not None:
+            keys = [ self.labels[x] for x in keys ]
+        return keys
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def iterkeys(self):
+        return iter(self.keys())
+
+    def values(self):
+        return [ self.rows[self.offsets[p]:self.offsets[p+1]] for p in xrange(len(self)) ]
+
+    def items(self):
+        return zip(self.keys(), self.values())
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def counts(self):
+        return np.diff(self.offsets)
+
+class CsrGroup(object):
+    """
+    Read only mapping of key A -> CsrIndex of key B -> array of row ids
+    """
+    __slots__ = ('outer', 'inner')
+
+    def __init__(self, outer, inner):
+        #outer.rows holds positions in the inner key array
+        self.outer = outer
+        self.inner = inner
+
+    @classmethod
+    def build(cls, column_from, column_to):
+        vals_from, labels_from = _key_values(column_from)
+        vals_to  , labels_to   = _key_values(column_to  )
+        order                  = np.lexsort((vals_to, vals_from)).astype(_rows_dtype(len(vals_from)))
+        sfrom                  = vals_from[order]
+        sto                    = vals_to  [order]
+
+        if len(order) == 0:
+            pair_starts = np.zeros(0, dtype=np.int64)
+        else:
+            change      = np.empty(len(order), dtype=np.bool_)
+            change[0]   = True
+            change[1:]  = (sfrom[1:] != sfrom[:-1]) | (sto[1:] != sto[:-1])
+            pair_starts = np.flatnonzero(change)
+
+        inner         = CsrIndex(sto[pair_starts], np.append(pair_starts, len(order)).astype(np.int64), order, labels=labels_to)
+
+        pfrom         = sfrom[pair_starts]
+        outer_starts  = _runs(pfrom)
+        outer         = CsrIndex(pfrom[outer_starts], np.append(outer_starts, len(pair_starts)).astype(np.int64), None, labels=labels_from)
+
+        return cls(outer, inner)
+
+    def __len__(self):
+        return len(self.outer)
+
+    def __contains__(self, key):
+        return key in self.outer
+
+    def __getitem__(self, key):
+        pos = self.outer._pos(key)
+        if pos is None:
+            raise KeyError(key)
+        return self._sub(pos)
+
+    def _sub(self, pos):
+        start = self.outer.offsets[pos  ]
+        end   = self.outer.offsets[pos+1]
+        inner = self.inner
+        return CsrIndex(inner.keys_arr[start:end], inner.offsets[start:end+1], inner.rows, labels=inner.labels)
+
+    def get(self, key, default=None):
+        if key not in self.outer:
+            return default
+        return self[key]
+
+    def keys(self):
+        return self.outer.keys()
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def iterkeys(self):
+        return iter(self.keys())
+
+    def values(self):
+        return [ self._sub(p) for p in xrange(len(self)) ]
+
+    def items(self):
+        return zip(self.keys(), self.values())
+
+    def iteritems(self):
+        return iter(self.items())
+
+
+
+class IntervalIndex(object):
+    """
+    Read only mapping of key -> rows whose [start, end] overlaps a region
+    """
+    __slots__ = ('index', 'starts', 'ends', 'max_ends')
+
+    def __init__(self, index, starts, ends, max_ends):
+        #index.rows holds the row ids of every key sorted by start, starts,
+        #ends and max_ends are aligned with it
+        self.index    = index
+        self.starts   = starts
+        self.ends     = ends
+        self.max_ends = max_ends
+
+    @classmethod
+    def build(cls, column, column_start, column_end):
+        vals, labels = _key_values(column)
+        starts       = np.minimum(column_start, column_end)
+        ends         = np.maximum(column_start, column_end)
+        order        = np.lexsort((starts, vals)).astype(_rows_dtype(len(vals)))
+        svals        = vals[order]
+        key_starts   = _runs(svals)
+        offsets      = np.append(key_starts, len(svals)).astype(np.int64)
+
+        starts       = starts[order]
+        ends         = ends  [order]
+        max_ends     = np.empty_like(ends)
+        for pos in xrange(len(key_starts)):
+            np.maximum.accumulate(ends[offsets[pos]:offsets[pos+1]], out=max_ends[offsets[pos]:offsets[pos+1]])
+
+        return cls(CsrIndex(svals[key_starts], offsets, order, labels=labels), starts, ends, max_ends)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def keys(self):
+        return self.index.keys()
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def span(self, key):
+        """
+        (min start, max end) of the rows of key
+        """
+        pos = self.index._pos(key)
+        if pos is None:
+            raise KeyError(key)
+        start = self.index.offsets[pos  ]
+        end   = self.index.offsets[pos+1]
+        return self.starts[start].item(), self.max_ends[end-1].item()
+
+    def query(self, key, beg=None, end=None):
+        """
+        Ascending row ids of the rows of key overlapping [beg, end]. A missing
+        beg or end leaves that side of the region open.
+        """
+        pos = self.index._pos(key)
+        if pos is None:
+            return np.zeros(0, dtype=self.index.rows.dtype)
+
+        start    = self.index.offsets[pos  ]
+        stop     = self.index.offsets[pos+1]
+        if end is not None:
+            stop = start + np.searchsorted(self.starts  [start:stop], end, side='right')
+        if beg is not None:
+            start = start + np.searchsorted(self.max_ends[start:stop], beg, side='left')
+
+        cand = np.arange(start, stop)
+        if beg is not None:
+            cand = cand[self.ends[cand] >= beg]
+
+        return np.sort(self.index.rows[cand])
+
+
+
+class XmapIndexer(object):
+    """
+    Lazy mapping of column name -> CsrIndex. An index is only built the
+    first time it is asked for. interval_cols maps a column to the start and
+    end columns of the interval index intervals() builds over it.
+    """
+    def __init__(self, table, names=None, interval_cols=None):
+        self.table           = table
+        self.names           = list(names or [])
+        self.built           = {}
+        self.interval_cols   = dict(interval_cols or {})
+        self.built_intervals = {}
+
+    def __contains__(self, name):
+        return name in self.table
+
+    def __getitem__(self, name):
+        if name not in self.built:
+            if name not in self.table:
+                raise KeyError(name)
+            with profile_stage("index", rows=len(self.table)):
+                self.built[name] = CsrIndex.build(self.table.column(name))
+        return self.built[name]
+
+    def intervals(self, name):
+        if name not in self.built_intervals:
+            if name not in self.interval_cols:
+                raise KeyError(name)
+            col_start, col_end = self.interval_cols[name]
+            with profile_stage("index", rows=len(self.table)):
+                self.built_intervals[name] = IntervalIndex.build(self.table.column(name), self.table.column(col_start), self.table.column(col_end))
+        return self.built_intervals[name]
+
+    def keys(self):
+        return list(self.names)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+class XmapGroups(object):
+    """
+    Lazy mapping of "<ColA>_<ColB>" -> CsrGroup. A grouping is only built the
+    first time it is asked for.
+    """
+    def __init__(self, table, pairs=None):
+        self.table = table
+        self.pairs = [ list(x) for x in (pairs or []) ]
+        self.built = {}
+
+    def split_name(self, name):
+        for grp_from, grp_to in self.pairs:
+            if grp_from + '_' + grp_to == name:
+                return grp_from, grp_to
+
+        #column names have underscores themselves, try every split point
+        for pos in xrange(1, len(name) - 1):
+            if name[pos] != '_':
+                continue
+            grp_from, grp_to = name[:pos], name[pos+1:]
+            if grp_from in self.table and grp_to in self.table:
+                return grp_from, grp_to
+
+        return None
+
+    def __contains__(self, name):
+        return self.split_name(name) is not None
+
+    def __getitem__(self, name):
+        if name not in self.built:
+            cols = self.split_name(name)
+            if cols is None:
+                raise KeyError(name)
+            grp_from, grp_to = cols
+            with profile_stage("index", rows=len(self.table)):
+                self.built[name] = CsrGroup.build(self.table.column(grp_from), self.table.column(grp_to))
+        return self.built[name]
+
+    def keys(self):
+        return [ x[0] + '_' + x[1] for x in self.pairs ]
+
+    def __iter__(self):
+        return iter(self.keys())
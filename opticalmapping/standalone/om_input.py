@@ -0,0 +1,309 @@
+import bz2
+import zlib
+import struct
+import collections
+
+"""
+Input side of the tools.
+
+open_input opens a file for reading, telling gzip, BGZF (block gzip, as
+written by bgzip) and bzip2 apart from plain text by their magic bytes.
+Compressed files are decompressed on the fly, nothing is written to disk.
+BGZF blocks are independent of each other, so they are inflated by a pool
+of threads while the caller parses the text inflated before them, and
+BgzfIndexReader reads single records of a file written with an index by
+om_io.BgzfIndexWriter.
+"""
+
+gzip_magic        = "\x1f\x8b"
+bzip2_magic       = "BZh"
+
+read_chunk_size   = 1 << 20
+bgzf_batch_blocks = 64
+
+
+
+def detect_compression(path):
+    """
+    None, 'gzip', 'bgzip' or 'bzip2', from the first bytes of path
+    """
+    with open(path, 'rb') as fhd:
+        head = fhd.read(18)
+
+    if head[:2] == gzip_magic:
+        #FEXTRA flag and a "BC" subfield as the first extra field
+        if len(head) >= 18 and ord(head[3]) & 4 and head[12:14] == "BC":
+            return 'bgzip'
+        return 'gzip'
+
+    if head[:3] == bzip2_magic:
+        return 'bzip2'
+
+    return None
+
+def gzip_chunks(fhd, chunk_size=read_chunk_size):
+    """
+    Inflated data of a gzip file, members one after the other
+    """
+    decomp = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    while True:
+        raw = fhd.read(chunk_size)
+        if len(raw) == 0:
+            break
+
+        while len(raw) > 0:
+            data = decomp.decompress(raw)
+            if len(data) > 0:
+                yield data
+
+            raw = decomp.unused_data
+            if len(raw) > 0:
+                #end of a member, the next one starts in unused_data
+                decomp = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    data = decomp.flush()
+    if len(data) > 0:
+        yield data
+
+def bzip2_chunks(fhd, chunk_size=read_chunk_size):
+    """
+    Decompressed data of a bzip2 file, streams one after the other as
+    written by pbzip2
+    """
+    decomp = bz2.BZ2Decompressor()
+    while True:
+        raw = fhd.read(chunk_size)
+        if len(raw) == 0:
+            break
+
+        while len(raw) > 0:
+            try:
+                data = decomp.decompress(raw)
+            except EOFError:
+                #end of a stream, the next one starts in raw
+                decomp = bz2.BZ2Decompressor()
+                continue
+
+            if len(data) > 0:
+                yield data
+
+            raw = decomp.unused_data
+            if len(raw) > 0:
+                decomp = bz2.BZ2Decompressor()
+
+def read_bgzf_blocks(fhd, num_blocks):
+    """
+    Up to num_blocks raw BGZF blocks, as a list of strings
+    """
+    blocks = []
+    while len(blocks) < num_blocks:
+        header = fhd.read(18)
+        if len(header) == 0:
+            break
+
+        if len(header) < 18 or header[:2] != gzip_magic or header[12:14] != "BC":
+            raise IOError("not a BGZF block at offset %d" % (fhd.tell() - len(header)))
+
+        block_size = struct.unpack('<H', header[16:18])[0] + 1
+        body       = fhd.read(block_size - 18)
+        if len(body) != block_size - 18:
+            raise IOError("truncated BGZF block")
+
+        blocks.append(header + body)
+    return blocks
+
+def inflate_bgzf_blocks(blocks):
+    """
+    Inflated text of a list of raw BGZF blocks
+    """
+    data = []
+    for block in blocks:
+        xlen = struct.unpack('<H', block[10:12])[0]
+        data.append(zlib.decompress(block[12 + xlen:-8], -15))
+    return "".join(data)
+
+def bgzf_chunks(fhd, threads=2, batch_blocks=bgzf_batch_blocks):
+    """
+    Inflated data of a BGZF file. Batches of batch_blocks blocks are
+    inflated by a pool of threads, a few batches ahead of the caller.
+    """
+    from multiprocessing.pool import ThreadPool
+
+    pool    = ThreadPool(threads)
+    pending = collections.deque()
+    try:
+        while True:
+            while len(pending) < threads * 2:
+                blocks = read_bgzf_blocks(fhd, batch_blocks)
+                if len(blocks) == 0:
+                    break
+                pending.append(pool.apply_async(inflate_bgzf_blocks, (blocks,)))
+
+            if len(pending) == 0:
+                break
+
+            data = pending.popleft().get()
+            if len(data) > 0:
+                yield data
+    finally:
+        pool.terminate()
+
+def iter_lines(chunks):
+    """
+    Lines, "\\n" included, of a sequence of strings
+    """
+    rest = ""
+    for chunk in chunks:
+        lines = chunk.split("\n")
+        if len(rest) > 0:
+            lines[0] = rest + lines[0]
+        rest = lines.pop()
+        for line in lines:
+            yield line + "\n"
+
+    if len(rest) > 0:
+        yield rest
+
+class DecompressedInput(object):
+    """
+    Read only, line iterable file object over a compressed file
+    """
+    def __init__(self, path, compression, threads=2):
+        self.name        = path
+        self.compression = compression
+        self.fhd         = open(path, 'rb')
+
+        if   compression == 'gzip':
+            self.chunks = gzip_chunks(self.fhd)
+        elif compression == 'bgzip':
+            self.chunks = bgzf_chunks(self.fhd, threads=threads)
+        elif compression == 'bzip2':
+            self.chunks = bzip2_chunks(self.fhd)
+        else:
+            raise ValueError("unknown compression %s" % compression)
+
+        self.lines = iter_lines(self.chunks)
+
+    def __iter__(self):
+        return self.lines
+
+    def next(self):
+        return next(self.lines)
+
+    def readline(self):
+        return next(self.lines, "")
+
+    def read(self):
+        return "".join(self.lines)
+
+    def close(self):
+        self.chunks.close()
+        self.fhd.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+def read_chunks(path, chunk_size=read_chunk_size, threads=2):
+    """
+    Text of path in pieces of about chunk_size bytes, decompressed as
+    open_input does. Pieces do not end at line breaks.
+    """
+    compression = detect_compression(path)
+    if compression is None:
+        with open(path, 'rb') as fhd:
+            while True:
+                data = fhd.read(chunk_size)
+                if len(data) == 0:
+                    break
+                yield data
+        return
+
+    with DecompressedInput(path, compression, threads=threads) as fhd:
+        for data in fhd.chunks:
+            yield data
+
+def open_input(path, threads=2):
+    """
+    Opens path for reading as text, decompressing gzip, BGZF and bzip2
+    files on the fly. Plain files are opened as they are.
+    """
+    compression = detect_compression(path)
+    if compression is None:
+        return open(path, 'r')
+    return DecompressedInput(path, compression, threads=threads)
+
+
+
+class BgzfIndexReader(object):
+    """
+    Region lookup on a BGZF file indexed by om_io.BgzfIndexWriter. Only the
+    blocks holding the records found are read and inflated.
+    """
+    def __init__(self, path, index_path=None):
+        from om_cache import read_arrays, source_stamp, intervals_from_arrays
+        from om_io    import index_ext, index_version
+
+        if index_path is None:
+            index_path = path + index_ext
+
+        info, arrays = read_arrays(index_path)
+        if info is None or info.get('version') != index_version:
+            raise IOError("%s is not an index" % index_path)
+
+        if info['source'] != source_stamp(path):
+            raise IOError("index %s is older than %s" % (index_path, path))
+
+        self.path        = path
+        self.names       = info['names']
+        self.seq_ids     = dict([ (n, p) for p, n in enumerate(self.names) ])
+        self.intervals   = intervals_from_arrays('itv', arrays, info['labels'])
+        self.voffsets    = arrays['voffsets']
+        self.voff_end    = arrays['voff_end']
+        self.fhd         = open(path, 'rb')
+        self.block_cache = None
+        self.blocks_read = 0
+
+    def block(self, coffset):
+        """
+        (inflated text, offset of the next block) of the block at coffset
+        """
+        if self.block_cache is None or self.block_cache[0] != coffset:
+            self.fhd.seek(coffset)
+            blocks           = read_bgzf_blocks(self.fhd, 1)
+            self.block_cache = ( coffset, inflate_bgzf_blocks(blocks), self.fhd.tell() )
+            self.blocks_read += 1
+        return self.block_cache[1:]
+
+    def record(self, pos):
+        start  = int(self.voffsets[pos])
+        stop   = int(self.voff_end[pos])
+        coff   = start >> 16
+        parts  = []
+        while True:
+            data, next_coff = self.block(coff)
+            if coff == stop >> 16:
+                parts.append(data[:stop & 0xffff])
+                break
+            parts.append(data)
+            coff = next_coff
+        return "".join(parts)[start & 0xffff:]
+
+    def query(self, seq_name, beg=None, end=None):
+        """
+        Text of the records of seq_name overlapping [beg, end], in file order
+        """
+        if seq_name not in self.seq_ids:
+            return []
+        return [ self.record(pos) for pos in self.intervals.query(self.seq_ids[seq_name], beg, end).tolist() ]
+
+    def close(self):
+        self.fhd.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,324 @@
+import os
+import gzip
+import zlib
+import struct
+
+import numpy as np
+
+from om_table   import StringColumn, CategoryColumn
+from om_profile import profile_stage
+
+"""
+Output side of the tools.
+
+FormatPlan turns the columns of a XmapTable into text a batch of rows at a
+time: every column is unboxed and formatted in one go and the rows are
+joined with a single join per batch. BufferedWriter collects the pieces
+and hands them to the file in large writes, and open_output writes plain,
+gzip or BGZF (block gzip, as written by bgzip) files. BgzfIndexWriter
+adds a region index of the records written, read back by
+om_input.BgzfIndexReader.
+"""
+
+compress_exts   = {
+    None   : "",
+    'gzip' : ".gz",
+    'bgzip': ".gz",
+}
+
+write_buffer_size = 1 << 20
+
+
+
+format_plans    = {}
+
+
+
+def format_str(vals):
+    return map(str, vals)
+
+def get_format_plan(names, sep="\t", end="\n"):
+    """
+    FormatPlan of names, compiled once per schema
+    """
+    key = ( tuple(names), sep, end )
+    if key not in format_plans:
+        format_plans[key] = FormatPlan(names, sep=sep, end=end)
+    return format_plans[key]
+
+class FormatPlan(object):
+    """
+    Per schema plan to render the columns in names as text, str() of every
+    value, joined by sep and ended by end. The formatter of a column is
+    chosen once, from its storage, the first time it is rendered.
+    """
+    def __init__(self, names, sep="\t", end="\n", chunk_rows=20000):
+        self.names      = list(names)
+        self.sep        = sep
+        self.end        = end
+        self.chunk_rows = chunk_rows
+        self.formatters = {}
+
+    def formatter(self, column):
+        if isinstance(column, CategoryColumn):
+            #the labels are the column's own, every table numbers them in the order they were met
+            def category_text(column, rows):
+                labels = [ str(x) for x in column.categories ]
+                return [ labels[x] for x in column.codes[rows].tolist() ]
+            return category_text
+
+        if isinstance(column, StringColumn):
+            return lambda column, rows: column.tolist(rows)
+
+        return lambda column, rows: format_str(column[rows].tolist())
+
+    def column_text(self, table, name, rows):
+        column = table.column(name)
+        key    = ( name, type(column), getattr(column, 'dtype', None) )
+        if key not in self.formatters:
+            self.formatters[key] = self.formatter(column)
+        return self.formatters[key](column, rows)
+
+    def lines(self, table, rows):
+        """
+        List with the text of every row in rows, end included
+        """
+        cols = [ self.column_text(table, name, rows) for name in self.names ]
+        return [ self.sep.join(x) + self.end for x in zip(*cols) ]
+
+    def render(self, table, rows=None):
+        """
+        Yields the text of rows (default all) chunk_rows rows at a time
+        """
+        if rows is None:
+            rows = np.arange(len(table), dtype=np.int64)
+        else:
+            rows = np.asarray(rows, dtype=np.int64)
+
+        for chunk_start in xrange(0, len(rows), self.chunk_rows):
+            chunk = rows[chunk_start:chunk_start+self.chunk_rows]
+            cols  = [ self.column_text(table, name, chunk) for name in self.names ]
+            yield self.end.join([ self.sep.join(x) for x in zip(*cols) ]) + self.end
+
+    def write(self, fhd, table, rows=None):
+        num   = len(table) if rows is None else len(rows)
+        texts = self.render(table, rows=rows)
+        for chunk_start in xrange(0, num, self.chunk_rows):
+            with profile_stage("render", rows=min(self.chunk_rows, num - chunk_start)):
+                text = next(texts)
+            fhd.write(text)
+
+
+
+class BufferedWriter(object):
+    """
+    Collects writes and passes them on to fhd in writes of about
+    buffer_size bytes
+    """
+    def __init__(self, fhd, buffer_size=write_buffer_size):
+        self.fhd         = fhd
+        self.buffer_size = buffer_size
+        self.parts       = []
+        self.size        = 0
+
+    def write(self, text):
+        self.parts.append(text)
+        self.size += len(text)
+        if self.size >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.parts) > 0:
+            with profile_stage("write", rows=self.size, unit="bytes"):
+                self.fhd.write("".join(self.parts))
+            self.parts = []
+            self.size  = 0
+
+    def write_record(self, seq_name, beg, end, text):
+        self.write(text)
+
+    def close(self):
+        self.flush()
+        self.fhd.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+
+bgzf_block_size = 0xff00
+bgzf_eof        = "\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00"
+
+class BgzfWriter(object):
+    """
+    BGZF writer: a series of gzip members of at most 64 KiB of data each,
+    with the compressed size of the member in a "BC" extra field, so that
+    readers can seek to any member. tell() gives the virtual offset of the
+    next byte: (file offset of its block << 16) | offset inside the block.
+    """
+    def __init__(self, fhd, level=6):
+        self.fhd    = fhd
+        self.level  = level
+        self.parts  = []
+        self.size   = 0
+        self.offset = 0
+
+    def write(self, data):
+        self.parts.append(data)
+        self.size += len(data)
+        if self.size >= bgzf_block_size:
+            data       = "".join(self.parts)
+            self.parts = []
+            self.size  = 0
+            pos        = 0
+            while len(data) - pos >= bgzf_block_size:
+                self.write_block(data[pos:pos+bgzf_block_size])
+                pos   += bgzf_block_size
+            if pos < len(data):
+                self.parts.append(data[pos:])
+                self.size = len(data) - pos
+
+    def write_block(self, data):
+        with profile_stage("write", rows=len(data), unit="bytes"):
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+            deflated   = compressor.compress(data) + compressor.flush()
+            block_size = 18 + len(deflated) + 8
+            self.fhd.write( struct.pack('<4BI2BH2BHH', 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, ord('B'), ord('C'), 2, block_size - 1) )
+            self.fhd.write( deflated )
+            self.fhd.write( struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data)) )
+        self.offset += block_size
+
+    def flush_block(self):
+        """
+        Ends the current block, so the next write starts a new one
+        """
+        if self.size > 0:
+            self.write_block("".join(self.parts))
+            self.parts = []
+            self.size  = 0
+
+    def tell(self):
+        return ( self.offset << 16 ) | self.size
+
+    def flush(self):
+        self.flush_block()
+        self.fhd.flush()
+
+    def close(self):
+        self.flush_block()
+        self.fhd.write(bgzf_eof)
+        self.fhd.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+
+index_ext       = ".omi"
+index_version   = 1
+
+class BgzfIndexWriter(object):
+    """
+    BGZF writer that indexes the records given to write_record by sequence
+    and [beg, end]. A record is kept inside a single block whenever it fits
+    in one, so that reading it back takes a single block read. The index is
+    written to path + index_ext on close.
+    """
+    def __init__(self, path, level=6):
+        self.path     = path
+        self.bgzf     = BgzfWriter(open(path, 'wb'), level=level)
+        self.seq_ids  = {}
+        self.seqs     = []
+        self.begs     = []
+        self.ends     = []
+        self.voffsets = []
+        self.voff_end = []
+
+    def write(self, text):
+        self.bgzf.write(text)
+
+    def write_record(self, seq_name, beg, end, text):
+        bgzf = self.bgzf
+        if bgzf.size > 0 and bgzf.size + len(text) > bgzf_block_size:
+            bgzf.flush_block()
+
+        if seq_name not in self.seq_ids:
+            self.seq_ids[seq_name] = len(self.seq_ids)
+
+        self.seqs    .append(self.seq_ids[seq_name])
+        self.begs    .append(beg)
+        self.ends    .append(end)
+        self.voffsets.append(bgzf.tell())
+        bgzf.write(text)
+        self.voff_end.append(bgzf.tell())
+
+    def close(self):
+        from om_cache import write_arrays, source_stamp, intervals_to_arrays
+        from om_index import IntervalIndex
+
+        self.bgzf.close()
+
+        names     = sorted(self.seq_ids, key=self.seq_ids.get)
+        intervals = IntervalIndex.build(np.array(self.seqs, dtype=np.int32), np.array(self.begs, dtype=np.int64), np.array(self.ends, dtype=np.int64))
+        arrays    = {
+            'voffsets': np.array(self.voffsets, dtype=np.uint64),
+            'voff_end': np.array(self.voff_end, dtype=np.uint64)
+        }
+        info      = {
+            'version': index_version,
+            'source' : source_stamp(self.path),
+            'names'  : names,
+            'labels' : intervals_to_arrays(intervals, 'itv', arrays)
+        }
+        write_arrays(self.path + index_ext, info, arrays)
+
+    def abort(self):
+        """
+        Closes the BGZF stream of a write that failed without indexing it,
+        and removes the index of an earlier run, so that om_query does not
+        take the file for a complete one
+        """
+        self.bgzf.close()
+        if os.path.exists(self.path + index_ext):
+            os.remove(self.path + index_ext)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+
+
+def output_name(path, compress=None):
+    return path + compress_exts[compress]
+
+def open_output(path, compress=None, buffer_size=write_buffer_size, index=False):
+    """
+    Opens path for writing, gzip or BGZF compressed if asked for, behind a
+    BufferedWriter. With index=True the file is BGZF compressed and indexed
+    by BgzfIndexWriter.
+    """
+    if index:
+        if compress not in (None, 'bgzip'):
+            raise ValueError("only bgzip output can be indexed")
+        return BgzfIndexWriter(path)
+
+    if   compress is None:
+        fhd = open(path, 'wb')
+    elif compress == 'gzip':
+        fhd = gzip.open(path, 'wb')
+    elif compress == 'bgzip':
+        fhd = BgzfWriter(open(path, 'wb'))
+    else:
+        raise ValueError("unknown compression %s" % compress)
+    return BufferedWriter(fhd, buffer_size=buffer_size)
@@ -0,0 +1,306 @@
+#!/usr/bin/python
+
+import os
+import sys
+
+from om_shared import *
+
+
+"""
+Lifts XMAP / augmented XMAP alignments or GFF3 features between the objects
+(eg. SL2.50ch chromosomes) and the components (eg. SL2.40sc scaffolds) of an
+AGP file.
+
+    om_liftover.py SL2.50ch_from_sc.agp in.xmap                      #scaffolds to chromosomes
+    om_liftover.py SL2.50ch_from_sc.agp in.gff3 --to-component       #chromosomes to scaffolds
+
+XMAP RefContigID N is the Nth name of --names, or of the sequences of the
+AGP in the order they first appear. The lifted RefContigID is the position
++ 1 of the new sequence in --target-names, or in the AGP. RefStartPos,
+RefEndPos and RefLen are lifted; alignments landing on a - component have
+their Orientation flipped and QryStartPos/QryEndPos swapped. HitEnum and
+Alignment are kept as they are, relative to the labels of the old reference.
+
+GFF3 features are lifted line by line, flipping the strand on - components.
+Parents and children are lifted independently of each other.
+
+Features that cannot be lifted (in a gap, across components or gaps, outside
+the AGP or on an unknown sequence) are written to <outfile>.unlifted.tsv with
+the reason in front of the original line.
+"""
+
+gff_batch_lines = 100000
+gff_exts        = ('.gff', '.gff3', '.gff.gz', '.gff3.gz', '.gff.bgz', '.gff3.bgz', '.gff.bz2', '.gff3.bz2')
+flip_strand     = { '+': '-', '-': '+' }
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description="AGP liftover of Bionano Genomics MAP and GFF3 files")
+    parser.add_argument( 'agp'   ,                                                  help="AGP file"                                              )
+    parser.add_argument( 'infile',                                                  help="MAP, AUGMENTED or GFF3 file"                           )
+    parser.add_argument( '-c'    , '--to-component'           , action='store_true', help="Lift from the objects (chromosomes) to the components (scaffolds) instead of the other way round" )
+    parser.add_argument( '-g'    , '--gff'                    , action='store_true', help="infile is GFF3 [default: from the extension]"         )
+    parser.add_argument( '-n'    , '--names'                  , action='store'    , help="Names of the reference sequences of the MAP. Eg: Ch0|Ch1|Ch3 Ch0,Ch1,Ch2 Ch0:Ch1:Ch2 [default: AGP order]" )
+    parser.add_argument( '-N'    , '--names-from-file'        , action='store'    , help="File containing names of the reference sequences of the MAP. One per line" )
+    parser.add_argument( '-t'    , '--target-names'           , action='store'    , help="Names of the lifted reference sequences, giving the new RefContigID [default: AGP order]" )
+    parser.add_argument( '-T'    , '--target-names-from-file' , action='store'    , help="File containing names of the lifted reference sequences. One per line" )
+    parser.add_argument( '-s'    , '--sep'  , '--separator'   , default=","       , help="Separator for names. Eg: | , :"                        )
+    parser.add_argument( '-C'    , '--cache'                  , action='store_true', help="Keep a binary parse cache next to the MAP file and reuse it" )
+    parser.add_argument( '-o'    , '--output'                 , action='store'    , help="Output file [default: <infile>.lifted.xmap or <infile>.lifted.gff3]" )
+    parser.add_argument( '-Z'    , '--compress'               , choices=['gzip', 'bgzip'], help="Write the output gzip or bgzip compressed"     )
+    add_profile_args(parser)
+
+    args    = parser.parse_args(args=args)
+
+    args.names        = read_names(args.names       , args.names_from_file       , args.sep)
+    args.target_names = read_names(args.target_names, args.target_names_from_file, args.sep)
+
+    if not args.gff:
+        args.gff = args.infile.lower().endswith(gff_exts)
+
+    return args
+
+def read_names(names, names_from_file, sep):
+    if names_from_file is not None:
+        if not os.path.exists(names_from_file):
+            print "names file %s does not exists" % names_from_file
+            sys.exit(1)
+
+        names = []
+        with open(names_from_file, 'r') as fhd:
+            for line in fhd:
+                line = line.strip()
+
+                if len(line) == 0:
+                    continue
+
+                if line[0] == "#":
+                    continue
+
+                names.append(line)
+        return names
+
+    if names is not None:
+        return names.split( sep )
+
+    return None
+
+def write_unlifted(fhd, status, lines):
+    from om_agp import status_names
+
+    for code, line in zip(status, lines):
+        fhd.write( status_names[code] + "\t" + line )
+
+class lines_writer(object):
+    """
+    File like object collecting what is written to it in a list
+    """
+    def __init__(self, lines):
+        self.lines = lines
+
+    def write(self, text):
+        self.lines.append(text)
+
+def lift_xmap(agp, data, to_object=True, names=None, target_names=None):
+    """
+    (lifted table, rows not lifted, their status) of a XmapTable
+    """
+    from om_agp    import LIFT_OK, LIFT_UNKNOWN
+    from om_table  import CategoryColumn
+
+    if names is None:
+        names        = agp.target_names(not to_object)
+    if target_names is None:
+        target_names = agp.target_names(to_object)
+
+    codes            = agp.source_codes(to_object)
+    #RefContigID -> AGP code of its name, -1 if not in the AGP
+    id_codes         = np.array([ -1 ] + [ codes.get(x, -1) for x in names ], dtype=np.int64)
+    #AGP code -> lifted RefContigID, 0 if not in target_names
+    target_ids       = dict([ (n, p + 1) for p, n in enumerate(target_names) ])
+    code_ids         = np.array([ target_ids.get(x, 0) for x in agp.target_names(to_object) ] + [ 0 ], dtype=np.int64)
+
+    ref_ids          = np.asarray(data.column("RefContigID"), dtype=np.int64)
+    ref_ids          = np.where(( ref_ids > 0 ) & ( ref_ids < len(id_codes) ), ref_ids, 0)
+
+    seqs, begs, ends, strands, status = agp.lift(id_codes[ref_ids], data.column("RefStartPos"), data.column("RefEndPos"), to_object=to_object)
+
+    new_ids          = code_ids[seqs]
+    status[( status == LIFT_OK ) & ( new_ids == 0 )] = LIFT_UNKNOWN
+
+    rows             = np.flatnonzero(status == LIFT_OK)
+    failed           = np.flatnonzero(status != LIFT_OK)
+
+    lifted           = data.take(rows)
+    flipped          = strands[rows] < 0
+    lengths          = agp.target_lengths(to_object)
+
+    lifted.set_column("RefContigID", new_ids[rows].astype(np.int32))
+    lifted.set_column("RefStartPos", begs[rows].astype(np.float64))
+    lifted.set_column("RefEndPos"  , ends[rows].astype(np.float64))
+    lifted.set_column("RefLen"     , lengths[seqs[rows]].astype(np.float64))
+
+    if flipped.any():
+        qry_starts   = lifted.column("QryStartPos")
+        qry_ends     = lifted.column("QryEndPos"  )
+        lifted.set_column("QryStartPos", np.where(flipped, qry_ends  , qry_starts))
+        lifted.set_column("QryEndPos"  , np.where(flipped, qry_starts, qry_ends  ))
+
+        orientation  = lifted.column("Orientation")
+        categories   = list(orientation.categories)
+        categories  += [ x for x in sorted(flip_strand) if x not in categories ]
+        flip_codes   = np.array([ categories.index(flip_strand.get(x, x)) for x in categories ], dtype=orientation.codes.dtype)
+        lifted.set_column("Orientation", CategoryColumn(np.where(flipped, flip_codes[orientation.codes], orientation.codes).astype(orientation.codes.dtype), categories))
+
+    return lifted, failed, status[failed]
+
+def liftover_xmap(args, agp, oufile, unfile):
+    from om_io import open_output
+
+    valid_fields        = gen_valid_fields(valid_fields_g)
+
+    data, headers, names, seman, types, indexer, groups, ref_maps_from, query_maps_from, filters_csv = parse_file(args.infile, valid_fields, cache=args.cache)
+
+    print "NAMES"  , names
+    print "TYPES"  , types
+
+    to_object           = not args.to_component
+    with profile_stage("lift", rows=len(data)):
+        lifted, failed, status = lift_xmap(agp, data, to_object=to_object, names=args.names, target_names=args.target_names)
+
+    note                = "# Lifted Over:          %s %s" % (args.agp, "to objects" if to_object else "to components")
+
+    print "CREATING LIFTED MAP:", oufile
+    with open_output(oufile, args.compress) as fhd:
+        fhd.write( "\n".join(headers[:-2] + [ note ] + headers[-2:]) + "\n" )
+        write_rows(fhd, lifted, names)
+
+    with open_output(unfile, args.compress) as fhd:
+        fhd.write( "#reason\t" + headers[-2][3:] + "\n" )
+        lines           = []
+        write_rows(lines_writer(lines), data, names, rows=failed)
+        write_unlifted(fhd, status, "".join(lines).splitlines(True))
+
+    print "lifted %d of %d alignments" % (len(lifted), len(data))
+
+def lift_gff_batch(agp, batch, to_object=True):
+    """
+    (lifted lines, status, lines not lifted) of a list of GFF3 feature lines
+    """
+    from om_agp import LIFT_OK
+
+    #only the columns up to the strand are split, the rest is kept as it is
+    cols             = [ line.split("\t", 7) for line in batch ]
+    seqs, begs, ends, strands, status = agp.lift(np.array([ x[0] for x in cols ]), [ int(x[3]) for x in cols ], [ int(x[4]) for x in cols ], to_object=to_object)
+
+    names            = agp.target_names(to_object)
+    rows             = np.flatnonzero(status == LIFT_OK)
+    seq_names        = [ names[x] for x in seqs[rows].tolist() ]
+    flipped          = ( strands[rows] < 0 ).tolist()
+    lifted           = [
+        "%s\t%s\t%s\t%d\t%d\t%s\t%s\t%s" % ( name, col[1], col[2], beg, end, col[5], flip_strand.get(col[6], col[6]) if flip else col[6], col[7] )
+        for name, col, beg, end, flip in zip(seq_names, [ cols[x] for x in rows.tolist() ], begs[rows].tolist(), ends[rows].tolist(), flipped)
+    ]
+
+    failed           = np.flatnonzero(status != LIFT_OK)
+    return lifted, status[failed], [ batch[x] for x in failed.tolist() ]
+
+def liftover_gff(args, agp, oufile, unfile):
+    from om_io    import open_output
+    from om_input import open_input
+
+    to_object           = not args.to_component
+    counts              = [ 0, 0 ]
+
+    def write_batch(fhd, fhu, batch):
+        with profile_stage("lift", rows=len(batch)):
+            lifted, status, failed = lift_gff_batch(agp, batch, to_object=to_object)
+        fhd.write( "".join(lifted) )
+        write_unlifted(fhu, status, failed)
+        counts[0] += len(batch)
+        counts[1] += len(lifted)
+
+    print "CREATING LIFTED GFF:", oufile
+    with open_input(args.infile) as fhi:
+        with open_output(oufile, args.compress) as fhd:
+            with open_output(unfile, args.compress) as fhu:
+                fhu.write( "#reason\tgff line\n" )
+
+                batch = []
+                for line in fhi:
+                    if line[0] == "#" or len(line.strip()) == 0:
+                        if line.startswith("##FASTA"):
+                            break
+
+                        #the regions of the old sequences do not hold any more
+                        if line.startswith("##sequence-region"):
+                            continue
+
+                        #comments stay where they were among the features
+                        if len(batch) > 0:
+                            write_batch(fhd, fhu, batch)
+                            batch = []
+
+                        fhd.write( line )
+                        continue
+
+                    if line[-1] != "\n":
+                        line += "\n"
+
+                    batch.append(line)
+                    if len(batch) == gff_batch_lines:
+                        write_batch(fhd, fhu, batch)
+                        batch = []
+
+                if len(batch) > 0:
+                    write_batch(fhd, fhu, batch)
+
+    print "lifted %d of %d features" % (counts[1], counts[0])
+
+def main(args):
+    from om_agp import AgpMap
+    from om_io  import output_name
+
+    for path in (args.agp, args.infile):
+        if not os.path.exists(path):
+            print "input file %s does not exists" % path
+            sys.exit(1)
+
+        if os.path.isdir(path):
+            print "input file %s is a folder" % path
+            sys.exit(1)
+
+    if args.output is None:
+        base            = args.infile + (".lifted.gff3" if args.gff else ".lifted.xmap")
+        oufile          = output_name(base, args.compress)
+    else:
+        base            = args.output
+        oufile          = args.output
+
+    unfile              = output_name(base + ".unlifted.tsv", args.compress)
+
+    print "saving to %s" % oufile
+    profile_output(oufile)
+
+    print "LOADING AGP", args.agp
+    with profile_stage("agp") as stage:
+        agp             = AgpMap.load(args.agp)
+        stage.rows      = len(agp)
+    print "AGP has %d lines, %d objects and %d components" % (len(agp), len(agp.object_names), len(agp.component_names))
+
+    if args.gff:
+        liftover_gff(args, agp, oufile, unfile)
+    else:
+        liftover_xmap(args, agp, oufile, unfile)
+
+
+
+if __name__ == '__main__':
+    if len(sys.argv) ==1:
+        print "no arguments given"
+        sys.exit(1)
+
+    args         = parse_args(sys.argv[1:])
+
+    with profile_run("om_liftover", args):
+        main(args)
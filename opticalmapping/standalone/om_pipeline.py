@@ -0,0 +1,155 @@
+#!/usr/bin/python
+
+import os
+import sys
+
+from om_shared import *
+
+
+"""
+om_augmenter, om_filter and om_to_gff / om_to_delta in a single run.
+
+The XMAP is parsed once and every step works on the table left in memory
+by the step before. Each table is brought to the types and precision the
+next tool would have read back from the intermediate TSV, and the TSV
+headers are rebuilt the same way, so the files written are the same as
+the ones of the chained tools.
+"""
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description="Bionano Genomics MAP augmenter, filter and GFF/Delta converter in a single run")
+    parser.add_argument( 'infile',                                                  help="MAP file"                                               )
+    parser.add_argument( '-f'    , '--filter'                 , action='append'   , help="Filters [Field:Function(%s):Value], as in om_filter" % ", ".join(sorted(valid_operators.keys())))
+    parser.add_argument( '-g'    , '--gff'                    , action='store_true', help="Write GFF3"                                            )
+    parser.add_argument( '-d'    , '--delta'                  , action='store_true', help="Write Mummerplot Delta"                                )
+    parser.add_argument( '-L'    , '--delta-labels'           , action='store_true', help="Write the Delta as the aligned segments of the label pairs, as om_to_delta --labels" )
+    parser.add_argument( '-t'    , '--tsv'                    , action='store_true', help="Also write the intermediate .augmented.tsv and .report.tsv files" )
+    parser.add_argument( '-x'    , '--exclude-cols'           , action='store'    , help="Exclude column from GFF"                               )
+    parser.add_argument( '-z'    , '--exclude-cols-from-file' , action='store'    , help="File containing names of columns to exclude from GFF"  )
+    parser.add_argument( '-n'    , '--names'                  , action='store'    , help="Names of reference chromosome. Eg: Ch0|Ch1|Ch3 Ch0,Ch1,Ch2 Ch0:Ch1:Ch2" )
+    parser.add_argument( '-N'    , '--names-from-file'        , action='store'    , help="File containing names of reference chromosome. One per line" )
+    parser.add_argument( '-s'    , '--sep'  , '--separator'   , default=","       , help="Separator for chromosome names. Eg: | , :"             )
+    parser.add_argument( '-r'    , '--reference'              , action='store'    , help="reference fasfa file for the Delta header and lengths"  )
+    parser.add_argument( '-q'    , '--query'                  , action='store'    , help="query fasfa file for the Delta header and lengths"      )
+    parser.add_argument( '-C'    , '--cache'                  , action='store_true', help="Keep a binary parse cache next to the input file and reuse it" )
+    parser.add_argument( '-Z'    , '--compress'               , choices=['gzip', 'bgzip'], help="Write the output files gzip or bgzip compressed" )
+    parser.add_argument( '-I'    , '--index'                  , action='store_true', help="Write the GFF bgzip compressed with a region index (.omi) for om_query" )
+    add_profile_args(parser)
+
+    args    = parser.parse_args(args=args)
+
+    if not ( args.gff or args.delta or args.tsv ):
+        print "nothing to write. use --gff, --delta and/or --tsv"
+        sys.exit(1)
+
+    if args.gff:
+        import om_to_gff
+        om_to_gff.resolve_names(args)
+
+    if args.delta_labels and not args.delta:
+        print "--delta-labels needs --delta"
+        sys.exit(1)
+
+    if args.index and not args.gff:
+        print "--index needs --gff"
+        sys.exit(1)
+
+    return args
+
+def main(args):
+    from om_index import XmapIndexer, XmapGroups
+    from om_io    import open_output, output_name
+    import om_augmenter
+    import om_filter
+    import om_to_gff
+    import om_to_delta
+
+    valid_fields        = gen_valid_fields(valid_fields_g)
+    infile              = args.infile
+
+    if not os.path.exists(infile):
+        print "input file %s does not exists" % infile
+        sys.exit(1)
+
+    if os.path.isdir(infile):
+        print "input file %s is a folder" % infile
+        sys.exit(1)
+
+    filters             = gen_filter(args.filter, valid_fields)
+
+    augfile             = infile + ".augmented.tsv"
+    repfile             = augfile
+    for filter_data in filters:
+        repfile        += filter_name(filter_data)
+    repfile            += ".report.tsv"
+    profile_output(repfile)
+
+    data, headers, names, seman, types, indexer, groups, ref_maps_from, query_maps_from, filters_csv = parse_file(infile, valid_fields, cache=args.cache)
+
+    print "NAMES"  , names
+    print "TYPES"  , types
+    print "file has %5d maps and %3d chromosomes" % (len(indexer["QryContigID"]), len(indexer["RefContigID"]))
+
+
+    print "AUGMENTING"
+    with profile_stage("augment", rows=len(data)):
+        rows, augmented = om_augmenter.augment(data)
+    augmented_header    = om_augmenter.augmented_header(headers, valid_fields)
+
+    if args.tsv:
+        print "CREATING REPORT:", output_name(augfile, args.compress)
+        with open_output(output_name(augfile, args.compress), args.compress) as reporter:
+            reporter.write( augmented_header )
+            write_rows(reporter, augmented, valid_fields['names'])
+
+    augmented           = as_parsed(augmented, valid_fields)
+    augmented_meta      = parse_header(augmented_header)
+
+
+    print "FILTERING"
+    report              = om_filter.filter_report(augmented, filters)
+    report_header       = om_filter.report_header(augmented_meta['headers'], filters, valid_fields)
+
+    if args.tsv:
+        print "CREATING REPORT:", output_name(repfile, args.compress)
+        with open_output(output_name(repfile, args.compress), args.compress) as reporter:
+            reporter.write( report_header )
+            write_rows(reporter, report, valid_fields['names'])
+
+    report              = as_parsed(report, valid_fields)
+    report_meta         = parse_header(report_header)
+    report_indexer      = XmapIndexer(report, cols_to_index)
+    report_groups       = XmapGroups( report, group_by     )
+
+    print "report has %5d maps and %3d chromosomes" % (len(report_indexer["QryContigID"]), len(report_indexer["RefContigID"]))
+
+
+    if args.gff:
+        gff_compress = 'bgzip' if args.index else args.compress
+        print "CREATING GFF: ", output_name(repfile + ".gff3", gff_compress)
+        with open_output(output_name(repfile + ".gff3", gff_compress), gff_compress, index=args.index) as fhd:
+            om_to_gff.write_gff(fhd, report, report_indexer, report_groups, report_meta['headers'], gen_filter(report_meta['filters'], valid_fields), args.names, args.exclude_cols)
+
+    if args.delta:
+        segments     = None
+        if args.delta_labels:
+            segments = om_to_delta.load_segments(infile, report, report_meta['ref_maps_from'], report_meta['query_maps_from'])
+
+        print "CREATING DELTA: ", output_name(repfile + ".delta", args.compress)
+        with open_output(output_name(repfile + ".delta", args.compress), args.compress) as fhd, profile_stage("render", rows=len(report)):
+            om_to_delta.write_delta(fhd, report, report_groups, report_meta['ref_maps_from'], report_meta['query_maps_from'], reference=args.reference, query=args.query, reference_lengths=om_to_delta.fasta_lengths(args.reference), query_lengths=om_to_delta.fasta_lengths(args.query), segments=segments)
+
+    print
+
+
+
+if __name__ == '__main__':
+    if len(sys.argv) ==1:
+        print "no arguments given"
+        sys.exit(1)
+
+    args         = parse_args(sys.argv[1:])
+
+    with profile_run("om_pipeline", args):
+        main(args)
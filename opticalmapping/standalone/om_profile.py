@@ -0,0 +1,309 @@
+import os
+import sys
+import time
+
+"""
+Per stage timing and memory of a tool run.
+
+The tools mark their stages (parse, index, stats, augment, filter, render,
+write ...) with profile_stage, which costs nothing unless a run was started
+with --profile:
+
+    with profile_stage("augment") as stage:
+        rows, report = augment(data)
+        stage.rows   = len(rows)
+
+For every stage name the calls, wall and CPU time, the wall time spent in
+the stage itself and not in the stages it holds (self_wall), the rows done,
+the throughput and the peak resident memory are added up, and written as
+JSON to <output>.profile.json at the end of the run. A stage entered again
+while it is open, eg. a write inside a write, counts once.
+
+The peak memory of a stage is the high water mark of the process while it
+runs. Linux lets it be reset through /proc/self/clear_refs, elsewhere it is
+the peak of the process so far.
+
+With --cprofile every stage also runs under its own cProfile profile, and
+the stats of the hottest stage (the largest self_wall) are dumped to
+<output>.profile.pstats, for pstats or snakeviz. Timings are then inflated
+by the profiler.
+"""
+
+profile_version = 1
+
+#the Profiler of the run, None unless profiling
+active          = None
+
+
+
+class NullStage(object):
+    """
+    Stands in for a stage when not profiling
+    """
+    rows = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+    def __setattr__(self, name, value):
+        pass
+
+null_stage = NullStage()
+
+class Stage(object):
+    def __init__(self, profiler, name, rows, unit):
+        self.profiler = profiler
+        self.name     = name
+        self.rows     = rows
+        self.unit     = unit
+
+    def __enter__(self):
+        self.profiler.enter(self)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.profiler.leave(self)
+        return False
+
+def cpu_time():
+    #children included, for the stages run in a pool of processes
+    times = os.times()
+    return times[0] + times[1] + times[2] + times[3]
+
+def peak_rss_kb():
+    """
+    High water mark of the resident memory of the process in kb
+    """
+    try:
+        with open("/proc/self/status", 'r') as fhd:
+            for line in fhd:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss //= 1024
+    return rss
+
+def reset_peak_rss():
+    try:
+        with open("/proc/self/clear_refs", 'w') as fhd:
+            fhd.write("5")
+        return True
+    except IOError:
+        return False
+
+class Profiler(object):
+    def __init__(self, tool, cprofile=False):
+        self.tool       = tool
+        self.cprofile   = cprofile
+        self.output     = None
+        self.totals     = {}
+        self.order      = []
+        self.running    = []
+        self.profiles   = {}
+        self.can_reset  = reset_peak_rss()
+        self.start_wall = time.time()
+        self.start_cpu  = cpu_time()
+        self.peak       = peak_rss_kb()
+
+    def stage(self, name, rows=None, unit="rows"):
+        for stage in self.running:
+            if stage.name == name:
+                return null_stage
+        return Stage(self, name, rows, unit)
+
+    def sample(self):
+        #the high water mark so far belongs to every stage open
+        peak      = peak_rss_kb()
+        self.peak = max(self.peak, peak)
+        for stage in self.running:
+            stage.peak = max(stage.peak, peak)
+
+    def enter(self, stage):
+        self.sample()
+        if self.can_reset:
+            reset_peak_rss()
+
+        if self.cprofile:
+            if len(self.running) > 0:
+                self.profiles[self.running[-1].name].disable()
+            if stage.name not in self.profiles:
+                import cProfile
+                self.profiles[stage.name] = cProfile.Profile()
+
+        stage.peak        = peak_rss_kb()
+        stage.child_wall  = 0.0
+        stage.start_cpu   = cpu_time()
+        self.running.append(stage)
+
+        if self.cprofile:
+            self.profiles[stage.name].enable()
+        stage.start_wall  = time.time()
+
+    def leave(self, stage):
+        wall              = time.time() - stage.start_wall
+        if self.cprofile:
+            self.profiles[stage.name].disable()
+
+        cpu               = cpu_time() - stage.start_cpu
+        self.sample()
+        self.running.pop()
+
+        if len(self.running) > 0:
+            self.running[-1].child_wall += wall
+            if self.cprofile:
+                self.profiles[self.running[-1].name].enable()
+
+        if stage.name not in self.totals:
+            self.order.append(stage.name)
+            self.totals[stage.name] = { 'name': stage.name, 'calls': 0, 'wall': 0.0, 'self_wall': 0.0, 'cpu': 0.0, 'rows': None, 'unit': stage.unit, 'peak_rss_kb': 0 }
+
+        total              = self.totals[stage.name]
+        total['calls']    += 1
+        total['wall']     += wall
+        total['self_wall']+= wall - stage.child_wall
+        total['cpu']      += cpu
+        total['peak_rss_kb'] = max(total['peak_rss_kb'], stage.peak)
+        if stage.rows is not None:
+            total['rows']  = ( total['rows'] or 0 ) + int(stage.rows)
+
+    def hottest(self):
+        if len(self.order) == 0:
+            return None
+        return max(self.order, key=lambda x: self.totals[x]['self_wall'])
+
+    def report(self):
+        self.sample()
+        stages = []
+        for name in self.order:
+            total = dict(self.totals[name])
+            total['rows_per_s'] = None
+            if total['rows'] is not None and total['wall'] > 0:
+                total['rows_per_s'] = total['rows'] / total['wall']
+            stages.append(total)
+
+        return {
+            'version'     : profile_version,
+            'tool'        : self.tool,
+            'argv'        : sys.argv,
+            'started'     : time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.start_wall)),
+            'wall'        : time.time() - self.start_wall,
+            'cpu'         : cpu_time() - self.start_cpu,
+            'peak_rss_kb' : self.peak,
+            'stage_peaks' : self.can_reset,
+            'cprofile'    : self.cprofile,
+            'hottest'     : self.hottest(),
+            'stages'      : stages,
+        }
+
+    def finish(self):
+        import json
+
+        base    = self.output if self.output is not None else self.tool
+        outfile = base + ".profile.json"
+        report  = self.report()
+
+        if self.cprofile and report['hottest'] is not None:
+            report['pstats'] = base + ".profile.pstats"
+            self.profiles[report['hottest']].dump_stats(report['pstats'])
+
+        with open(outfile, 'w') as fhd:
+            json.dump(report, fhd, indent=1, sort_keys=True)
+
+        print "PROFILE:", outfile
+        print "%-12s %6s %9s %9s %9s %12s %12s %-6s %9s" % ( "stage", "calls", "wall s", "self s", "cpu s", "rows", "per s", "unit", "peak MB" )
+        for stage in report['stages']:
+            print "%-12s %6d %9.2f %9.2f %9.2f %12s %12s %-6s %9.1f" % ( stage['name'], stage['calls'], stage['wall'], stage['self_wall'], stage['cpu'],
+                "-" if stage['rows'] is None else stage['rows'], "-" if stage['rows_per_s'] is None else "%.0f" % stage['rows_per_s'], stage['unit'], stage['peak_rss_kb'] / 1024.0 )
+        print "%-12s %6s %9.2f %9s %9.2f %12s %12s %-6s %9.1f" % ( "total", "", report['wall'], "", report['cpu'], "", "", "", report['peak_rss_kb'] / 1024.0 )
+
+        if 'pstats' in report:
+            import pstats
+            print "hottest stage %s, cProfile stats in %s" % ( report['hottest'], report['pstats'] )
+            pstats.Stats(report['pstats']).sort_stats('tottime').print_stats(15)
+
+        return outfile
+
+
+
+def profile_stage(name, rows=None, unit="rows"):
+    """
+    Context of a stage of the run, see the module docs
+    """
+    if active is None:
+        return null_stage
+    return active.stage(name, rows=rows, unit=unit)
+
+def profile_iter(name, items, unit="rows"):
+    """
+    Yields items, each next() of it timed as a call of stage name, with
+    len(item) rows
+    """
+    items = iter(items)
+    while True:
+        with profile_stage(name, unit=unit) as stage:
+            try:
+                item = next(items)
+            except StopIteration:
+                return
+            stage.rows = len(item) if hasattr(item, '__len__') else None
+        yield item
+
+def profile_output(path):
+    """
+    Writes the profile of the run next to path. The first output named wins.
+    """
+    if active is not None and active.output is None:
+        active.output = path
+
+def start_profile(tool, cprofile=False):
+    global active
+    active = Profiler(tool, cprofile=cprofile)
+    return active
+
+def finish_profile():
+    global active
+    if active is None:
+        return None
+    profiler, active = active, None
+    return profiler.finish()
+
+def add_profile_args(parser):
+    parser.add_argument( '--profile'  , action='store_true', help="Write the time, rows and peak memory of every stage to <output>.profile.json" )
+    parser.add_argument( '--cprofile' , action='store_true', help="As --profile, and dump the cProfile stats of the hottest stage to <output>.profile.pstats" )
+
+class profile_run(object):
+    """
+    Profiles the run of tool if args asked for it:
+
+        with profile_run("om_augmenter", args):
+            main(args)
+    """
+    def __init__(self, tool, args):
+        self.tool     = tool
+        self.enabled  = getattr(args, 'profile', False) or getattr(args, 'cprofile', False)
+        self.cprofile = getattr(args, 'cprofile', False)
+
+    def __enter__(self):
+        if self.enabled:
+            start_profile(self.tool, cprofile=self.cprofile)
+        return active
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if not self.enabled:
+            return False
+
+        #a run ended by sys.exit(0), as --list, is still written
+        if exc_type is None or ( exc_type is SystemExit and exc_val.code in ( None, 0 ) ):
+            finish_profile()
+        else:
+            global active
+            active = None
+        return False
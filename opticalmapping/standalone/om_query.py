@@ -0,0 +1,254 @@
+#!/usr/bin/python
+
+import os
+import sys
+
+from om_shared import *
+
+
+"""
+Region lookup on a XMAP or augmented XMAP file, or on a GFF written by
+om_to_gff --index.
+
+The rows are found through the interval index of the RefContigID (or, with
+--by-query, QryContigID) positions, which is kept in the parse cache next to
+the input file. Only the first query parses the file, later ones map the
+cache and answer in milliseconds. On an indexed GFF the regions are given
+by the sequence names of the GFF and only the blocks of the genes found are
+read.
+
+    om_query.py in.xmap -n SL2.50ch00,SL2.50ch01,... SL2.50ch05:1,000,000-1,500,000
+
+From python:
+
+    data, headers, names, seman, types, indexer, groups, ref_maps_from, query_maps_from, filters = parse_file("in.xmap", gen_valid_fields(valid_fields_g), cache=True)
+    rows = query_region(indexer, parse_region("5:1000000-1500000"))
+"""
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description="Bionano Genomics MAP region lookup")
+    parser.add_argument( 'infile',                                                  help="MAP, AUGMENTED or indexed GFF file"                     )
+    parser.add_argument( 'regions'                            , nargs='*'         , help="Regions as Chrom, Chrom:Pos or Chrom:Start-End. Chrom is a name from --names or a contig id" )
+    parser.add_argument( '-r'    , '--regions-from-file'      , action='store'    , help="File containing regions. One per line"               )
+    parser.add_argument( '-n'    , '--names'                  , action='store'    , help="Names of reference chromosome. Eg: Ch0|Ch1|Ch3 Ch0,Ch1,Ch2 Ch0:Ch1:Ch2" )
+    parser.add_argument( '-N'    , '--names-from-file'        , action='store'    , help="File containing names of reference chromosome. One per line" )
+    parser.add_argument( '-s'    , '--sep'  , '--separator'   , default=","       , help="Separator for chromosome names. Eg: | , :"             )
+    parser.add_argument( '-Q'    , '--by-query'               , action='store_true', help="Regions are on the query maps (QryContigID) instead of the reference" )
+    parser.add_argument( '-o'    , '--output'                 , action='store'    , help="Output file [default: stdout]"                         )
+    parser.add_argument( '-H'    , '--no-header'              , action='store_true', help="Do not write the header lines"                        )
+    parser.add_argument( '--no-cache'                         , action='store_true', help="Do not keep the parse cache next to the input file"   )
+    add_profile_args(parser)
+
+    #regions given after an option are left over by argparse
+    args, extra = parser.parse_known_args(args=args)
+    for region in extra:
+        if region.startswith("-"):
+            parser.error("unrecognized arguments: %s" % region)
+        args.regions.append(region)
+
+    if args.regions_from_file is not None:
+        if not os.path.exists(args.regions_from_file):
+            print "regions file %s does not exists" % args.regions_from_file
+            sys.exit(1)
+
+        with open(args.regions_from_file, 'r') as fhd:
+            for line in fhd:
+                line = line.strip()
+
+                if len(line) == 0:
+                    continue
+
+                if line[0] == "#":
+                    continue
+
+                args.regions.append(line)
+
+    if len(args.regions) == 0:
+        print "no regions given"
+        sys.exit(1)
+
+    if args.names_from_file is not None:
+        if not os.path.exists(args.names_from_file):
+            print "names file %s does not exists" % args.names_from_file
+            sys.exit(1)
+
+        args.names = []
+        with open(args.names_from_file, 'r') as fhd:
+            for line in fhd:
+                line = line.strip()
+
+                if len(line) == 0:
+                    continue
+
+                if line[0] == "#":
+                    continue
+
+                args.names.append(line)
+
+    elif args.names is not None:
+        args.names = args.names.split( args.sep )
+
+    else:
+        args.names = []
+
+    return args
+
+def parse_position(pos):
+    return int(pos.replace(",", "").replace("_", ""))
+
+def split_region(region):
+    """
+    (chrom, start, end) of "Chrom", "Chrom:Pos" or "Chrom:Start-End". Start
+    or end are None if not given.
+    """
+    chrom, beg, end = region, None, None
+
+    if ":" in region:
+        chrom, span = region.rsplit(":", 1)
+        if "-" in span:
+            beg, end = span.split("-", 1)
+            beg      = parse_position(beg) if len(beg) > 0 else None
+            end      = parse_position(end) if len(end) > 0 else None
+        else:
+            beg      = end = parse_position(span)
+
+    if beg is not None and end is not None and beg > end:
+        raise ValueError("region %s starts after its end" % region)
+
+    return chrom, beg, end
+
+def parse_region(region, chromosome_names=None):
+    """
+    (contig id, start, end) of a region as in split_region. Chrom is the
+    name of the contig in chromosome_names (contig id is its position + 1,
+    as in om_to_gff) or the contig id itself.
+    """
+    chrom, beg, end = split_region(region)
+
+    if chromosome_names is not None and chrom in chromosome_names:
+        contig_id = chromosome_names.index(chrom) + 1
+
+    elif chrom.isdigit():
+        contig_id = int(chrom)
+
+    else:
+        raise ValueError("unknown chromosome %s in region %s" % (chrom, region))
+
+    return contig_id, beg, end
+
+def query_region(indexer, region, name="RefContigID"):
+    """
+    Ascending row ids of the rows overlapping region, a (contig id, start,
+    end) tuple as given by parse_region
+    """
+    contig_id, beg, end = region
+    return indexer.intervals(name).query(contig_id, beg, end)
+
+def query_gff(args):
+    """
+    Region lookup on a GFF written by om_to_gff --index, reading only the
+    blocks of the genes found
+    """
+    from om_input import BgzfIndexReader
+
+    regions             = []
+    for region in args.regions:
+        try:
+            regions.append(split_region(region))
+        except ValueError as e:
+            print e
+            sys.exit(1)
+
+    try:
+        reader          = BgzfIndexReader(args.infile)
+    except IOError as e:
+        print e
+        sys.exit(1)
+
+    if args.output is None:
+        fhd             = sys.stdout
+    else:
+        fhd             = open(args.output, 'w')
+
+    try:
+        if not args.no_header:
+            fhd.write( "##gff-version 3\n" )
+
+        for chrom, beg, end in regions:
+            with profile_stage("query") as stage:
+                records    = reader.query(chrom, beg, end)
+                stage.rows = len(records)
+            for record in records:
+                fhd.write( record )
+    finally:
+        reader.close()
+        if args.output is not None:
+            fhd.close()
+
+def main(args):
+    from om_io import index_ext
+
+    valid_fields        = gen_valid_fields(valid_fields_g)
+    infile              = args.infile
+
+    if not os.path.exists(infile):
+        print "input file %s does not exists" % infile
+        sys.exit(1)
+
+    if os.path.isdir(infile):
+        print "input file %s is a folder" % infile
+        sys.exit(1)
+
+    profile_output(args.output if args.output is not None else infile)
+
+    if os.path.exists(infile + index_ext):
+        query_gff(args)
+        return
+
+    regions             = []
+    for region in args.regions:
+        try:
+            regions.append(parse_region(region, args.names))
+        except ValueError as e:
+            print e
+            sys.exit(1)
+
+    #the rows go to stdout, keep the progress messages out of it
+    stdout, sys.stdout  = sys.stdout, sys.stderr
+    try:
+        data, headers, names, seman, types, indexer, groups, ref_maps_from, query_maps_from, filters_csv = parse_file(infile, valid_fields, cache=not args.no_cache)
+    finally:
+        sys.stdout      = stdout
+
+    name                = "QryContigID" if args.by_query else "RefContigID"
+
+    if args.output is None:
+        fhd             = sys.stdout
+    else:
+        fhd             = open(args.output, 'w')
+
+    try:
+        if not args.no_header:
+            fhd.write( "\n".join(headers) + "\n" )
+
+        for region in regions:
+            with profile_stage("query") as stage:
+                rows       = query_region(indexer, region, name=name)
+                stage.rows = len(rows)
+            write_rows(fhd, data, names, rows=rows)
+    finally:
+        if args.output is not None:
+            fhd.close()
+
+
+
+if __name__ == '__main__':
+    if len(sys.argv) ==1:
+        print "no arguments given"
+        sys.exit(1)
+
+    args         = parse_args(sys.argv[1:])
+
+    with profile_run("om_query", args):
+        main(args)
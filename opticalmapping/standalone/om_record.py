@@ -0,0 +1,66 @@
+"""
+Lightweight records with attribute and key access, used instead of building
+one dict per row.
+"""
+
+class RecordBase(object):
+    __slots__ = ()
+    _fields   = ()
+
+    def __init__(self, vals=(), **kwargs):
+        for field, val in zip(self._fields, vals):
+            setattr(self, field, val)
+
+        for field, val in kwargs.items():
+            setattr(self, field, val)
+
+    def __getitem__(self, key):
+        if isinstance(key, int):
+            key = self._fields[key]
+
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, val):
+        if isinstance(key, int):
+            key = self._fields[key]
+
+        try:
+            setattr(self, key, val)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self._fields and hasattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def keys(self):
+        return [ x for x in self._fields if hasattr(self, x) ]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def items(self):
+        return [ (x, getattr(self, x)) for x in self.keys() ]
+
+    def _asdict(self):
+        return dict(self.items())
+
+    def __repr__(self):
+        return "%s(%s)" % ( self.__class__.__name__, ", ".join([ "%s=%r" % x for x in self.items() ]) )
+
+def gen_record_type(name, field_names):
+    """
+    Record class with one slot per field name. Fields can be read and set as
+    attributes or as keys, record['object_id'] or record.object_id, and are
+    listed in field order by keys().
+    """
+    field_names = tuple(field_names)
+    return type(name, (RecordBase,), { '__slots__': field_names, '_fields': field_names })
@@ -1,9 +1,29 @@
 import re
+import sys
 import operator
 import argparse
 import textwrap
+import importlib
 from collections     import defaultdict
-from sqlalchemy.util import KeyedTuple
+from om_profile      import profile_stage, profile_iter, profile_output, profile_run, add_profile_args
+
+
+
+class lazy_module(object):
+    """
+    Stands in for a module until one of its attributes is first used.
+    numpy alone is most of the start up time of the tools, and --help,
+    --list or a bad argument never need it.
+    """
+    def __init__(self, name):
+        self.__dict__['_lazy_name'] = name
+
+    def __getattr__(self, attr):
+        module = importlib.import_module(self.__dict__['_lazy_name'])
+        self.__dict__.update(module.__dict__)
+        return getattr(module, attr)
+
+np = lazy_module('numpy')
 
 """
 #h XmapEntryID  QryContigID     RefContigID     QryStartPos     QryEndPos       RefStartPos     RefEndPos       Orientation     Confidence      HitEnum QryLen     RefLen    LabelChannel    Alignment
@@ -12,6 +32,11 @@ from sqlalchemy.util import KeyedTuple
 """
 
 cols_to_index  = ["QryContigID", "RefContigID", "Orientation", "XmapEntryID"]
+cols_category  = ["Orientation"]
+interval_cols  = {
+    "RefContigID": ["RefStartPos", "RefEndPos"],
+    "QryContigID": ["QryStartPos", "QryEndPos"],
+}
 group_by       = [
     ["RefContigID", "QryContigID"],
     ["RefContigID", "RefStartPos"],
@@ -27,6 +52,10 @@ re_insertions = re.compile("(\d+)I")
 re_deletions  = re.compile("(\d+)D")
 re_alignment  = re.compile("\((\d+),(\d+)\)")
 
+re_filter_expr  = re.compile("[\s()]")
+re_filter_token = re.compile("\(|\)|[^\s()]+")
+re_filter_name  = re.compile("[^\w.,-]+")
+
 
 
 def col_parse_orientation(val):
@@ -35,13 +64,13 @@ def col_parse_orientation(val):
 
 def col_parse_hit_enum(val):
     #4M2D2M
-    assert(set([x for x in val]) <= set(['M', 'D', 'I', '0', '1', '2', '3', '4', '5', '6', '7', '8', '9']))
+    assert(len(val.translate(None, 'MDI0123456789')) == 0)
     return val
 
 def col_parse_alignment(val):
     #"(1,34)(2,34)(3,35)(4,36)(5,37)(6,38)(8,38)(9,39)"
     val = val.strip('"')
-    assert(set([x for x in val]) <= set(['(', ')', ',', '0', '1', '2', '3', '4', '5', '6', '7', '8', '9']))
+    assert(len(val.translate(None, '(),0123456789')) == 0)
     return val
 
 def col_parse_bool(val):
@@ -87,6 +116,80 @@ def process_cigar(cigar):
     
     return cigar_matches, cigar_insertions, cigar_deletions
 
+def digit_runs(buf, digit_pos, run_end):
+    """
+    Values of the decimal numbers written in the uint8 array buf.
+    digit_pos are the (sorted) positions of the digits and run_end the
+    position right after the number each digit belongs to.
+    Returns the run_end of every number and its value.
+    """
+    if len(digit_pos) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    vals       = (buf[digit_pos].astype(np.int64) - 48) * np.power(10, (run_end - digit_pos - 1).astype(np.int64))
+    change     = np.empty(len(run_end), dtype=np.bool_)
+    change[0]  = True
+    np.not_equal(run_end[1:], run_end[:-1], out=change[1:])
+    starts     = np.flatnonzero(change)
+
+    return run_end[starts], np.add.reduceat(vals, starts)
+
+def process_cigars(hit_enums, run_lengths=False):
+    """
+    process_cigar for a whole HitEnum column (StringColumn or list of str)
+    in a single pass over the shared buffer.
+
+    Returns the matches, insertions and deletions arrays, one value per row.
+    With run_lengths=True also returns the run length encoding of all rows:
+    ops (uint8 'M', 'I' or 'D'), lens, and offsets so that the runs of row i
+    are ops[offsets[i]:offsets[i+1]].
+    """
+    from om_table import StringColumn
+
+    if not isinstance(hit_enums, StringColumn):
+        hit_enums = StringColumn.from_list(list(hit_enums))
+
+    buf      = hit_enums.buffer
+    offsets  = hit_enums.offsets
+    num_rows = len(hit_enums)
+
+    is_op    = (buf == ord('M')) | (buf == ord('I')) | (buf == ord('D'))
+    is_digit = (buf >= ord('0')) & (buf <= ord('9'))
+    if not (is_op | is_digit).all():
+        bad_pos = np.flatnonzero(~(is_op | is_digit))[0]
+        raise AssertionError("invalid character in HitEnum of row %d: %s" % ( np.searchsorted(offsets, bad_pos, 'right') - 1, chr(buf[bad_pos]) ))
+
+    op_pos    = np.flatnonzero(is_op)
+    op_row    = np.searchsorted(offsets, op_pos, 'right') - 1
+    digit_pos = np.flatnonzero(is_digit)
+
+    #every digit belongs to the first op after it. digits trailing at the end
+    #of a row have no op and are ignored, as the regular expressions did
+    nxt       = np.searchsorted(op_pos, digit_pos)
+    keep      = nxt < len(op_pos)
+    digit_pos = digit_pos[keep]
+    nxt       = nxt[keep]
+    keep      = ( np.searchsorted(offsets, digit_pos, 'right') - 1 ) == op_row[nxt]
+    digit_pos = digit_pos[keep]
+    nxt       = nxt[keep]
+
+    run_ends, run_vals = digit_runs(buf, digit_pos, op_pos[nxt])
+    lens      = np.zeros(len(op_pos), dtype=np.int64)
+    lens[ np.searchsorted(op_pos, run_ends) ] = run_vals
+    ops       = buf[op_pos]
+
+    res       = []
+    for op in ('M', 'I', 'D'):
+        sel = ops == ord(op)
+        res.append( np.bincount(op_row[sel], weights=lens[sel], minlength=num_rows).astype(np.int64) )
+
+    if run_lengths:
+        run_offsets = np.zeros(num_rows + 1, dtype=np.int64)
+        np.cumsum(np.bincount(op_row, minlength=num_rows), out=run_offsets[1:])
+        res.extend([ ops, lens, run_offsets ])
+
+    return tuple(res)
+
 def process_alignment(alignment):
     """
      Alignment (4862,48)(4863,48)(4864,47)(4865,46)(4866,45)(4867,44)(4870,43)(4873,42)(4874,41)(4875,40)(4877,40)(4878,39)(4879,38)(4880,37)(4883,36)(4884,36)(4885,35)(4886,34)(4887,33)(4888,33)(4889,32)(4890,30)(4891,30)(4892,29)(4893,28)(4894,28)(4899,27)(4900,26)(4901,25)(4902,24)(4903,23)(4904,22)(4906,21)(4907,21)(4908,20)(4910,19)(4911,18)(4912,17)(4913,16)(4915,15)(4917,14)(4918,13)(4919,12)(4920,11)(4922,10)(4923,9)(4925,8)(4927,7)(4930,6)(4931,5)(4932,3)(4933,2)(4934,1)
@@ -114,13 +217,104 @@ def process_alignment(alignment):
 
 
 
+def decode_alignments(alignments):
+    """
+    Decodes a whole Alignment column (StringColumn or list of str) at once.
+    Returns pairs, an int32 array of shape (N, 2) with the (ref, qry) label
+    pairs of all rows back to back, and offsets so that the pairs of row i
+    are pairs[offsets[i]:offsets[i+1]].
+    """
+    from om_table import StringColumn
+
+    if not isinstance(alignments, StringColumn):
+        alignments = StringColumn.from_list(list(alignments))
+
+    buf        = alignments.buffer
+    offsets    = alignments.offsets
+    num_rows   = len(alignments)
+
+    is_digit   = (buf >= ord('0')) & (buf <= ord('9'))
+    digit_pos  = np.flatnonzero( is_digit)
+    other_pos  = np.flatnonzero(~is_digit)
+
+    #a number ends at the first non digit after it, "," or ")" in a well formed alignment
+    nxt        = np.searchsorted(other_pos, digit_pos)
+    assert (nxt < len(other_pos)).all(), "alignment does not end in )"
+    run_ends, numbers = digit_runs(buf, digit_pos, other_pos[nxt])
+
+    open_pos   = np.flatnonzero(buf == ord('('))
+    num_pairs  = np.bincount(np.searchsorted(offsets, open_pos, 'right') - 1, minlength=num_rows)
+    assert len(numbers) == 2 * len(open_pos), "malformed alignment: %d numbers in %d pairs" % ( len(numbers), len(open_pos) )
+
+    pair_offsets = np.zeros(num_rows + 1, dtype=np.int64)
+    np.cumsum(num_pairs, out=pair_offsets[1:])
+
+    return numbers.astype(np.int32).reshape(-1, 2), pair_offsets
+
+def count_label_runs(rows, labels, num_rows):
+    """
+    Per row number of distinct labels and number of pairs whose label shows
+    up more than once in the row (collapses)
+    """
+    order      = np.lexsort((labels, rows))
+    srows      = rows  [order]
+    slabels    = labels[order]
+
+    if len(order) == 0:
+        return np.zeros(num_rows, dtype=np.int64), np.zeros(num_rows, dtype=np.int64)
+
+    change     = np.empty(len(order), dtype=np.bool_)
+    change[0]  = True
+    change[1:] = (srows[1:] != srows[:-1]) | (slabels[1:] != slabels[:-1])
+    starts     = np.flatnonzero(change)
+    run_lens   = np.diff(np.append(starts, len(order)))
+    run_rows   = srows[starts]
+
+    distinct   = np.bincount(run_rows, minlength=num_rows)
+    colapses   = np.bincount(run_rows, weights=run_lens * (run_lens > 1), minlength=num_rows)
+
+    return distinct.astype(np.int64), colapses.astype(np.int64)
+
+def process_alignments(pairs, offsets):
+    """
+    process_alignment for all rows decoded by decode_alignments.
+    Returns arrays in the same order: count_refs, count_queries,
+    count_refs_colapses, count_queries_colapses
+    """
+    num_rows   = len(offsets) - 1
+    pair_rows  = np.repeat(np.arange(num_rows, dtype=np.int64), np.diff(offsets))
+
+    count_refs   , count_refs_colapses    = count_label_runs(pair_rows, pairs[:, 0], num_rows)
+    count_queries, count_queries_colapses = count_label_runs(pair_rows, pairs[:, 1], num_rows)
+
+    return count_refs, count_queries, count_refs_colapses, count_queries_colapses
+
+
+
+class WrappedHelps(dict):
+    """
+    field name -> help text wrapped at 80 columns and joined with sep.
+    The text is only wrapped the first time a field is asked for.
+    """
+    def __init__(self, texts, sep):
+        dict.__init__(self)
+        self.texts = texts
+        self.sep   = sep
+
+    def __missing__(self, field_name):
+        help_text             = self.sep.join(textwrap.wrap(self.texts[field_name], 80))
+        self[ field_name ]    = help_text
+        return help_text
+
 def gen_valid_fields(valid_fields):
+    if 'names' in valid_fields:
+        return valid_fields
+
     valid_fields['names'  ] = [None] * len(valid_fields['data'])
     valid_fields['parsers'] = {}
     valid_fields['types'  ] = {}
     valid_fields['poses'  ] = {}
-    valid_fields['helps'  ] = {}
-    valid_fields['helps_t'] = {}
+    valid_fields['texts'  ] = {}
     
     for field_pos, field_data, in enumerate(valid_fields['data']):
         field_name, field_type, field_parser, field_help = field_data
@@ -129,8 +323,10 @@ def gen_valid_fields(valid_fields):
         valid_fields['parsers'][ field_name ] = field_parser
         valid_fields['types'  ][ field_name ] = field_type
         valid_fields['poses'  ][ field_name ] = field_pos
-        valid_fields['helps'  ][ field_name ] = ("\n"  + (" "*53)).join(textwrap.wrap(field_help, 80))
-        valid_fields['helps_t'][ field_name ] = ("\n#" + (" "*42)).join(textwrap.wrap(field_help, 80))
+        valid_fields['texts'  ][ field_name ] = field_help
+
+    valid_fields['helps'  ] = WrappedHelps(valid_fields['texts'], "\n"  + (" "*53))
+    valid_fields['helps_t'] = WrappedHelps(valid_fields['texts'], "\n#" + (" "*42))
 
     return valid_fields
 
@@ -140,6 +336,10 @@ def parser_in(orig_parser, value, sep=","):
 def function_in(val, qry):
     return val in qry
 
+def function_contains(val, qry):
+    #"1,3,5" contains 3,5
+    return qry <= set(val.split(","))
+
 valid_operators = {
     #op name      op func            override parser   help
     'eq'      : [ operator.eq      , None, "value <Equal> to filter" ],
@@ -151,7 +351,7 @@ valid_operators = {
     'lt'      : [ operator.lt      , None, "value <Less than> filter" ],
     'ne'      : [ operator.ne      , None, "value <Not equal> to filter" ],
     #'truth'   : [ operator.truth   , None, "value is <Truth>" ],
-    'contains': [ operator.contains, parser_in, "value <Contains> filter" ],
+    'contains': [ function_contains, parser_in, "value <Contains> filter [comman separated, string fields]" ],
     'in'      : [ function_in      , parser_in, "value <In> filter [comman separated]" ]
 }
 #for operator_name in sorted(dir(operator)):
@@ -163,52 +363,318 @@ valid_operators = {
 #    valid_operators[operator_name] = getattr(operator, operator_name)
 
 
+def gen_filter_leaf(filter_data, valid_fields):
+    filter_cols = filter_data.split(":")
+
+    if len(filter_cols) != 3:
+        print "filter has to have 3 parts <field>:<function>:<value>, %d found in %s" % ( len(filter_cols), filter_data )
+        sys.exit(0)
+
+    field_name, operator_name, value_str = filter_cols
+    assert field_name    in valid_fields['names'  ], "invalid value for field name"
+    assert operator_name in valid_operators        , "operator %s does not exists. acceptable values are: %s" % ( operator_name, ", ".join(sorted(valid_operators)) )
+    assert operator_name != 'contains' or valid_fields['types'][field_name] == 'string', "operator contains only applies to string fields"
+
+    if valid_operators[operator_name][1] is None:
+        value          =                                    valid_fields['parsers'][field_name]( value_str )
+    else:
+        value          = valid_operators[operator_name][1]( valid_fields['parsers'][field_name], value_str )
+
+    operator_val   = valid_operators[operator_name][0]
+    filter_res     = [field_name, operator_name, operator_val, value_str, value]
+
+    return filter_res
+
+def gen_filter_expr(filter_data, valid_fields):
+    """
+    Boolean expression of filters:
+        Confidence:ge:10 AND ( _meta_num_qry_matches:eq:1 OR NOT Orientation:eq:- )
+    NOT binds tighter than AND, which binds tighter than OR.
+    Nodes are ['leaf', filter_res], ['and', [nodes]], ['or', [nodes]] or ['not', node]
+    """
+    tokens = re_filter_token.findall(filter_data)
+    pos    = [0]
+
+    def peek():
+        if pos[0] < len(tokens):
+            return tokens[pos[0]]
+        return None
+
+    def take():
+        token   = peek()
+        pos[0] += 1
+        return token
+
+    def parse_or():
+        nodes = [ parse_and() ]
+        while peek() is not None and peek().lower() == 'or':
+            take()
+            nodes.append( parse_and() )
+        return nodes[0] if len(nodes) == 1 else ['or', nodes]
+
+    def parse_and():
+        nodes = [ parse_not() ]
+        while peek() is not None and peek().lower() == 'and':
+            take()
+            nodes.append( parse_not() )
+        return nodes[0] if len(nodes) == 1 else ['and', nodes]
+
+    def parse_not():
+        token = take()
+        if token is None:
+            print "filter expression ended unexpectedly: %s" % filter_data
+            sys.exit(1)
+
+        if token.lower() == 'not':
+            return ['not', parse_not()]
+
+        if token == '(':
+            node = parse_or()
+            if take() != ')':
+                print "missing closing parenthesis in filter: %s" % filter_data
+                sys.exit(1)
+            return node
+
+        return ['leaf', gen_filter_leaf(token, valid_fields)]
+
+    node = parse_or()
+    if peek() is not None:
+        print "unexpected %s in filter: %s" % (peek(), filter_data)
+        sys.exit(1)
+
+    return node
+
 def gen_filter(filter_datas, valid_fields):
+    """
+    Each filter is [field_name, operator_name, operator_val, value_str, value].
+    Boolean expressions become ['expr', 'expr', node, expression, node], see
+    gen_filter_expr. All filters have to pass (AND).
+    """
     filters = []
     
     if filter_datas is not None:
         for filter_data in filter_datas:
-            filter_cols = filter_data.split(":")
-
-            if len(filter_cols) != 3:
-                print "filter has to have 3 parts <field>:<function>:<value>, %d found in %s" % ( len(filter_cols), filter_data )
-                sys.exit(0)
-
-            field_name, operator_name, value_str = filter_cols
-            assert field_name    in valid_fields['names'  ], "invalid value for field name"
-            assert operator_name in valid_operators        , "operator %s does not exists. acceptable values are: lt, le, eq, ne, ge, gt" % operator_name
+            if re_filter_expr.search(filter_data.strip()):
+                node       = gen_filter_expr(filter_data, valid_fields)
+                expression = " ".join(re_filter_token.findall(filter_data))
+                filters.append(['expr', 'expr', node, expression, node])
 
-            if valid_operators[operator_name][1] is None:
-                value          =                                    valid_fields['parsers'][field_name]( value_str )
             else:
-                value          = valid_operators[operator_name][1]( valid_fields['parsers'][field_name], value_str )
+                filters.append(gen_filter_leaf(filter_data, valid_fields))
 
-            operator_val   = valid_operators[operator_name][0]
-            filter_res     = [field_name, operator_name, operator_val, value_str, value]
+    return filters
 
-            filters.append(filter_res)
+def filter_name(filter_data):
+    """
+    Suffix added to the output file name for a filter
+    """
+    field_name, field_operator_name, field_operator, field_value_str, field_value = filter_data
+    if field_operator_name == 'expr':
+        return '_expr_' + re_filter_name.sub('_', field_value_str).strip('_').replace(',', '_')
+    return ('_' + '_'.join( [ field_name, field_operator_name, field_value_str ] )).replace(',', '_')
 
-    return filters
+def filter_header(filter_data):
+    """
+    "# FILTER :" header line for a filter. parse_file reads it back as the
+    original filter string
+    """
+    field_name, field_operator_name, field_operator, field_value_str, field_value = filter_data
+    if field_operator_name == 'expr':
+        return "# FILTER : %s\n" % field_value_str
+    return "# FILTER : %-39s: %3s : %s\n" % ( field_name, field_operator_name, field_value_str )
 
 
 
-def parse_file(infile, valid_fields):
-    data            = []
-    names           = []
-    seman           = {}
-    types           = []
-    indexer         = {}
-    headers         = []
-    filters         = []
-    groups          = defaultdict(lambda: defaultdict(lambda: defaultdict(set)))
-    ref_maps_from   = ""
-    query_maps_from = ""
+class FilterPlan(object):
+    """
+    Filters compiled into a single tree, evaluated one column at a time.
+    mask(table) returns a boolean array with the rows passing every filter.
+    AND/OR only evaluate their later terms on the rows still undecided.
+    """
+    def __init__(self, filters):
+        nodes = []
+        for filter_data in filters:
+            if filter_data[1] == 'expr':
+                nodes.append( filter_data[4] )
+            else:
+                nodes.append( ['leaf', filter_data] )
+        self.node = ['and', nodes]
+
+    def __len__(self):
+        return len(self.node[1])
+
+    def fields(self):
+        """
+        Names of the fields the filters look at
+        """
+        names = []
+        todo  = [ self.node ]
+        while len(todo) > 0:
+            node = todo.pop()
+            if   node[0] == 'leaf':
+                if node[1][0] not in names:
+                    names.append( node[1][0] )
+            elif node[0] == 'not':
+                todo.append( node[1] )
+            else:
+                todo.extend( reversed(node[1]) )
+        return names
+
+    def mask(self, table, rows=None):
+        if rows is None:
+            rows = np.arange(len(table), dtype=np.int64)
+        else:
+            rows = np.asarray(rows, dtype=np.int64)
+        return self.eval_node(self.node, table, rows)
+
+    def eval_node(self, node, table, rows):
+        kind = node[0]
+
+        if   kind == 'leaf':
+            return self.eval_leaf(node[1], table, rows)
+
+        elif kind == 'not':
+            return ~self.eval_node(node[1], table, rows)
+
+        elif kind == 'and':
+            alive = np.arange(len(rows), dtype=np.int64)
+            for child in node[1]:
+                if len(alive) == 0:
+                    break
+                alive = alive[ self.eval_node(child, table, rows[alive]) ]
+            res        = np.zeros(len(rows), dtype=np.bool_)
+            res[alive] = True
+            return res
+
+        elif kind == 'or':
+            res = np.zeros(len(rows), dtype=np.bool_)
+            for child in node[1]:
+                todo = np.flatnonzero(~res)
+                if len(todo) == 0:
+                    break
+                res[ todo ] = self.eval_node(child, table, rows[todo])
+            return res
+
+        raise ValueError("unknown filter node %s" % kind)
+
+    def eval_leaf(self, filter_data, table, rows):
+        from om_table import StringColumn, CategoryColumn
+
+        field_name, field_operator_name, field_operator, field_value_str, field_value = filter_data
+        column = table.column(field_name)
+
+        if   isinstance(column, CategoryColumn):
+            #evaluate once per category, then look the codes up
+            res = np.array([ field_operator(c, field_value) for c in column.categories ], dtype=np.bool_)
+            return res[ column.codes[rows] ]
+
+        elif isinstance(column, StringColumn):
+            return np.fromiter(( field_operator(v, field_value) for v in column.tolist(rows) ), dtype=np.bool_, count=len(rows))
+
+        elif field_operator_name == 'in':
+            return np.in1d(column[rows], list(field_value))
+
+        else:
+            return np.asarray(field_operator(column[rows], field_value), dtype=np.bool_)
+
+
+
+def col_kind(valid_fields, name):
+    if name in cols_category:
+        return 'category'
+    return valid_fields['types'][name]
+
+def new_header_meta():
+    return {
+        'headers'        : [],
+        'names'          : [],
+        'seman'          : {},
+        'types'          : [],
+        'ref_maps_from'  : "",
+        'query_maps_from': "",
+        'filters'        : []
+    }
+
+def parse_header_line(meta, line):
+    """
+    Adds a stripped "#" line of a XMAP file to the header metadata in meta
+    """
+    meta['headers'].append(line)
+    
+    
+    if len(line) == 1:
+        return
+    
+    if line[2:10] == "FILTER :":
+        print "PARSING FILTER"
+        #"Confidence                             :  ge : 10.0"
+        cols = [ x.strip() for x in line[2:].split(":") ]
+        filter_line = ":".join(cols[1:])
+        meta['filters'].append( filter_line )
+    
+    elif line[1] == "h":
+        line  = line[3:]
+        names = [x.strip() for x in line.split("\t")]
+        #print "NAMES", names
+        
+        for p, n in enumerate(names):
+            meta['seman'][n] = p
 
+        meta['names'] = names
     
-    for cti in cols_to_index:
-        indexer[cti] = defaultdict(set)
+    elif line[1] == "f":
+        line  = line[3:]
+        types = [x.strip() for x in line.split("\t")]
+        
+        #for tp in xrange(len(types)):
+        #    t = types[tp]
+        #    if   t == "int":
+        #        types[tp] = int
+        #    elif t == "float":
+        #        types[tp] = float
+        #    elif t == "string":
+        #        types[tp] = col_parsers[ names[tp] ]
+        
+        assert(len(types) == len(meta['names']))
+        
+        #print "TYPES", types
+        meta['types'] = types
+    
+    elif "Reference Maps From:" in line:
+        # Reference Maps From:  S_lycopersicum_chromosomes.2.50.BspQI-BbvCI_to_EXP_REFINEFINAL1_r.cmap
+        # Query Maps From:      S_lycopersicum_chromosomes.2.50.BspQI-BbvCI_to_EXP_REFINEFINAL1_q.cmap
+        meta['ref_maps_from'  ] = line[23:].strip()
+
+    elif "Query Maps From:" in line:
+        meta['query_maps_from'] = line[23:].strip()
+
+def parse_header(text):
+    """
+    Header metadata of the "#" lines in text, as iter_xmap yields it
+    """
+    meta = new_header_meta()
+    for line in text.split("\n"):
+        line = line.strip()
+        if len(line) > 0 and line[0] == "#":
+            parse_header_line(meta, line)
+    return meta
+
+def iter_xmap(infile, valid_fields, chunk_rows=100000):
+    """
+    Streams a XMAP file. The first item yielded is a dict with the header
+    metadata (headers, names, seman, types, ref_maps_from, query_maps_from,
+    filters), followed by XmapTable batches of at most chunk_rows rows.
+    With chunk_rows=None the whole file comes as a single batch. gzip, BGZF
+    and bzip2 files are read as they are.
+    """
+    from om_table import XmapTable
+    from om_input import open_input
+
+    data            = None
+    meta            = new_header_meta()
+    num_rows        = 0
     
-    with open(infile, 'r') as fhd:
+    with open_input(infile) as fhd:
         for line in fhd:
             line = line.strip()
             
@@ -216,126 +682,240 @@ def parse_file(infile, valid_fields):
                 continue
             
             if line[0] == "#":
-                headers.append(line)
-                
-                
-                if len(line) == 1:
-                    continue
-                
-                if line[2:10] == "FILTER :":
-                    print "PARSING FILTER"
-                    #"Confidence                             :  ge : 10.0"
-                    cols = [ x.strip() for x in line[2:].split(":") ]
-                    filter_line = ":".join(cols[1:])
-                    filters.append( filter_line )
-                
-                elif line[1] == "h":
-                    line  = line[3:]
-                    names = [x.strip() for x in line.split("\t")]
-                    #print "NAMES", names
-                    
-                    for p, n in enumerate(names):
-                        seman[n] = p
-                
-                elif line[1] == "f":
-                    line  = line[3:]
-                    types = [x.strip() for x in line.split("\t")]
-                    
-                    #for tp in xrange(len(types)):
-                    #    t = types[tp]
-                    #    if   t == "int":
-                    #        types[tp] = int
-                    #    elif t == "float":
-                    #        types[tp] = float
-                    #    elif t == "string":
-                    #        types[tp] = col_parsers[ names[tp] ]
-                    
-                    assert(len(types) == len(names))
-                    
-                    #print "TYPES", types
-                
-                elif "Reference Maps From:" in line:
-                    # Reference Maps From:  S_lycopersicum_chromosomes.2.50.BspQI-BbvCI_to_EXP_REFINEFINAL1_r.cmap
-                    # Query Maps From:      S_lycopersicum_chromosomes.2.50.BspQI-BbvCI_to_EXP_REFINEFINAL1_q.cmap
-                    ref_maps_from   = line[23:].strip()
-    
-                elif "Query Maps From:" in line:
-                    query_maps_from = line[23:].strip()
-
+                parse_header_line(meta, line)
                 continue
             
-            cols = [x.strip()                                  for x in line.split("\t") ]
-            vals = [valid_fields['parsers'][names[p]](cols[p]) for p in xrange(len(cols))]
+            if data is None:
+                yield meta
+
+                names   = meta['names']
+                parsers = [ valid_fields['parsers'][n] for n in names ]
+                kinds   = [ col_kind(valid_fields, n)  for n in names ]
+                data    = XmapTable.builder(names, kinds)
+
+            cols = [x.strip()           for x in line.split("\t") ]
+            vals = [parsers[p](cols[p]) for p in xrange(len(cols)) ]
 
-            for ind in indexer:
-                indexer[ ind ][ vals[seman[ind]] ].add(len(data))
-            
-            for grp_from, grp_to in group_by:
-                val_from = vals[seman[grp_from]]
-                val_to   = vals[seman[grp_to  ]]
-                groups[grp_from+'_'+grp_to][val_from][val_to].add(len(data))
-            
             data.append(vals)
+            num_rows += 1
 
-    return data, headers, names, seman, types, indexer, groups, ref_maps_from, query_maps_from, filters
+            if num_rows == chunk_rows:
+                yield data.finish()
+                data     = XmapTable.builder(names, kinds)
+                num_rows = 0
 
+    if data is None:
+        yield meta
 
+        data = XmapTable.builder(meta['names'], [ col_kind(valid_fields, n) for n in meta['names'] ])
 
-def stats_from_data_vals(RefContigID, QryContigID, groups, indexer, data, data_vals, valid_data_poses):
-    ref_lens             = [ ( x["RefStartPos"], x["RefEndPos"] ) for x in data_vals ]
-    qry_lens             = [ ( x["QryStartPos"], x["QryEndPos"] ) for x in data_vals ]
-    
-    num_qry_matches = []
-    for RefContigID_l in groups["QryContigID_RefContigID"][QryContigID]:
-        for match_pos in groups["QryContigID_RefContigID"][QryContigID][RefContigID_l]:
-            if match_pos in valid_data_poses:
-                num_qry_matches.append(RefContigID_l)
-
-    #num_qry_matches      = len( groups["QryContigID_RefContigID"][QryContigID] )
-    num_qry_matches      = len( set(num_qry_matches)                       )
-    num_orientations     = len( set([x["Orientation"] for x in data_vals]) )
-
-    ref_no_gap_len       = sum( [ max(x)-min(x) for x in ref_lens ] )
-    ref_min_coord        = min( [ min(x)        for x in ref_lens ] )
-    ref_max_coord        = max( [ max(x)        for x in ref_lens ] )
-    ref_gap_len          = ref_max_coord - ref_min_coord
-    
-    qry_no_gap_len       = sum( [ max(x)-min(x) for x in qry_lens ] )
-    qry_min_coord        = min( [ min(x)        for x in qry_lens ] )
-    qry_max_coord        = max( [ max(x)        for x in qry_lens ] )
-    qry_gap_len          = qry_max_coord - qry_min_coord
-    
-    XmapEntryIDs         = groups["QryContigID_XmapEntryID"][QryContigID].keys()
-    
-    Confidences          = []
-    for XmapEntryID in XmapEntryIDs:
-        data_pos = list(indexer["XmapEntryID"][XmapEntryID])[0]
-        if data_pos not in valid_data_poses:
-            continue
-        Confidences.append( [ data[data_pos]["Confidence"], data[data_pos]["RefContigID"] ] )
-    
-    max_confidence       = max([ x[0] for x in Confidences ])
-    max_confidence_chrom = [ x[1] for x in Confidences if x[0] == max_confidence][0]
+    if num_rows > 0 or chunk_rows is None:
+        yield data.finish()
+
+def parse_file(infile, valid_fields, cache=False):
+    """
+    With cache=True the parsed columns and group indexes are kept in a binary
+    <infile>.cache sidecar, which is reused as long as the size and mtime of
+    infile and the schema in valid_fields do not change
+    """
+    from om_index import XmapIndexer, XmapGroups
+    from om_cache import read_xmap_cache, write_xmap_cache
+
+    cache_file      = infile + ".cache"
+
+    if cache:
+        with profile_stage("parse") as stage:
+            cached = read_xmap_cache(cache_file, infile, valid_fields, cols_category)
+            stage.rows = None if cached is None else len(cached[1])
+
+        if cached is not None:
+            print "LOADING CACHE", cache_file
+            meta, data, indexes, grps, intervals = cached
+
+            indexer         = XmapIndexer(data, cols_to_index, interval_cols)
+            groups          = XmapGroups( data, group_by     )
+            indexer.built          .update(indexes  )
+            indexer.built_intervals.update(intervals)
+            groups .built          .update(grps     )
+
+            return data, meta['headers'], meta['names'], meta['seman'], meta['types'], indexer, groups, meta['ref_maps_from'], meta['query_maps_from'], meta['filters']
+
+    with profile_stage("parse") as stage:
+        xmap        = iter_xmap(infile, valid_fields, chunk_rows=None)
+        meta        = next(xmap)
+        data        = next(xmap)
+        stage.rows  = len(data)
+
+    indexer         = XmapIndexer(data, cols_to_index, interval_cols)
+    groups          = XmapGroups( data, group_by     )
+
+    if cache:
+        print "SAVING CACHE", cache_file
+        for cti in cols_to_index:
+            indexer[cti]
+        for cti in interval_cols:
+            indexer.intervals(cti)
+        for grp_from, grp_to in group_by:
+            groups[grp_from+'_'+grp_to]
+
+        try:
+            with profile_stage("cache", rows=len(data)):
+                write_xmap_cache(cache_file, infile, valid_fields, cols_category, meta, data, indexer, groups)
+        except (IOError, OSError) as e:
+            print "could not save cache %s: %s" % (cache_file, e)
+
+    return data, meta['headers'], meta['names'], meta['seman'], meta['types'], indexer, groups, meta['ref_maps_from'], meta['query_maps_from'], meta['filters']
+
+
+
+def write_rows(fhd, table, names, rows=None):
+    """
+    Writes the names columns of rows (default all) as tab separated lines
+    """
+    from om_io import get_format_plan
+    get_format_plan(names).write(fhd, table, rows=rows)
+
+def as_parsed(table, valid_fields):
+    """
+    The table as parse_file reads it back once a tool has written it: the
+    valid_fields columns only, in their order and types, with the floats
+    rounded to the 12 digits written by str()
+    """
+    from om_table import XmapTable, StringColumn, CategoryColumn, col_dtypes
+
+    columns = []
+    for name in valid_fields['names']:
+        column = table.column(name)
+        kind   = col_kind(valid_fields, name)
+
+        if   kind == 'category':
+            if not isinstance(column, CategoryColumn):
+                column = CategoryColumn.from_list(column.tolist())
+
+        elif kind == 'string':
+            if not isinstance(column, StringColumn):
+                column = StringColumn.from_list([ str(x) for x in column.tolist() ])
+
+        elif kind == 'float':
+            column = np.array([ float(str(x)) for x in column.tolist() ], dtype=np.float64)
+
+        else:
+            column = np.asarray(column, dtype=col_dtypes[kind][0])
+
+        columns.append([ name, column ])
+
+    return XmapTable(list(valid_fields['names']), columns)
+
+def runs_of(*keys):
+    """
+    Start of every run of equal keys in arrays sorted by those keys, and the
+    run number of every position
+    """
+    num = len(keys[0])
+    if num == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    change     = np.zeros(num, dtype=np.bool_)
+    change[0]  = True
+    for key in keys:
+        change[1:] |= key[1:] != key[:-1]
+
+    return np.flatnonzero(change), np.cumsum(change) - 1
+
+def query_stats(data, mask=None):
+    """
+    Per query statistics of all (RefContigID, QryContigID) pairs in a few
+    grouped passes over the columns. Only the rows set in mask are taken
+    into account, so om_filter can recalculate them over the rows left.
+
+    Returns (rows, stats): rows are the row ids in mask ordered by
+    RefContigID, QryContigID and file order, as written by the tools, and
+    stats maps every per query _meta_ field to its values for those rows.
+    Confidence ties go to the lowest XmapEntryID.
+    """
+    if mask is None:
+        rows = np.arange(len(data), dtype=np.int64)
+    else:
+        rows = np.flatnonzero(mask)
+
+    ref_ids      = data.column("RefContigID")
+    qry_ids      = data.column("QryContigID")
+    rows         = rows[ np.lexsort((qry_ids[rows], ref_ids[rows])) ]
+    refs         = ref_ids[rows]
+    qrys         = qry_ids[rows]
+
+    #(RefContigID, QryContigID) pairs
+    pair_starts, pair_of_row = runs_of(refs, qrys)
+    num_pairs    = len(pair_starts)
+    pair_refs    = refs[pair_starts]
+    pair_qrys    = qrys[pair_starts]
+
+    def match_lens(col_start, col_end):
+        starts   = data.column(col_start)[rows]
+        ends     = data.column(col_end  )[rows]
+        lo       = np.minimum(starts, ends)
+        hi       = np.maximum(starts, ends)
+        no_gap   = np.bincount(pair_of_row, weights=hi - lo, minlength=num_pairs)
+        if num_pairs == 0:
+            #bincount of nothing is int, the lengths are always float
+            no_gap   = no_gap.astype(np.float64)
+            return no_gap, no_gap
+        gapped   = np.maximum.reduceat(hi, pair_starts) - np.minimum.reduceat(lo, pair_starts)
+        return gapped, no_gap
+
+    ref_gap_len, ref_no_gap_len = match_lens("RefStartPos", "RefEndPos")
+    qry_gap_len, qry_no_gap_len = match_lens("QryStartPos", "QryEndPos")
+
+    orientations = data.column("Orientation")
+    orientations = getattr(orientations, 'codes', orientations)
+    num_orientations, _ = count_label_runs(pair_of_row, orientations[rows], num_pairs)
+
+    #per query, over every reference it matches
+    qry_rows     = rows[ np.lexsort((data.column("XmapEntryID")[rows], qry_ids[rows])) ]
+    qry_starts, qry_of_row = runs_of(qry_ids[qry_rows])
+    qry_keys     = qry_ids[qry_rows][qry_starts]
+    confidences  = data.column("Confidence")[qry_rows]
+
+    if len(qry_rows) > 0:
+        max_confidence       = np.maximum.reduceat(confidences, qry_starts)
+    else:
+        max_confidence       = confidences
+    max_pos      = np.flatnonzero(confidences == max_confidence[qry_of_row])
+    max_pos      = max_pos[ runs_of(qry_of_row[max_pos])[0] ]
+    max_confidence_chrom = ref_ids[qry_rows[max_pos]]
+
+    match_order  = np.lexsort((pair_refs, pair_qrys))
+    match_starts, _ = runs_of(pair_qrys[match_order])
+    num_qry_matches = np.diff(np.append(match_starts, num_pairs))
+    match_refs   = pair_refs[match_order].tolist()
+    qry_matches  = [ ','.join([ str(x) for x in match_refs[start:end] ]) for start, end in zip(match_starts.tolist(), match_starts[1:].tolist() + [num_pairs]) ]
+
+    pair_qry     = np.searchsorted(qry_keys, pair_qrys)
+    row_qry      = pair_qry[pair_of_row]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        proportion_sizes_gapped = ref_gap_len    / qry_gap_len
+        proportion_sizes_no_gap = ref_no_gap_len / qry_no_gap_len
 
     stats = {}
-    stats["_meta_is_max_confidence_for_qry_chrom"      ] = max_confidence_chrom == RefContigID
-    
-    stats["_meta_len_ref_match_gapped"                 ] = ref_gap_len
-    stats["_meta_len_ref_match_no_gap"                 ] = ref_no_gap_len
-    stats["_meta_len_qry_match_gapped"                 ] = qry_gap_len
-    stats["_meta_len_qry_match_no_gap"                 ] = qry_no_gap_len
+    stats["_meta_is_max_confidence_for_qry_chrom"      ] = ( max_confidence_chrom[pair_qry] == pair_refs )[pair_of_row]
+
+    stats["_meta_len_ref_match_gapped"                 ] = ref_gap_len   [pair_of_row]
+    stats["_meta_len_ref_match_no_gap"                 ] = ref_no_gap_len[pair_of_row]
+    stats["_meta_len_qry_match_gapped"                 ] = qry_gap_len   [pair_of_row]
+    stats["_meta_len_qry_match_no_gap"                 ] = qry_no_gap_len[pair_of_row]
 
-    stats["_meta_max_confidence_for_qry"               ] = max_confidence
-    stats["_meta_max_confidence_for_qry_chrom"         ] = max_confidence_chrom
+    stats["_meta_max_confidence_for_qry"               ] = max_confidence      [row_qry]
+    stats["_meta_max_confidence_for_qry_chrom"         ] = max_confidence_chrom[row_qry]
 
-    stats["_meta_num_orientations"                     ] = num_orientations
-    stats["_meta_num_qry_matches"                      ] = num_qry_matches
-    stats["_meta_qry_matches"                          ] = ','.join( [ str(x) for x in sorted(list(set([ x[1] for x in Confidences ]))) ] )
+    stats["_meta_num_orientations"                     ] = num_orientations[pair_of_row]
+    stats["_meta_num_qry_matches"                      ] = num_qry_matches [row_qry    ]
+    stats["_meta_qry_matches"                          ] = [ qry_matches[x] for x in row_qry.tolist() ]
 
-    stats["_meta_proportion_sizes_gapped"              ] = (ref_gap_len    * 1.0)/ qry_gap_len
-    stats["_meta_proportion_sizes_no_gap"              ] = (ref_no_gap_len * 1.0)/ qry_no_gap_len
+    stats["_meta_proportion_sizes_gapped"              ] = proportion_sizes_gapped[pair_of_row]
+    stats["_meta_proportion_sizes_no_gap"              ] = proportion_sizes_no_gap[pair_of_row]
 
-    return stats
+    return rows, stats
 
 valid_fields_g  = {
     'data':
@@ -0,0 +1,111 @@
+#!/usr/bin/python
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+"""
+Cold start budget of the standalone tools.
+
+Every tool is started a few times for --help / --list and once more on a one
+line XMAP, and the best wall time is compared with its budget. Budgets are in
+milliseconds on top of the start up of a bare interpreter, so that they hold
+on slower hosts too. The tools are byte compiled first, so that the times do
+not depend on whether .pyc files were left by an earlier run. Exits with 1
+if any tool is over budget.
+"""
+
+tiny_xmap = """# XMAP File Version:\t0.2
+# Label Channels:\t1
+# Reference Maps From:\tref_r.cmap
+# Query Maps From:\tqry_q.cmap
+#h XmapEntryID\tQryContigID\tRefContigID\tQryStartPos\tQryEndPos\tRefStartPos\tRefEndPos\tOrientation\tConfidence\tHitEnum\tQryLen\tRefLen\tLabelChannel\tAlignment
+#f int        \tint        \tint        \tfloat      \tfloat    \tfloat      \tfloat    \tstring     \tfloat     \tstring \tfloat \tfloat \tint         \tstring
+1\t141\t1\t528400.6\t571697.5\t10672.0\t54237.5\t+\t6.65\t4M2D2M\t1439123.5\t21805821.0\t1\t"(1,34)(2,34)(3,35)(4,36)(5,37)(6,38)(8,38)(9,39)"
+"""
+
+#name, arguments ({xmap} and {augmented} are replaced by the tiny inputs), budget ms
+startup_budgets = [
+    [ "om_filter --list"       , [ "om_filter.py"   , "{xmap}", "--list"              ],  40 ],
+    [ "om_filter --help"       , [ "om_filter.py"   , "--help"                        ],  40 ],
+    [ "om_augmenter --help"    , [ "om_augmenter.py", "--help"                        ],  40 ],
+    [ "om_to_gff --help"       , [ "om_to_gff.py"   , "--help"                        ],  40 ],
+    [ "om_to_delta --help"     , [ "om_to_delta.py" , "--help"                        ],  40 ],
+    [ "om_pipeline --help"     , [ "om_pipeline.py" , "--help"                        ],  40 ],
+    [ "om_augmenter tiny"      , [ "om_augmenter.py", "{xmap}"                        ], 150 ],
+    [ "om_filter tiny"         , [ "om_filter.py"   , "{augmented}", "-f", "Confidence:ge:1" ], 150 ],
+    [ "om_to_gff tiny"         , [ "om_to_gff.py"   , "{augmented}", "-n", "chr1"     ], 150 ],
+]
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description="Cold start budget of the standalone tools")
+    parser.add_argument( '-n'    , '--repeats', default=5  , type=int  , help="Runs per tool, the best one counts [default: 5]" )
+    parser.add_argument( '-s'    , '--scale'  , default=1.0, type=float, help="Multiply all budgets by this factor [default: 1.0]" )
+    parser.add_argument( '-p'    , '--python' , default=sys.executable , help="Interpreter to run the tools with" )
+
+    args    = parser.parse_args(args=args)
+
+    return args
+
+def best_time(cmd, repeats, cwd):
+    best = None
+    with open(os.devnull, 'w') as devnull:
+        for rep in xrange(repeats):
+            start = time.time()
+            ret   = subprocess.call(cmd, stdout=devnull, stderr=devnull, cwd=cwd)
+            took  = time.time() - start
+
+            if ret != 0:
+                print "command failed (%d): %s" % (ret, " ".join(cmd))
+                sys.exit(1)
+
+            if best is None or took < best:
+                best = took
+
+    return best * 1000.0
+
+def main(args):
+    src_dir   = os.path.dirname(os.path.abspath(__file__))
+    tmp_dir   = tempfile.mkdtemp(prefix="om_startup_")
+
+    try:
+        xmap      = os.path.join(tmp_dir, "tiny.xmap")
+        augmented = xmap + ".augmented.tsv"
+
+        with open(xmap, 'w') as fhd:
+            fhd.write(tiny_xmap)
+
+        with open(os.devnull, 'w') as devnull:
+            subprocess.call([ args.python, "-m", "compileall", "-q", "-l", src_dir ], stdout=devnull, stderr=devnull)
+            subprocess.check_call([ args.python, os.path.join(src_dir, "om_augmenter.py"), xmap ], stdout=devnull)
+
+        base = best_time([ args.python, "-c", "pass" ], args.repeats, tmp_dir)
+        print "%-24s %8.1f ms" % ( "interpreter", base )
+
+        over = []
+        for name, cmd, budget in startup_budgets:
+            budget = budget * args.scale
+            cmd    = [ args.python, os.path.join(src_dir, cmd[0]) ] + [ x.format(xmap=xmap, augmented=augmented) for x in cmd[1:] ]
+            took   = best_time(cmd, args.repeats, tmp_dir) - base
+            status = "ok"
+            if took > budget:
+                status = "OVER BUDGET"
+                over.append(name)
+            print "%-24s %8.1f ms  budget %6.1f ms  %s" % ( name, took, budget, status )
+
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    if len(over) > 0:
+        print "over budget:", ", ".join(over)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    args         = parse_args(sys.argv[1:])
+
+    main(args)
@@ -0,0 +1,297 @@
+#!/usr/bin/python
+
+import os
+import sys
+import json
+import argparse
+
+import numpy as np
+
+"""
+Seeded synthetic inputs for the standalone tools.
+
+A genome of --genome-size bases is split into --chromosomes chromosomes,
+each one laid out as scaffolds separated by gaps. From that layout come
+
+    <prefix>.xmap   optical map alignments: --rows rows over all chromosomes,
+                    a third of the queries aligning more than once, with
+                    HitEnum and Alignment strings of 4 to 400 label pairs
+    <prefix>.agp    the chromosomes as scaffolds (components) and gaps
+    <prefix>.fa     the chromosome sequences, N runs at the gaps of the AGP
+
+The same seed and sizes always give the same files. Everything is made in
+batches of numpy arrays, so 10M rows or a 3 Gbp FASTA only take the time to
+format and write them:
+
+    om_synth.py bench -r 1000000 -g 900000000
+"""
+
+label_spacing    = 10000.0      #mean distance between labels
+fasta_line_width = 60
+xmap_batch_rows  = 50000
+fasta_batch      = fasta_line_width * 65536
+
+chrom_prefix     = "SL2.50ch"
+scaffold_prefix  = "SL2.40sc"
+
+xmap_header      = """# XMAP File Version:\t0.2
+# Label Channels:\t1
+# Reference Maps From: %(prefix)s_r.cmap
+# Query Maps From:     %(prefix)s_q.cmap
+#h XmapEntryID\tQryContigID\tRefContigID\tQryStartPos\tQryEndPos\tRefStartPos\tRefEndPos\tOrientation\tConfidence\tHitEnum\tQryLen\tRefLen\tLabelChannel\tAlignment
+#f int        \tint        \tint        \tfloat      \tfloat    \tfloat      \tfloat    \tstring     \tfloat     \tstring \tfloat \tfloat \tint         \tstring
+"""
+
+xmap_row_fmt     = "%d\t%d\t%d\t%.1f\t%.1f\t%.1f\t%.1f\t%s\t%.2f\t%s\t%.1f\t%.1f\t1\t\"%s\"\n"
+
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description="Seeded synthetic XMAP, AGP and FASTA files")
+    parser.add_argument( 'prefix'                          ,                                 help="Output prefix. Writes <prefix>.xmap, <prefix>.agp and <prefix>.fa" )
+    parser.add_argument( '-r'    , '--rows'                , default=100000   , type=int   , help="XMAP rows [default: 100000]" )
+    parser.add_argument( '-g'    , '--genome-size'         , default=100000000, type=int   , help="Genome size in bp [default: 100000000]" )
+    parser.add_argument( '-c'    , '--chromosomes'         , default=12       , type=int   , help="Number of chromosomes [default: 12]" )
+    parser.add_argument( '-s'    , '--seed'                , default=1        , type=int   , help="Random seed [default: 1]" )
+    parser.add_argument( '-o'    , '--only'                , choices=['xmap', 'agp', 'fasta'], action='append', help="Write only these files" )
+    parser.add_argument( '-p'    , '--paths'               , action='store'   ,              help="Also save the paths written and the chromosome names to this JSON file" )
+
+    args    = parser.parse_args(args=args)
+
+    return args
+
+
+
+class Genome(object):
+    """
+    Chromosome lengths and their scaffold / gap layout. Each layout line is
+    [start, end, scaffold number or 0 for a gap, orientation], 1 based.
+    """
+    def __init__(self, genome_size, num_chroms, seed):
+        rng              = np.random.RandomState(seed)
+        weights          = rng.uniform(0.5, 1.5, num_chroms)
+        self.lengths     = np.maximum(( weights / weights.sum() * genome_size ).astype(np.int64), 1000)
+        self.names       = [ "%s%02d" % ( chrom_prefix, x + 1 ) for x in xrange(num_chroms) ]
+        self.layouts     = []
+
+        scaffold         = 0
+        for length in self.lengths.tolist():
+            num_parts    = int(min(max(length // 2000000, 3), 2000))
+            sizes        = rng.uniform(0.2, 1.8, num_parts)
+            gaps         = np.where(rng.uniform(size=num_parts - 1) < 0.7, 100, rng.randint(1000, 100000, num_parts - 1))
+            gaps         = np.minimum(gaps, max(length // ( 10 * num_parts ), 1))
+            sizes        = np.maximum(( sizes / sizes.sum() * ( length - gaps.sum() ) ).astype(np.int64), 1)
+            sizes[-1]    = length - gaps.sum() - sizes[:-1].sum()
+            orients      = rng.choice(['+', '-', '+', '?'], num_parts)
+
+            layout       = []
+            pos          = 1
+            for part in xrange(num_parts):
+                scaffold += 1
+                layout.append([ pos, pos + sizes[part] - 1, scaffold, orients[part] ])
+                pos      += sizes[part]
+                if part < num_parts - 1:
+                    layout.append([ pos, pos + gaps[part] - 1, 0, '.' ])
+                    pos  += gaps[part]
+            self.layouts.append(layout)
+
+    def __len__(self):
+        return len(self.lengths)
+
+
+
+def write_agp(path, genome):
+    with open(path, 'w') as fhd:
+        fhd.write("##agp-version\t2.0\n")
+        for name, layout in zip(genome.names, genome.layouts):
+            for part, ( start, end, scaffold, orient ) in enumerate(layout):
+                if scaffold == 0:
+                    size = end - start + 1
+                    if size == 100:
+                        fhd.write("%s\t%d\t%d\t%d\tU\t100\tcontig\tno\n" % ( name, start, end, part + 1 ))
+                    else:
+                        fhd.write("%s\t%d\t%d\t%d\tN\t%d\tscaffold\tyes\tmap\n" % ( name, start, end, part + 1, size ))
+                else:
+                    fhd.write("%s\t%d\t%d\t%d\tW\t%s%05d\t1\t%d\t%s\n" % ( name, start, end, part + 1, scaffold_prefix, scaffold, end - start + 1, orient ))
+
+def write_fasta(path, genome, seed):
+    rng   = np.random.RandomState(seed + 1)
+    bases = np.frombuffer("ACGTacgt", dtype=np.uint8)
+
+    with open(path, 'wb') as fhd:
+        for name, length, layout in zip(genome.names, genome.lengths.tolist(), genome.layouts):
+            fhd.write(">%s\n" % name)
+            gaps = np.array([ [ x[0] - 1, x[1] ] for x in layout if x[2] == 0 ], dtype=np.int64).reshape(-1, 2)
+
+            for start in xrange(0, length, fasta_batch):
+                size = min(fasta_batch, length - start)
+                #a tenth of the bases soft masked, in runs of 1 kbp
+                seq  = bases[rng.randint(0, 4, size) + 4 * ( rng.uniform(size=( size + 999 ) // 1000) < 0.1 ).repeat(1000)[:size]]
+
+                for gap_start, gap_end in gaps[( gaps[:, 1] > start ) & ( gaps[:, 0] < start + size )].tolist():
+                    seq[max(gap_start - start, 0):min(gap_end - start, size)] = ord('N')
+
+                full = size // fasta_line_width * fasta_line_width
+                if full > 0:
+                    lines = np.empty(( full // fasta_line_width, fasta_line_width + 1 ), dtype=np.uint8)
+                    lines[:, :-1] = seq[:full].reshape(-1, fasta_line_width)
+                    lines[:,  -1] = ord('\n')
+                    fhd.write(lines.tostring())
+                if full < size:
+                    fhd.write(seq[full:].tostring() + "\n")
+
+def hit_enum_tokens():
+    """
+    Text of a count and op, for the counts up to 1000
+    """
+    return dict([ ( op, [ "%d%s" % ( x, op ) for x in xrange(1001) ] ) for op in "MID" ])
+
+def xmap_batch(rng, genome, ref_weights, qry_lens, first_id, num_rows, tokens):
+    """
+    Text of num_rows XMAP rows
+    """
+    num_qrys    = len(qry_lens)
+    ref_ids     = rng.choice(len(genome), num_rows, p=ref_weights)
+    qry_ids     = rng.randint(0, num_qrys, num_rows)
+    reverse     = rng.uniform(size=num_rows) < 0.5
+    confidence  = np.minimum(rng.gamma(2.0, 12.0, num_rows) + 3.0, 200.0)
+
+    #label pairs: steps of the reference and of the query label between pairs
+    num_pairs   = np.clip(rng.lognormal(np.log(30), 0.6, num_rows), 4, 400).astype(np.int64)
+    pair_rows   = np.repeat(np.arange(num_rows), num_pairs)
+    first_pair  = np.zeros(num_rows + 1, dtype=np.int64)
+    np.cumsum(num_pairs, out=first_pair[1:])
+    ref_steps   = rng.choice([0, 1, 2, 3], len(pair_rows), p=[0.02, 0.85, 0.10, 0.03])
+    qry_steps   = rng.choice([0, 1, 2, 3], len(pair_rows), p=[0.02, 0.88, 0.08, 0.02])
+    ref_steps[first_pair[:-1]] = 0
+    qry_steps[first_pair[:-1]] = 0
+    #no pair twice in a row
+    both_zero   = ( ref_steps == 0 ) & ( qry_steps == 0 )
+    both_zero[first_pair[:-1]] = False
+    ref_steps[both_zero] = 1
+
+    ref_walk    = np.cumsum(ref_steps)
+    qry_walk    = np.cumsum(qry_steps)
+    ref_walk   -= np.repeat(ref_walk[first_pair[:-1]], num_pairs)
+    qry_walk   -= np.repeat(qry_walk[first_pair[:-1]], num_pairs)
+    ref_span_l  = ref_walk[first_pair[1:] - 1]
+    qry_span_l  = qry_walk[first_pair[1:] - 1]
+
+    #coordinates
+    ref_lens    = genome.lengths[ref_ids].astype(np.float64)
+    qlens       = qry_lens[qry_ids]
+    span        = np.minimum(rng.gamma(np.maximum(ref_span_l, 1), label_spacing), np.minimum(qlens, ref_lens) * 0.95)
+    ref_start   = np.floor(rng.uniform(size=num_rows) * ( ref_lens - span )) + 1
+    ref_end     = ref_start + span
+    qry_left    = np.round(rng.uniform(size=num_rows) * ( qlens - span ), 1)
+    qry_span    = np.minimum(span * rng.uniform(0.97, 1.03, num_rows), qlens - qry_left)
+    qry_start   = np.where(reverse, qlens - qry_left, qry_left)
+    qry_end     = np.where(reverse, qry_start - qry_span, qry_start + qry_span)
+
+    ref_first   = ( ref_start / label_spacing ).astype(np.int64) + 1
+    qry_first   = ( qry_left  / label_spacing ).astype(np.int64) + 1
+    qry_first   = np.where(reverse, qry_first + qry_span_l, qry_first)
+    ref_labels  = np.repeat(ref_first, num_pairs) + ref_walk
+    qry_labels  = np.where(np.repeat(reverse, num_pairs), np.repeat(qry_first, num_pairs) - qry_walk, np.repeat(qry_first, num_pairs) + qry_walk)
+
+    #HitEnum: one M per pair, D for the reference labels and I for the query
+    #labels skipped after it, consecutive M merged
+    next_ref    = np.append(ref_steps[1:], 0)
+    next_qry    = np.append(qry_steps[1:], 0)
+    last_pair   = np.zeros(len(pair_rows), dtype=np.bool_)
+    last_pair[first_pair[1:] - 1] = True
+    dels        = np.where(last_pair, 0, np.maximum(next_ref - 1, 0))
+    ins         = np.where(last_pair, 0, np.maximum(next_qry - 1, 0))
+    m_break     = ( dels > 0 ) | ( ins > 0 ) | last_pair
+    m_ends      = np.flatnonzero(m_break)
+    m_starts    = np.append(0, m_ends[:-1] + 1)
+    m_starts    = np.maximum(m_starts, first_pair[pair_rows[m_ends]])
+    m_runs      = np.minimum(m_ends - m_starts + 1, 1000).tolist()
+    dels_m      = np.minimum(dels[m_ends], 1000).tolist()
+    ins_m       = np.minimum(ins [m_ends], 1000).tolist()
+    run_row     = pair_rows[m_ends]
+    run_first   = np.searchsorted(run_row, np.arange(num_rows + 1)).tolist()
+
+    m_tok, i_tok, d_tok = tokens['M'], tokens['I'], tokens['D']
+    run_text    = [ m_tok[m] + ( d_tok[d] if d > 0 else "" ) + ( i_tok[i] if i > 0 else "" ) for m, d, i in zip(m_runs, dels_m, ins_m) ]
+
+    labels      = np.empty(2 * len(pair_rows), dtype=np.int64)
+    labels[0::2] = ref_labels
+    labels[1::2] = np.maximum(qry_labels, 1)
+    labels      = labels.tolist()
+    pair_first  = ( 2 * first_pair ).tolist()
+
+    rows        = zip(
+        xrange(first_id, first_id + num_rows), ( qry_ids + 1 ).tolist(), ( ref_ids + 1 ).tolist(),
+        qry_start.tolist(), qry_end.tolist(), ref_start.tolist(), ref_end.tolist(),
+        np.where(reverse, '-', '+').tolist(), confidence.tolist(), qlens.tolist(), ref_lens.tolist(), num_pairs.tolist()
+    )
+
+    text        = []
+    pair_fmt    = {}
+    for row, ( xid, qid, rid, qs, qe, rs, re_, orient, conf, qlen, rlen, pairs ) in enumerate(rows):
+        fmt = pair_fmt.get(pairs)
+        if fmt is None:
+            fmt = pair_fmt[pairs] = "(%d,%d)" * pairs
+        alignment = fmt % tuple(labels[pair_first[row]:pair_first[row+1]])
+        hit_enum  = "".join(run_text[run_first[row]:run_first[row+1]])
+        text.append(xmap_row_fmt % ( xid, qid, rid, qs, qe, rs, re_, orient, conf, hit_enum, qlen, rlen, alignment ))
+
+    return "".join(text)
+
+def write_xmap(path, genome, num_rows, seed, prefix="synth"):
+    rng         = np.random.RandomState(seed + 2)
+    ref_weights = genome.lengths / float(genome.lengths.sum())
+    #every query has two alignments on average, a third of them more than one
+    num_qrys    = max(num_rows * 2 // 3, 1)
+    qry_lens    = np.round(rng.uniform(150000, 2500000, num_qrys), 1)
+    tokens      = hit_enum_tokens()
+
+    with open(path, 'w') as fhd:
+        fhd.write(xmap_header % { 'prefix': prefix })
+        for first in xrange(0, num_rows, xmap_batch_rows):
+            fhd.write(xmap_batch(rng, genome, ref_weights, qry_lens, first + 1, min(xmap_batch_rows, num_rows - first), tokens))
+
+def generate(prefix, rows=100000, genome_size=100000000, chromosomes=12, seed=1, only=None):
+    """
+    Writes the synthetic files of prefix and returns their paths and the
+    chromosome names
+    """
+    genome = Genome(genome_size, chromosomes, seed)
+    paths  = {
+        'xmap' : prefix + ".xmap",
+        'agp'  : prefix + ".agp",
+        'fasta': prefix + ".fa",
+    }
+
+    if only is None or 'agp' in only:
+        write_agp(paths['agp'], genome)
+
+    if only is None or 'fasta' in only:
+        write_fasta(paths['fasta'], genome, seed)
+
+    if only is None or 'xmap' in only:
+        write_xmap(paths['xmap'], genome, rows, seed, prefix=os.path.basename(prefix))
+
+    paths['names'] = genome.names
+    return paths
+
+def main(args):
+    print "GENERATING", args.prefix
+    paths = generate(args.prefix, rows=args.rows, genome_size=args.genome_size, chromosomes=args.chromosomes, seed=args.seed, only=args.only)
+    print json.dumps(paths, indent=1, sort_keys=True)
+
+    if args.paths is not None:
+        with open(args.paths, 'w') as fhd:
+            json.dump(paths, fhd, indent=1, sort_keys=True)
+
+
+
+if __name__ == '__main__':
+    if len(sys.argv) ==1:
+        print "no arguments given"
+        sys.exit(1)
+
+    args         = parse_args(sys.argv[1:])
+
+    main(args)
@@ -0,0 +1,364 @@
+import array
+
+import numpy as np
+
+"""
+Columnar storage for XMAP tables.
+
+Every column is kept as a single typed array instead of one boxed python
+object per cell:
+
+    int      -> int32   array
+    float    -> float64 array
+    bool     -> bool    array
+    category -> int8    codes + list of category labels (eg. Orientation)
+    string   -> one uint8 buffer + int64 offsets (eg. HitEnum, Alignment)
+"""
+
+col_dtypes = {
+    #type       numpy dtype   array.array typecode
+    'int'   : [ np.int32    , 'i' ],
+    'float' : [ np.float64  , 'd' ],
+    'bool'  : [ np.bool_    , 'b' ],
+}
+
+
+
+class StringColumn(object):
+    """
+    Strings stored back to back in one buffer. Row i is buffer[offsets[i]:offsets[i+1]]
+    """
+    __slots__ = ('buffer', 'offsets')
+
+    def __init__(self, buffer, offsets):
+        self.buffer  = buffer
+        self.offsets = offsets
+
+    @classmethod
+    def from_list(cls, vals):
+        lens    = np.fromiter((len(x) for x in vals), dtype=np.int64, count=len(vals))
+        offsets = np.zeros(len(vals) + 1, dtype=np.int64)
+        np.cumsum(lens, out=offsets[1:])
+        buffer  = np.frombuffer("".join(vals), dtype=np.uint8) if offsets[-1] > 0 else np.zeros(0, dtype=np.uint8)
+        return cls(buffer, offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, pos):
+        return self.buffer[self.offsets[pos]:self.offsets[pos+1]].tostring()
+
+    def __iter__(self):
+        for pos in xrange(len(self)):
+            yield self[pos]
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def take(self, rows):
+        rows    = np.asarray(rows, dtype=np.int64)
+        starts  = self.offsets[rows]
+        lens    = self.offsets[rows + 1] - starts
+        offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum(lens, out=offsets[1:])
+        #gather every selected byte at once: byte j of the new buffer comes from starts[row] + (j - offsets[row])
+        shift   = np.repeat(starts - offsets[:-1], lens)
+        buffer  = self.buffer[np.arange(offsets[-1], dtype=np.int64) + shift]
+        return StringColumn(buffer, offsets)
+
+    def tolist(self, rows=None):
+        if rows is None:
+            rows = xrange(len(self))
+        return [ self[x] for x in rows ]
+
+class CategoryColumn(object):
+    """
+    Small set of string labels stored as int8 codes
+    """
+    __slots__ = ('codes', 'categories')
+
+    def __init__(self, codes, categories):
+        self.codes      = codes
+        self.categories = categories
+
+    @classmethod
+    def from_list(cls, vals, categories=None):
+        categories = list(categories or [])
+        lookup     = dict([ (c, p) for p, c in enumerate(categories) ])
+        codes      = np.zeros(len(vals), dtype=np.int8)
+        for pos, val in enumerate(vals):
+            if val not in lookup:
+                lookup[val] = len(categories)
+                categories.append(val)
+            codes[pos] = lookup[val]
+        return cls(codes, categories)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, pos):
+        return self.categories[self.codes[pos]]
+
+    def __iter__(self):
+        for code in self.codes:
+            yield self.categories[code]
+
+    def code(self, val):
+        if val in self.categories:
+            return self.categories.index(val)
+        return -1
+
+    def take(self, rows):
+        return CategoryColumn(self.codes[np.asarray(rows, dtype=np.int64)], self.categories)
+
+    def tolist(self, rows=None):
+        codes = self.codes if rows is None else self.codes[np.asarray(rows, dtype=np.int64)]
+        return [ self.categories[x] for x in codes.tolist() ]
+
+
+
+def column_tolist(column, rows=None):
+    """
+    Column values as plain python objects (so that str() prints them as the
+    original row based code did)
+    """
+    if isinstance(column, (StringColumn, CategoryColumn)):
+        return column.tolist(rows)
+    if rows is None:
+        return column.tolist()
+    return column[np.asarray(rows, dtype=np.int64)].tolist()
+
+def column_take(column, rows):
+    if isinstance(column, (StringColumn, CategoryColumn)):
+        return column.take(rows)
+    return column[np.asarray(rows, dtype=np.int64)]
+
+def column_concat(columns):
+    """
+    The rows of columns one after the other, stored as the first column is
+    """
+    first = columns[0]
+
+    if isinstance(first, StringColumn):
+        lens    = np.concatenate([ x.lengths() for x in columns ])
+        offsets = np.zeros(len(lens) + 1, dtype=np.int64)
+        np.cumsum(lens, out=offsets[1:])
+        return StringColumn(np.concatenate([ x.buffer for x in columns ]), offsets)
+
+    if isinstance(first, CategoryColumn):
+        categories = list(first.categories)
+        codes      = []
+        for column in columns:
+            for val in column.categories:
+                if val not in categories:
+                    categories.append(val)
+            recode = np.array([ categories.index(x) for x in column.categories ], dtype=np.int8)
+            codes.append( recode[column.codes] )
+        return CategoryColumn(np.concatenate(codes), categories)
+
+    return np.concatenate([ np.asarray(x, dtype=first.dtype) for x in columns ])
+
+
+
+class ColumnBuilder(object):
+    """
+    Append only column used while parsing. Values are stored unboxed as they
+    arrive so that the peak memory is close to the final column size.
+    """
+    def __init__(self, kind):
+        self.kind = kind
+
+        if   kind == 'string':
+            self.buffer     = bytearray()
+            self.offsets    = array.array('l', [0])
+
+        elif kind == 'category':
+            self.codes      = array.array('b')
+            self.categories = []
+            self.lookup     = {}
+
+        else:
+            self.vals       = array.array(col_dtypes[kind][1])
+
+    def append(self, val):
+        if   self.kind == 'string':
+            self.buffer    += val
+            self.offsets.append(len(self.buffer))
+
+        elif self.kind == 'category':
+            code = self.lookup.get(val)
+            if code is None:
+                code             = len(self.categories)
+                self.lookup[val] = code
+                self.categories.append(val)
+            self.codes.append(code)
+
+        else:
+            self.vals.append(val)
+
+    def finish(self):
+        if   self.kind == 'string':
+            #array('l') is 4 or 8 bytes wide depending on the platform
+            offsets = np.frombuffer(self.offsets, dtype='i%d' % self.offsets.itemsize).astype(np.int64)
+            return StringColumn(np.frombuffer(self.buffer, dtype=np.uint8) if len(self.buffer) > 0 else np.zeros(0, dtype=np.uint8), offsets)
+
+        elif self.kind == 'category':
+            return CategoryColumn(np.frombuffer(self.codes, dtype=np.int8) if len(self.codes) > 0 else np.zeros(0, dtype=np.int8), self.categories)
+
+        else:
+            dtype = col_dtypes[self.kind][0]
+            if len(self.vals) == 0:
+                return np.zeros(0, dtype=dtype)
+            return np.frombuffer(self.vals, dtype=dtype)
+
+
+
+class XmapRow(object):
+    """
+    View of one row of a XmapTable with dict like access. Nothing is copied
+    out of the columns; values assigned to the row are kept in a small
+    overlay that is only created on the first assignment.
+    """
+    __slots__ = ('table', 'pos', 'overlay')
+
+    def __init__(self, table, pos):
+        self.table   = table
+        self.pos     = pos
+        self.overlay = None
+
+    def __getitem__(self, name):
+        if self.overlay is not None and name in self.overlay:
+            return self.overlay[name]
+        if name not in self.table.columns:
+            raise KeyError(name)
+        return self.table.get(self.pos, name)
+
+    def __setitem__(self, name, val):
+        if self.overlay is None:
+            self.overlay = {}
+        self.overlay[name] = val
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __contains__(self, name):
+        return name in self.table.columns or ( self.overlay is not None and name in self.overlay )
+
+    def get(self, name, default=None):
+        if name in self:
+            return self[name]
+        return default
+
+    def keys(self):
+        keys = list(self.table.names)
+        if self.overlay is not None:
+            keys.extend([ x for x in self.overlay if x not in self.table.columns ])
+        return keys
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def items(self):
+        return [ (x, self[x]) for x in self.keys() ]
+
+    def _asdict(self):
+        return dict(self.items())
+
+    def __repr__(self):
+        return "XmapRow(%d, %r)" % ( self.pos, self._asdict() )
+
+
+
+class XmapTable(object):
+    """
+    Column oriented XMAP table.
+
+    table[pos] returns a XmapRow view of the row, table.column(name) returns
+    the whole typed column.
+    """
+    def __init__(self, names, columns):
+        self.names   = list(names)
+        self.columns = dict(columns)
+
+    @classmethod
+    def builder(cls, names, kinds):
+        return XmapTableBuilder(names, kinds)
+
+    def __len__(self):
+        if len(self.names) == 0:
+            return 0
+        return len(self.columns[self.names[0]])
+
+    def __contains__(self, name):
+        return name in self.columns
+
+    def __getitem__(self, pos):
+        return self.row(pos)
+
+    def column(self, name):
+        return self.columns[name]
+
+    def get(self, pos, name):
+        column = self.columns[name]
+        if isinstance(column, (StringColumn, CategoryColumn)):
+            return column[pos]
+        return column[pos].item()
+
+    def row(self, pos):
+        return XmapRow(self, pos)
+
+    def set_column(self, name, values):
+        if isinstance(values, list):
+            values = StringColumn.from_list(values)
+        assert len(self.names) == 0 or len(values) == len(self), "column %s has %d rows, table has %d" % (name, len(values), len(self))
+        if name not in self.columns:
+            self.names.append(name)
+        self.columns[name] = values
+
+    def take(self, rows):
+        return XmapTable(self.names, [ (name, column_take(self.columns[name], rows)) for name in self.names ])
+
+    @classmethod
+    def concat(cls, tables):
+        """
+        The rows of tables one after the other, with the columns of the first
+        """
+        names = tables[0].names
+        return cls(names, [ (name, column_concat([ x.column(name) for x in tables ])) for name in names ])
+
+    def tolist(self, name, rows=None):
+        return column_tolist(self.columns[name], rows)
+
+    def iter_rows(self, names, rows=None, chunk_rows=10000):
+        """
+        Yields one list of python values per row, in the order of names.
+        The columns are unboxed chunk_rows rows at a time.
+        """
+        if rows is None:
+            rows = np.arange(len(self), dtype=np.int64)
+        else:
+            rows = np.asarray(rows, dtype=np.int64)
+
+        for chunk_start in xrange(0, len(rows), chunk_rows):
+            chunk = rows[chunk_start:chunk_start+chunk_rows]
+            vals  = [ self.tolist(name, chunk) for name in names ]
+            for row_vals in zip(*vals):
+                yield row_vals
+
+class XmapTableBuilder(object):
+    def __init__(self, names, kinds):
+        self.names    = list(names)
+        self.builders = [ ColumnBuilder(kind) for kind in kinds ]
+
+    def append(self, vals):
+        for builder, val in zip(self.builders, vals):
+            builder.append(val)
+
+    def finish(self):
+        return XmapTable(self.names, [ (name, builder.finish()) for name, builder in zip(self.names, self.builders) ])
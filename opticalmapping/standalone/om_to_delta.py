@@ -8,18 +8,272 @@ from om_shared import *
 
 def parse_args(args):
     parser = argparse.ArgumentParser(description="Bionano Genomics augmented MAP to Mummerplot Delta converter")
-    parser.add_argument( '-r'    , '--reference',     action='store', help="reference fasfa file" )
-    parser.add_argument( '-q'    , '--query'    ,     action='store', help="query fasfa file"     )
+    parser.add_argument( '-r'    , '--reference',     action='store', help="reference fasfa file. Its sequence lengths replace RefLen" )
+    parser.add_argument( '-q'    , '--query'    ,     action='store', help="query fasfa file. Its sequence lengths replace QryLen"     )
     parser.add_argument( 'infile',                                    help="AUGMENTED file"                                         )
+    parser.add_argument( '-C'    , '--cache'    , action='store_true', help="Keep a binary parse cache next to the input file and reuse it" )
+    parser.add_argument( '-Z'    , '--compress' , choices=['gzip', 'bgzip'], help="Write the delta gzip or bgzip compressed" )
+    parser.add_argument( '-l'    , '--labels'   , action='store_true', help="Split the alignments into their aligned segments using the Alignment label pairs and the label positions of the CMAP files. Indels show as breaks between segments and skipped or collapsed labels as errors; the label pairs give no base positions, so the indel lists stay empty" )
+    parser.add_argument( '-m'    , '--max-indel', default=1000.0, type=float, help="With --labels, split an alignment where the distances between two aligned labels on the reference and on the query differ by more than this [default: 1000]" )
+    parser.add_argument( '--ref-cmap'           , action='store'     , help="Reference CMAP for --labels [default: Reference Maps From in the header]" )
+    parser.add_argument( '--qry-cmap'           , action='store'     , help="Query CMAP for --labels [default: Query Maps From in the header]"         )
+    add_profile_args(parser)
     
     args    = parser.parse_args(args=args)
 
     return args
 
+def fasta_lengths(path):
+    """
+    Sequence lengths of a FASTA file, in file order, from its .fai index
+    (built if missing). Contig id N is the Nth sequence, as numbered by
+    fa2cmap. None if path is not given or does not exist.
+    """
+    from om_fasta import sequence_lengths, FastaIndexError
+
+    if path is None:
+        return None
+
+    if not os.path.exists(path):
+        print "fasta file %s does not exists. using the lengths in the MAP" % path
+        return None
+
+    try:
+        return [ x[1] for x in sequence_lengths(path) ]
+    except FastaIndexError as e:
+        print e, "- using the lengths in the MAP"
+        return None
+
+def contig_length(lengths, contig_id, default):
+    if lengths is None or contig_id < 1 or contig_id > len(lengths):
+        return default
+    return lengths[contig_id - 1]
+
+class LabelSegments(object):
+    """
+    Aligned segments of the rows of a table, as found by label_segments.
+    The segments of row i are [offsets[i]:offsets[i+1]] of the other arrays.
+    """
+    def __init__(self, offsets, ref_starts, ref_ends, qry_starts, qry_ends, errors):
+        self.offsets    = offsets
+        self.ref_starts = ref_starts
+        self.ref_ends   = ref_ends
+        self.qry_starts = qry_starts
+        self.qry_ends   = qry_ends
+        self.errors     = errors
+        self.counts     = np.diff(offsets).tolist()
+
+    def __len__(self):
+        return len(self.errors)
+
+    def count(self, row):
+        return self.counts[row]
+
+    def text(self, row, sum_ref_len, sum_qry_len):
+        """
+        Delta alignment lines of the segments of row, shifted as the rows.
+        The indel list of every segment is empty (a lone 0): labels do not
+        tell where inside a segment the bases differ. The indels are the
+        breaks between segments, the skipped and collapsed labels the errors.
+        """
+        start = self.offsets[row  ]
+        stop  = self.offsets[row+1]
+        lines = zip(
+            self.ref_starts[start:stop].tolist(), self.ref_ends[start:stop].tolist(),
+            self.qry_starts[start:stop].tolist(), self.qry_ends[start:stop].tolist(),
+            self.errors    [start:stop].tolist()
+        )
+        return "".join([ "%d %d %d %d %d %d 0\n0\n" % ( int(rs + sum_ref_len), int(re + sum_ref_len), int(qs + sum_qry_len), int(qe + sum_qry_len), err, err ) for rs, re, qs, qe, err in lines ])
+
+def label_segments(data, ref_cmap, qry_cmap, max_indel=1000.0):
+    """
+    Splits every row of data into aligned segments using its Alignment
+    (ref label, qry label) pairs and the label positions of the CMAPs.
+
+    Two consecutive pairs stay in the same segment unless the distance
+    between their reference labels and between their query labels differ
+    by more than max_indel (an indel). The errors of a segment are the
+    labels skipped on either map between its pairs, plus one per label
+    aligned twice (a collapse). Indels are only counted as the breaks
+    between segments and skips as errors, no indel positions are kept.
+    Rows whose labels are not all in the CMAPs get no segments.
+
+    All rows are done at once: one decode of the Alignment column, one
+    lookup of the label positions and a few array operations over all the
+    pairs.
+    """
+    num_rows      = len(data)
+    pairs, poffs  = decode_alignments(data.column("Alignment"))
+    counts        = np.diff(poffs)
+    pair_rows     = np.repeat(np.arange(num_rows, dtype=np.int64), counts)
+
+    ref_labels    = pairs[:, 0].astype(np.int64)
+    qry_labels    = pairs[:, 1].astype(np.int64)
+
+    #pairs in reference label order within every row, as XMAP files have them
+    if not ( ( ref_labels[1:] >= ref_labels[:-1] ) | ( pair_rows[1:] != pair_rows[:-1] ) ).all():
+        order      = np.lexsort((ref_labels, pair_rows))
+        ref_labels = ref_labels[order]
+        qry_labels = qry_labels[order]
+
+    ref_ids       = np.asarray(data.column("RefContigID"), dtype=np.int64)
+    qry_ids       = np.asarray(data.column("QryContigID"), dtype=np.int64)
+    ref_pos       = ref_cmap.positions_of(ref_ids[pair_rows], ref_labels)
+    qry_pos       = qry_cmap.positions_of(qry_ids[pair_rows], qry_labels)
+
+    missing       = np.isnan(ref_pos) | np.isnan(qry_pos)
+    valid         = ( np.bincount(pair_rows, weights=missing, minlength=num_rows) == 0 ) & ( counts >= 2 )
+    ref_pos[missing] = 0
+    qry_pos[missing] = 0
+
+    #interval i goes from pair i to pair i + 1
+    same_row      = pair_rows[1:] == pair_rows[:-1]
+    ref_step      = ref_labels[1:] - ref_labels[:-1]
+    qry_step      = np.abs(qry_labels[1:] - qry_labels[:-1])
+    skips         = np.maximum(ref_step - 1, 0) + np.maximum(qry_step - 1, 0) + ( ( ref_step == 0 ) | ( qry_step == 0 ) )
+    indel         = np.abs(( ref_pos[1:] - ref_pos[:-1] ) - np.abs(qry_pos[1:] - qry_pos[:-1])) > max_indel
+    breaks        = ~same_row | indel
+
+    seg_starts    = np.append(0, np.flatnonzero(breaks) + 1)
+    seg_ends      = np.append(np.flatnonzero(breaks), len(pair_rows) - 1)
+    if len(pair_rows) == 0:
+        seg_starts = seg_ends = np.zeros(0, dtype=np.int64)
+
+    errors_sum    = np.zeros(len(pair_rows), dtype=np.int64)
+    np.cumsum(np.where(breaks, 0, skips), out=errors_sum[1:])
+    seg_errors    = errors_sum[seg_ends] - errors_sum[seg_starts]
+
+    #single label segments have no length
+    seg_rows      = pair_rows[seg_starts]
+    keep          = valid[seg_rows] & ( ref_pos[seg_ends] > ref_pos[seg_starts] )
+    seg_starts    = seg_starts[keep]
+    seg_ends      = seg_ends  [keep]
+
+    offsets       = np.zeros(num_rows + 1, dtype=np.int64)
+    np.cumsum(np.bincount(seg_rows[keep], minlength=num_rows), out=offsets[1:])
+
+    return LabelSegments(offsets, ref_pos[seg_starts], ref_pos[seg_ends], qry_pos[seg_starts], qry_pos[seg_ends], seg_errors[keep])
+
+def write_delta(fhd, data, groups, ref_maps_from, query_maps_from, reference=None, query=None, reference_lengths=None, query_lengths=None, segments=None):
+    """
+    reference_lengths and query_lengths, if given, replace the RefLen and
+    QryLen of the MAP by the lengths of the sequences in the FASTA files.
+    With segments (see label_segments) every row is written as its aligned
+    segments instead of a single block, rows without segments as before.
+    """
+    linecount = 0
+    #fhd.write("/home/assembly/nobackup/mummer/MUMmer3.23/1502/solanum_lycopersicum_heinz/SL2.40ch12.fa /home/assembly/nobackup/mummer/MUMmer3.23/1502/solanum_pennellii_scaffold/final.assembly.fasta\n")
+    if reference is not None and query is not None:
+        fhd.write("%s %s\n" % (reference, query))
+    else:
+        fhd.write("%s %s\n" % (ref_maps_from, query_maps_from))
+    
+    fhd.write("NUCMER\n")
+
+    sum_ref_len = 0
+    sum_qry_len = 0
+    
+    
+    done_QryContigID = {}
+    for RefContigID in sorted(groups["RefContigID_RefStartPos"]):
+        RefStartPoses = groups["RefContigID_RefStartPos"][RefContigID]
+        RefLen        = 0
+
+        for RefStartPosG in sorted(RefStartPoses):
+            pos_rows = list(RefStartPoses[RefStartPosG])
+            
+            for pos_row_pos in pos_rows:
+                QryContigID = data.get(pos_row_pos, "QryContigID")
+                
+                if QryContigID not in done_QryContigID:
+                    done_QryContigID[QryContigID] = {}
+                
+                first_time = True
+                
+                if RefContigID in done_QryContigID[QryContigID]:
+                    continue
+                
+                else:
+                    if len(done_QryContigID[QryContigID]) == 0:
+                        done_QryContigID[QryContigID][RefContigID] = sum_qry_len
+
+                    else:
+                        done_QryContigID[QryContigID][RefContigID] = done_QryContigID[QryContigID][done_QryContigID[QryContigID].keys()[0]]
+                        first_time = False
+                
+                sum_qry_len_local = done_QryContigID[QryContigID][RefContigID]
+                
+                line_count        = 0
+                qry_rows          = list(groups["RefContigID_QryContigID"][RefContigID][QryContigID])
+                
+                for qry_row_pos in qry_rows:
+                    qry_row     = data[qry_row_pos]
+                    
+                    RefStartPos = qry_row["RefStartPos"] + sum_ref_len
+                    RefEndPos   = qry_row["RefEndPos"  ] + sum_ref_len
+                    RefLen      = contig_length(reference_lengths, RefContigID, qry_row["RefLen"])
+                    
+                    QryStartPos = qry_row["QryStartPos"] + sum_qry_len_local
+                    QryEndPos   = qry_row["QryEndPos"  ] + sum_qry_len_local
+                    QryLen      = contig_length(query_lengths    , QryContigID, qry_row["QryLen"])
+                    
+                    num_errors  = 0
+                    sim_erros   = 0
+                    stop_codons = 0
+                    
+                    header      = [int(RefContigID), int(QryContigID), int(RefLen     ), int(QryLen   ) ]
+                    line        = [int(RefStartPos), int(RefEndPos  ), int(QryStartPos), int(QryEndPos), num_errors, sim_erros, stop_codons]
+
+                    if segments is not None and segments.count(qry_row_pos) > 0:
+                        text    = segments.text(qry_row_pos, sum_ref_len, sum_qry_len_local)
+                    else:
+                        text    =   " ".join([str(x) for x in line  ]) + "\n0\n"
+                    if line_count == 0:
+                        text    = ">" + " ".join([str(x) for x in header]) + "\n" + text
+
+                    fhd.write( text )
+
+                    line_count += 1
+                
+                if first_time:
+                    sum_qry_len += QryLen
+        
+        sum_ref_len += RefLen
+        #break
+
+
+
+def load_segments(infile, data, ref_maps_from, query_maps_from, ref_cmap=None, qry_cmap=None, max_indel=1000.0):
+    """
+    label_segments of data with the CMAPs given or named by the header of
+    infile. Exits if a CMAP cannot be found.
+    """
+    from om_cmap import load_cmap, find_cmap
+
+    cmaps = []
+    for path, maps_from, desc in ( ( ref_cmap, ref_maps_from, "ref" ), ( qry_cmap, query_maps_from, "qry" ) ):
+        if path is None:
+            path = find_cmap(infile, maps_from)
+
+        if path is None or not os.path.exists(path):
+            print "%s cmap %s does not exists. give it with --%s-cmap" % ( desc, path or maps_from, desc )
+            sys.exit(1)
+
+        print "LOADING CMAP", path
+        with profile_stage("cmap"):
+            cmaps.append(load_cmap(path))
+
+    with profile_stage("segments", rows=len(data)):
+        segments = label_segments(data, cmaps[0], cmaps[1], max_indel=max_indel)
+    print "split %d alignments in %d segments" % ( np.count_nonzero(np.diff(segments.offsets)), len(segments) )
+    return segments
+
 def main(args):
+    from om_io import open_output, output_name
+
     valid_fields        = gen_valid_fields(valid_fields_g)
     infile              = args.infile
-    oufile              = infile + ".delta"
+    oufile              = output_name(infile + ".delta", args.compress)
 
     if not os.path.exists(infile):
         print "input file %s does not exists" % infile
@@ -30,8 +284,9 @@ def main(args):
         sys.exit(1)
     
     print "saving to %s" % oufile
+    profile_output(oufile)
 
-    data, headers, names, seman, types, indexer, groups, ref_maps_from, query_maps_from, filters_csv = parse_file(infile, valid_fields)
+    data, headers, names, seman, types, indexer, groups, ref_maps_from, query_maps_from, filters_csv = parse_file(infile, valid_fields, cache=args.cache)
 
     print "NAMES"  , names
     #print "HEADERS", "\n".join( headers )
@@ -43,86 +298,13 @@ def main(args):
 
     
 
-    print "CREATING DELTA: ", oufile
-    with open(oufile, "w") as fhd:
-        linecount = 0
-        #fhd.write("/home/assembly/nobackup/mummer/MUMmer3.23/1502/solanum_lycopersicum_heinz/SL2.40ch12.fa /home/assembly/nobackup/mummer/MUMmer3.23/1502/solanum_pennellii_scaffold/final.assembly.fasta\n")
-        if args.reference is not None and args.query is not None:
-            fhd.write("%s %s\n" % (args.reference, args.query))
-        else:
-            fhd.write("%s %s\n" % (ref_maps_from, query_maps_from))
-        
-        fhd.write("NUCMER\n")
-
-        sum_ref_len = 0
-        sum_qry_len = 0
-        
-        data = [ KeyedTuple(x, labels=names)._asdict() for x in data ]
-        
-        done_QryContigID = {}
-        for RefContigID in sorted(groups["RefContigID_RefStartPos"]):
-            RefStartPoses = groups["RefContigID_RefStartPos"][RefContigID]
-            RefLen        = 0
-
-            for RefStartPosG in sorted(RefStartPoses):
-                pos_rows = list(RefStartPoses[RefStartPosG])
-                
-                for pos_row_pos in pos_rows:
-                    pos_row = data[pos_row_pos]
-
-                    QryContigID = pos_row["QryContigID"]
-                    
-                    if QryContigID not in done_QryContigID:
-                        done_QryContigID[QryContigID] = {}
-                    
-                    first_time = True
-                    
-                    if RefContigID in done_QryContigID[QryContigID]:
-                        continue
-                    
-                    else:
-                        if len(done_QryContigID[QryContigID]) == 0:
-                            done_QryContigID[QryContigID][RefContigID] = sum_qry_len
+    segments            = None
+    if args.labels:
+        segments        = load_segments(infile, data, ref_maps_from, query_maps_from, ref_cmap=args.ref_cmap, qry_cmap=args.qry_cmap, max_indel=args.max_indel)
 
-                        else:
-                            done_QryContigID[QryContigID][RefContigID] = done_QryContigID[QryContigID][done_QryContigID[QryContigID].keys()[0]]
-                            first_time = False
-                    
-                    sum_qry_len_local = done_QryContigID[QryContigID][RefContigID]
-                    
-                    line_count        = 0
-                    qry_rows          = list(groups["RefContigID_QryContigID"][RefContigID][QryContigID])
-                    
-                    for qry_row_pos in qry_rows:
-                        qry_row     = data[qry_row_pos]
-                        
-                        RefStartPos = qry_row["RefStartPos"] + sum_ref_len
-                        RefEndPos   = qry_row["RefEndPos"  ] + sum_ref_len
-                        RefLen      = qry_row["RefLen"     ]
-                        
-                        QryStartPos = qry_row["QryStartPos"] + sum_qry_len_local
-                        QryEndPos   = qry_row["QryEndPos"  ] + sum_qry_len_local
-                        QryLen      = qry_row["QryLen"     ]
-                        
-                        num_errors  = 0
-                        sim_erros   = 0
-                        stop_codons = 0
-                        
-                        header      = [int(RefContigID), int(QryContigID), int(RefLen     ), int(QryLen   ) ]
-                        line        = [int(RefStartPos), int(RefEndPos  ), int(QryStartPos), int(QryEndPos), num_errors, sim_erros, stop_codons]
-
-                        if line_count == 0:
-                            fhd.write(">" + " ".join([str(x) for x in header]) + "\n")
-
-                        fhd.write(      " ".join([str(x) for x in line  ]) + "\n0\n")
-
-                        line_count += 1
-                    
-                    if first_time:
-                        sum_qry_len += QryLen
-            
-            sum_ref_len += RefLen
-            #break
+    print "CREATING DELTA: ", oufile
+    with open_output(oufile, args.compress) as fhd, profile_stage("render", rows=len(data)):
+        write_delta(fhd, data, groups, ref_maps_from, query_maps_from, reference=args.reference, query=args.query, reference_lengths=fasta_lengths(args.reference), query_lengths=fasta_lengths(args.query), segments=segments)
         print
 
 
@@ -134,4 +316,5 @@ if __name__ == '__main__':
 
     args         = parse_args(sys.argv[1:])
 
-    main(args)
\ No newline at end of file
+    with profile_run("om_to_delta", args):
+        main(args)
\ No newline at end of file
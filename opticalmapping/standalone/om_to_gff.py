@@ -14,12 +14,26 @@ def parse_args(args):
     parser.add_argument( '-n'    , '--names',                                         action='store', help="Names of reference chromosome. Eg: Ch0|Ch1|Ch3 Ch0,Ch1,Ch2 Ch0:Ch1:Ch2" )
     parser.add_argument( '-f'    , '--names-from-file',                               action='store', help="File containing names of reference chromosome. One per line" )
     parser.add_argument( '-s'    , '--sep'  , '--separator',  default=",",                            help="Separator for chromosome names. Eg: | , :" )
+    parser.add_argument( '-C'    , '--cache',                                         action='store_true', help="Keep a binary parse cache next to the input file and reuse it" )
+    parser.add_argument( '-Z'    , '--compress',      choices=['gzip', 'bgzip'],                           help="Write the GFF gzip or bgzip compressed" )
+    parser.add_argument( '-I'    , '--index',                                         action='store_true', help="Write the GFF bgzip compressed with a region index (.omi) for om_query" )
+    add_profile_args(parser)
     
     ##genome-build source buildName
     ##species NCBI_Taxonomy_URI
     
     args    = parser.parse_args(args=args)
 
+    resolve_names(args)
+    resolve_index(args)
+
+    return args
+
+def resolve_names(args):
+    """
+    Fills args.names and args.exclude_cols in from the --names / --exclude-cols
+    lists or from the files given instead
+    """
     if args.names is None and args.names_from_file is None:
         print "either --names or --names-from-file has to be defined"
         sys.exit(1)
@@ -79,14 +93,79 @@ def parse_args(args):
     else:
         args.exclude_cols = []
 
-    return args
-
-def main(args):
-    valid_fields        = gen_valid_fields(valid_fields_g)
-    infile              = args.infile
-    chromosome_names    = args.names
-    exclude_cols        = args.exclude_cols
-    oufile              = infile + ".gff3"
+def resolve_index(args):
+    """
+    An indexed GFF is always bgzip compressed
+    """
+    if args.index:
+        if args.compress not in (None, 'bgzip'):
+            print "an indexed GFF can only be bgzip compressed"
+            sys.exit(1)
+        args.compress = 'bgzip'
+
+def ref_genes(data, groups, RefContigID):
+    """
+    (QryContigID, ascending row ids) of the queries aligned to RefContigID,
+    in the order of their first alignment by RefStartPos
+    """
+    by_start       = groups["RefContigID_RefStartPos"][RefContigID]
+    by_qry         = groups["RefContigID_QryContigID"][RefContigID]
+
+    rows           = by_start.rows[by_start.offsets[0]:by_start.offsets[-1]]
+    qry_ids, first = np.unique(data.column("QryContigID")[rows], return_index=True)
+    qry_ids        = qry_ids[np.argsort(first)]
+
+    pos            = np.searchsorted(by_qry.keys_arr, qry_ids)
+    starts         = by_qry.offsets[pos  ].tolist()
+    ends           = by_qry.offsets[pos+1].tolist()
+    return [ ( q, by_qry.rows[s:e] ) for q, s, e in zip(qry_ids.tolist(), starts, ends) ]
+
+def filter_attributes(filters):
+    """
+    The _meta_filter_ attributes of filters. Expressions are numbered,
+    _meta_filter_expr1, _meta_filter_expr2 ..., so that the tags stay unique
+    """
+    text  = ""
+    exprs = 0
+    for field_name, operator_name, operator_val, value_str, value in filters:
+        if operator_name == 'expr':
+            exprs += 1
+            text  += ";_meta_filter_expr%d=%s" % ( exprs, value_str )
+        else:
+            text  += ";_meta_filter_%s=%s_%s" % ( field_name.lower(), operator_name, str(value_str) )
+    return text
+
+class CdsPlan(object):
+    """
+    What every CDS line of write_gff shares, worked out once per run: the
+    attribute columns in order, lower cased and without the excluded ones,
+    and the _meta_filter_ attributes closing every line. The values are
+    then rendered batch_rows rows at a time, one column at a time.
+    """
+    def __init__(self, names, exclude_cols, filters, batch_rows=20000):
+        from om_io import get_format_plan
+
+        exclude          = set(exclude_cols)
+        self.batch_rows  = batch_rows
+        self.attr_names  = [ k for k in sorted(names) if k not in exclude ]
+        self.attr_tmpl   = "".join([ ";%s=%%s" % k.lower() for k in self.attr_names ])
+        self.filter_text = filter_attributes(filters)
+        self.format_plan = get_format_plan(self.attr_names)
+
+    def column_text(self, data, name, rows):
+        return self.format_plan.column_text(data, name, rows)
+
+    def attributes(self, data, rows):
+        """
+        Text of the column attributes of every row in rows
+        """
+        if len(self.attr_names) == 0:
+            return [ "" ] * len(rows)
+        cols = [ self.column_text(data, name, rows) for name in self.attr_names ]
+        tmpl = self.attr_tmpl
+        return [ tmpl % x for x in zip(*cols) ]
+
+def write_gff(fhd, data, indexer, groups, headers, filters, chromosome_names, exclude_cols):
     source_name         = "IrysView"
     feature_name_full   = "optical_contig"
     feature_name_piece  = "optical_contig_piece"
@@ -97,6 +176,153 @@ def main(args):
     
     id_prefix           = "om_"
 
+    assert len(indexer["RefContigID"]       ) <= len(chromosome_names), "number of chromosome differ from %d to %d\n%s\n%s" % (len(indexer["RefContigID"]       ), len(chromosome_names),     indexer["RefContigID"].keys() , chromosome_names)
+    assert max(indexer["RefContigID"].keys()) <= len(chromosome_names), "number of chromosome differ from %d to %d"         % (max(indexer["RefContigID"].keys()), len(chromosome_names))
+
+    linecount = 0
+    #fhd.write("/home/assembly/nobackup/mummer/MUMmer3.23/1502/solanum_lycopersicum_heinz/SL2.40ch12.fa /home/assembly/nobackup/mummer/MUMmer3.23/1502/solanum_pennellii_scaffold/final.assembly.fasta\n")
+    
+    fhd.write("##gff-version 3\n")
+    
+    for RefContigID in sorted(groups["RefContigID_RefStartPos"]):
+        RefStartPoses = groups["RefContigID_RefStartPos"][RefContigID]
+        RefEndPoses   = groups["RefContigID_RefEndPos"  ][RefContigID]
+        ref_min_pos   = min( [min(RefEndPoses), min(RefStartPoses)] )
+        ref_max_pos   = max( [max(RefEndPoses), max(RefStartPoses)] )
+        fhd.write("##sequence-region %s %d %d\n" % (chromosome_names[RefContigID-1], int(ref_min_pos), int(ref_max_pos)))
+    
+    
+    fhd.write( "#\n" + "\n".join([ "# XMAP "+x[1:] for x in headers[:-2] ]) + "\n#\n")
+
+    
+    
+
+
+
+
+
+    cds_plan            = CdsPlan(data.names, exclude_cols, filters)
+    filter_text         = cds_plan.filter_text
+
+    gene_tmpl           = "\t".join([ "%s", source_name, feature_name_full1, "%d", "%d", '.', '.', '.', "ID=%s;Name=%s"               ])
+    mrna_tmpl           = "\t".join([ "%s", source_name, feature_name_full2, "%d", "%d", '.', '.', '.', "ID=%s_m;Name=%s_m;Parent=%s" ])
+    cds_tmpl            = "\t".join([ "%s", source_name, feature_name_piece, "%s", "%s", "%s", "%s", '.', "ID=%s_m_%06d_c;Name=%s_m_%06d_c;Parent=%s_m;Gap=%s%s" ])
+
+    def write_genes(genes):
+        #every gene, with its mRNA and CDS lines, goes out as one record, so
+        #that an indexed output keeps them together
+        rows      = np.concatenate([ x[2] for x in genes ])
+        attrs     = cds_plan.attributes(data, rows)
+
+        ref_start = data.column("RefStartPos")[rows]
+        ref_end   = data.column("RefEndPos"  )[rows]
+        firsts    = np.cumsum([0] + [ len(x[2]) for x in genes[:-1] ])
+        gene_begs = np.minimum.reduceat(np.minimum(ref_start, ref_end), firsts).astype(np.int64).tolist()
+        gene_ends = np.maximum.reduceat(np.maximum(ref_start, ref_end), firsts).astype(np.int64).tolist()
+
+        starts    = map(str, ref_start.astype(np.int64).tolist())
+        ends      = map(str, ref_end  .astype(np.int64).tolist())
+        confs     = cds_plan.column_text(data, "Confidence" , rows)
+        orients   = cds_plan.column_text(data, "Orientation", rows)
+        hitenums  = cds_plan.column_text(data, "HitEnum"    , rows)
+
+        pos       = 0
+        for gene_num, (chromosome_name, QryContigID, qry_rows) in enumerate(genes):
+            gene_id = "%s%s_%d" % ( id_prefix, chromosome_name, QryContigID )
+            beg     = gene_begs[gene_num]
+            end     = gene_ends[gene_num]
+
+            record  = [
+                gene_tmpl % ( chromosome_name, beg, end, gene_id, gene_id          ) + filter_text + "\n",
+                mrna_tmpl % ( chromosome_name, beg, end, gene_id, gene_id, gene_id ) + filter_text + "\n"
+            ]
+
+            #http://www.ensembl.org/info/website/upload/gff.html
+            #seqname source feature start end score strand frame attribute
+            for qry_num in xrange(1, len(qry_rows) + 1):
+                record.append( cds_tmpl % ( chromosome_name, starts[pos], ends[pos], confs[pos], orients[pos], gene_id, qry_num, gene_id, qry_num, gene_id, hitenums[pos], attrs[pos] ) + filter_text + "\n" )
+                pos += 1
+
+            fhd.write_record(chromosome_name, beg, end, "".join(record))
+
+    genes               = []
+    num_rows            = 0
+    for RefContigID in sorted(groups["RefContigID_RefStartPos"]):
+        chromosome_name = chromosome_names[RefContigID-1]
+
+        for QryContigID, qry_rows in ref_genes(data, groups, RefContigID):
+            genes.append( ( chromosome_name, QryContigID, qry_rows ) )
+            num_rows   += len(qry_rows)
+
+            if num_rows >= cds_plan.batch_rows:
+                with profile_stage("render", rows=num_rows):
+                    write_genes(genes)
+                genes    = []
+                num_rows = 0
+
+    if len(genes) > 0:
+        with profile_stage("render", rows=num_rows):
+            write_genes(genes)
+
+
+
+
+
+    #for RefContigID in sorted(groups["RefContigID_RefStartPos"]):
+    #    RefStartPoses = groups["RefContigID_RefStartPos"][RefContigID]
+    #
+    #    for RefStartPosG in sorted(RefStartPoses):
+    #        pos_rows  = list(RefStartPoses[RefStartPosG])
+    #        
+    #        for pos_row_pos in pos_rows:
+    #            pos_row         = data[pos_row_pos]
+    #
+    #            QryContigID     = pos_row["QryContigID"]
+    #            
+    #            RefStartPos     = pos_row["RefStartPos"]
+    #            RefEndPos       = pos_row["RefEndPos"  ]
+    #            RefLen          = pos_row["RefLen"     ]
+    #            
+    #            QryStartPos     = pos_row["QryStartPos"]
+    #            QryEndPos       = pos_row["QryEndPos"  ]
+    #            QryLen          = pos_row["QryLen"     ]
+    #            
+    #            Confidence      = pos_row["Confidence" ]
+    #            Orientation     = pos_row["Orientation"]
+    #            HitEnum         = pos_row["HitEnum"    ]
+    #
+    #            attributes_keys = [
+    #                [ 'ID'  , QryContigID ],
+    #                [ 'Name', QryContigID ],
+    #                [ 'Gap' , HitEnum     ],
+    #            ]
+    #            
+    #            for k in sorted(pos_row):
+    #                if k in exclude_cols:
+    #                    continue
+    #                attributes_keys.append( [ k.lower(), pos_row[k] ] )
+    #
+    #            for filter_data in filters:
+    #                attributes_keys.append( [ "_meta_filter_"+filter_data[0].lower(), filter_data[1] + '_' + str(filter_data[3]) ] )
+    #
+    #            attributes  = ";".join("=".join([k,str(v)]) for k,v in attributes_keys)
+    #
+    #            #http://www.ensembl.org/info/website/upload/gff.html
+    #            #        seqname                          source       feature       start             end             score       strand       frame attribute 
+    #            line = [ chromosome_names[RefContigID-1], source_name, feature_name, int(RefStartPos), int(RefEndPos), Confidence, Orientation, '.',  attributes]
+    #            fhd.write(      "\t".join([str(x) for x in line]) + "\n")
+
+
+
+def main(args):
+    from om_io import open_output, output_name
+
+    valid_fields        = gen_valid_fields(valid_fields_g)
+    infile              = args.infile
+    chromosome_names    = args.names
+    exclude_cols        = args.exclude_cols
+    oufile              = output_name(infile + ".gff3", args.compress)
+
 
     if not os.path.exists(infile):
         print "input file %s does not exists" % infile
@@ -107,8 +333,9 @@ def main(args):
         sys.exit(1)
     
     print "saving to %s" % oufile
+    profile_output(oufile)
 
-    data, headers, names, seman, types, indexer, groups, ref_maps_from, query_maps_from, filters_csv = parse_file(infile, valid_fields)
+    data, headers, names, seman, types, indexer, groups, ref_maps_from, query_maps_from, filters_csv = parse_file(infile, valid_fields, cache=args.cache)
 
     filters = gen_filter(filters_csv, valid_fields)
 
@@ -120,197 +347,12 @@ def main(args):
     
     print "file has %5d maps and %3d chromosomes" % (len(indexer["QryContigID"]), len(indexer["RefContigID"]))
 
-    assert len(indexer["RefContigID"]       ) <= len(chromosome_names), "number of chromosome differ from %d to %d\n%s\n%s" % (len(indexer["RefContigID"]       ), len(chromosome_names),     indexer["RefContigID"].keys() , chromosome_names)
-    assert max(indexer["RefContigID"].keys()) <= len(chromosome_names), "number of chromosome differ from %d to %d"         % (max(indexer["RefContigID"].keys()), len(chromosome_names))
 
     print chromosome_names
     
     print "CREATING GFF: ", oufile
-    with open(oufile, "w") as fhd:
-        linecount = 0
-        #fhd.write("/home/assembly/nobackup/mummer/MUMmer3.23/1502/solanum_lycopersicum_heinz/SL2.40ch12.fa /home/assembly/nobackup/mummer/MUMmer3.23/1502/solanum_pennellii_scaffold/final.assembly.fasta\n")
-        
-        fhd.write("##gff-version 3\n")
-        
-        for RefContigID in sorted(groups["RefContigID_RefStartPos"]):
-            RefStartPoses = groups["RefContigID_RefStartPos"][RefContigID]
-            RefEndPoses   = groups["RefContigID_RefEndPos"  ][RefContigID]
-            ref_min_pos   = min( [min(RefEndPoses), min(RefStartPoses)] )
-            ref_max_pos   = max( [max(RefEndPoses), max(RefStartPoses)] )
-            fhd.write("##sequence-region %s %d %d\n" % (chromosome_names[RefContigID-1], int(ref_min_pos), int(ref_max_pos)))
-        
-        
-        fhd.write( "#\n" + "\n".join([ "# XMAP "+x[1:] for x in headers[:-2] ]) + "\n#\n")
-
-        
-        data = [ KeyedTuple(x, labels=names)._asdict() for x in data ]
-        
-
-
-
-
-
-        done_QryContigID = {}
-        for RefContigID in sorted(groups["RefContigID_RefStartPos"]):
-            RefStartPoses = groups["RefContigID_RefStartPos"][RefContigID]
-            RefLen        = 0
-
-            for RefStartPosG in sorted(RefStartPoses):
-                pos_rows = list(RefStartPoses[RefStartPosG])
-                
-                for pos_row_pos in pos_rows:
-                    pos_row = data[pos_row_pos]
-
-                    QryContigID = pos_row["QryContigID"]
-                    
-                    if QryContigID not in done_QryContigID:
-                        done_QryContigID[QryContigID] = {}
-                    
-                    first_time = True
-                    
-                    if RefContigID in done_QryContigID[QryContigID]:
-                        continue
-                    
-                    else:
-                        done_QryContigID[QryContigID][RefContigID] = True
-                    
-                    qry_rows             = list(groups["RefContigID_QryContigID"][RefContigID][QryContigID])
-                    
-                    ref_lens             = [ ( data[x]["RefStartPos"], data[x]["RefEndPos"] ) for x in qry_rows ]
-                    qry_lens             = [ ( data[x]["QryStartPos"], data[x]["QryEndPos"] ) for x in qry_rows ]
-        
-                    ref_no_gap_len       = sum( [ max(x)-min(x) for x in ref_lens ] )
-                    ref_min_coord        = min( [ min(x)        for x in ref_lens ] )
-                    ref_max_coord        = max( [ max(x)        for x in ref_lens ] )
-                    
-                    qry_no_gap_len       = sum( [ max(x)-min(x) for x in qry_lens ] )
-                    qry_min_coord        = min( [ min(x)        for x in qry_lens ] )
-                    qry_max_coord        = max( [ max(x)        for x in qry_lens ] )
-
-
-                    chromosome_name = chromosome_names[RefContigID-1]
-
-                    attributes_keys_G = [
-                        [ 'ID'  , "%s%s_%d"   % ( id_prefix, chromosome_name, QryContigID ) ],
-                        [ 'Name', "%s%s_%d"   % ( id_prefix, chromosome_name, QryContigID ) ]
-                    ]
-
-                    for filter_data in filters:
-                        attributes_keys_G.append( [ "_meta_filter_"+filter_data[0].lower(), filter_data[1] + '_' + str(filter_data[3]) ] )
-        
-                    attributes_G  = ";".join("=".join([k,str(v)]) for k,v in attributes_keys_G)
-                    
-                    line_G = [ chromosome_name, source_name, feature_name_full1, int(ref_min_coord), int(ref_max_coord), '.', '.', '.',  attributes_G]
-                    fhd.write(      "\t".join([str(x) for x in line_G]) + "\n")
-
-
-
-
-                    attributes_keys_G = [
-                        [ 'ID'    , "%s%s_%d_m" % ( id_prefix, chromosome_name, QryContigID ) ],
-                        [ 'Name'  , "%s%s_%d_m" % ( id_prefix, chromosome_name, QryContigID ) ],
-                        [ 'Parent', "%s%s_%d"   % ( id_prefix, chromosome_name, QryContigID ) ]
-                    ]
-
-                    for filter_data in filters:
-                        attributes_keys_G.append( [ "_meta_filter_"+filter_data[0].lower(), filter_data[1] + '_' + str(filter_data[3]) ] )
-        
-                    attributes_G  = ";".join("=".join([k,str(v)]) for k,v in attributes_keys_G)
-                    
-                    line_G = [ chromosome_name, source_name, feature_name_full2, int(ref_min_coord), int(ref_max_coord), '.', '.', '.',  attributes_G]
-                    fhd.write(      "\t".join([str(x) for x in line_G]) + "\n")
-
-
-
-
-                    qry_num = 1
-                    for qry_row_pos in qry_rows:
-                        qry_row         = data[qry_row_pos]
-                        
-                        RefStartPos     = qry_row["RefStartPos"]
-                        RefEndPos       = qry_row["RefEndPos"  ]
-                        RefLen          = qry_row["RefLen"     ]
-                        
-                        QryStartPos     = qry_row["QryStartPos"]
-                        QryEndPos       = qry_row["QryEndPos"  ]
-                        QryLen          = qry_row["QryLen"     ]
-                        
-                        Confidence      = qry_row["Confidence" ]
-                        Orientation     = qry_row["Orientation"]
-                        HitEnum         = qry_row["HitEnum"    ]
-            
-                        attributes_keys = [
-                            [ 'ID'    , "%s%s_%d_m_%06d_c" % ( id_prefix, chromosome_name, QryContigID, qry_num ) ],
-                            [ 'Name'  , "%s%s_%d_m_%06d_c" % ( id_prefix, chromosome_name, QryContigID, qry_num ) ],
-                            [ 'Parent', "%s%s_%d_m"        % ( id_prefix, chromosome_name, QryContigID          ) ],
-                            [ 'Gap'   , HitEnum                                  ],
-                        ]
-                        
-                        for k in sorted(qry_row):
-                            if k in exclude_cols:
-                                continue
-                            attributes_keys.append( [ k.lower(), qry_row[k] ] )
-            
-                        for filter_data in filters:
-                            attributes_keys.append( [ "_meta_filter_"+filter_data[0].lower(), filter_data[1] + '_' + str(filter_data[3]) ] )
-            
-                        attributes  = ";".join("=".join([k,str(v)]) for k,v in attributes_keys)
-
-                        #http://www.ensembl.org/info/website/upload/gff.html
-                        #        seqname          source       feature             start             end             score       strand       frame attribute 
-                        line = [ chromosome_name, source_name, feature_name_piece, int(RefStartPos), int(RefEndPos), Confidence, Orientation, '.',  attributes]
-                        fhd.write(      "\t".join([str(x) for x in line]) + "\n")
-
-                        qry_num += 1
-
-
-
-
-
-        #for RefContigID in sorted(groups["RefContigID_RefStartPos"]):
-        #    RefStartPoses = groups["RefContigID_RefStartPos"][RefContigID]
-        #
-        #    for RefStartPosG in sorted(RefStartPoses):
-        #        pos_rows  = list(RefStartPoses[RefStartPosG])
-        #        
-        #        for pos_row_pos in pos_rows:
-        #            pos_row         = data[pos_row_pos]
-        #
-        #            QryContigID     = pos_row["QryContigID"]
-        #            
-        #            RefStartPos     = pos_row["RefStartPos"]
-        #            RefEndPos       = pos_row["RefEndPos"  ]
-        #            RefLen          = pos_row["RefLen"     ]
-        #            
-        #            QryStartPos     = pos_row["QryStartPos"]
-        #            QryEndPos       = pos_row["QryEndPos"  ]
-        #            QryLen          = pos_row["QryLen"     ]
-        #            
-        #            Confidence      = pos_row["Confidence" ]
-        #            Orientation     = pos_row["Orientation"]
-        #            HitEnum         = pos_row["HitEnum"    ]
-        #
-        #            attributes_keys = [
-        #                [ 'ID'  , QryContigID ],
-        #                [ 'Name', QryContigID ],
-        #                [ 'Gap' , HitEnum     ],
-        #            ]
-        #            
-        #            for k in sorted(pos_row):
-        #                if k in exclude_cols:
-        #                    continue
-        #                attributes_keys.append( [ k.lower(), pos_row[k] ] )
-        #
-        #            for filter_data in filters:
-        #                attributes_keys.append( [ "_meta_filter_"+filter_data[0].lower(), filter_data[1] + '_' + str(filter_data[3]) ] )
-        #
-        #            attributes  = ";".join("=".join([k,str(v)]) for k,v in attributes_keys)
-        #
-        #            #http://www.ensembl.org/info/website/upload/gff.html
-        #            #        seqname                          source       feature       start             end             score       strand       frame attribute 
-        #            line = [ chromosome_names[RefContigID-1], source_name, feature_name, int(RefStartPos), int(RefEndPos), Confidence, Orientation, '.',  attributes]
-        #            fhd.write(      "\t".join([str(x) for x in line]) + "\n")
-
+    with open_output(oufile, args.compress, index=args.index) as fhd:
+        write_gff(fhd, data, indexer, groups, headers, filters, chromosome_names, exclude_cols)
         print
 
 
@@ -322,4 +364,5 @@ if __name__ == '__main__':
 
     args         = parse_args(sys.argv[1:])
 
-    main(args)
\ No newline at end of file
+    with profile_run("om_to_gff", args):
+        main(args)
\ No newline at end of file